@@ -1,73 +1,144 @@
-from fastapi import APIRouter, Response, HTTPException
-from typing import List
+import zlib
+from time import perf_counter
+from fastapi import APIRouter, Request, Response, HTTPException
+from typing import List, Optional
 from models.mtm_messaging_model import PatientRecord
-from services.mtm_messaging import convert_to_ncpdp_message
-from fastapi.responses import StreamingResponse
-from fastapi import Depends
-from sqlalchemy.orm import Session
+from services.mtm_messaging import (
+    convert_to_ncpdp_message, get_messaging_values, iter_all_records_messaging, iter_changed_messaging,
+    iter_patient_records,
+)
+from services.change_tracking import next_token
+from services.serializers import MESSAGING_KEYS
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from fastapi import Header
 
-from core.database import SessionLocal
-from models.mtm_orm_model import MTMRecordORM
+from core.database import SessionLocal, run_in_session
+from core.metrics import add_stage
+from services import columnar, mtm_service
+from services.coalesce import coalescer
+from services.render_cache import render_cache
+from services.export_artifacts import ARTIFACTS_ENABLED, artifact_store
+from api.mtm_routes import (
+    artifact_response, cached_response, ndjson_response, parse_since, response_format,
+)
 
 router = APIRouter(prefix="/mtm", tags=["MTM"])
 
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
+def get_patient_record(db, patient_id: str):
+    return mtm_service.get_record_by_id(db, patient_id)
 
 @router.get("/ncpdp/messaging/download/{patient_id}", response_class=Response)
-def download_patient_message(patient_id: str):
-    with SessionLocal() as db:
-        record = db.query(MTMRecordORM).filter(MTMRecordORM.PATIENT_ID == patient_id).first()
-        if record:
-            patient = PatientRecord.from_orm_model(record)
-            content = convert_to_ncpdp_message(patient)
-            return Response(content=content, media_type="text/plain", headers={"Content-Disposition": f"attachment; filename={patient_id}.txt"})
+async def download_patient_message(patient_id: str, if_none_match: Optional[str] = Header(None)):
+    def render():
+        with SessionLocal() as db:
+            record = get_patient_record(db, patient_id)
+            if record:
+                return convert_to_ncpdp_message(PatientRecord.from_orm_model(record))
+            return None
+
+    entry = await coalescer.run(("ncpdp", patient_id), render_cache.get_or_render, patient_id, "ncpdp", render)
+    if entry is None:
         raise HTTPException(status_code=404, detail="Patient not found")
+    return cached_response(entry, if_none_match, media_type="text/plain",
+                           headers={"Content-Disposition": f"attachment; filename={patient_id}.txt"})
     
-# GET: All patient records for NCPDP messaging
+# GET: All patient records for NCPDP messaging; one per line with ?format=ndjson
+# or Accept: application/x-ndjson
 @router.get("/ncpdp/messaging", response_model=List[PatientRecord])
-def get_all_messaging_patients():
-    with SessionLocal() as db:
-        records = db.query(MTMRecordORM).all()
-        return [PatientRecord.from_orm_model(r) for r in records]
+async def get_all_messaging_patients(request: Request, format: Optional[str] = None):
+    format = response_format(request, format, allowed=("json", "ndjson"))
+    if format == "ndjson":
+        return ndjson_response(iter_patient_records)
+
+    def load(db):
+        # Already validated by PatientRecord; skip response_model's second pass
+        return [PatientRecord.from_orm_model(r).model_dump() for r in mtm_service.get_all_records(db)]
 
-# GET: Patient record by ID
+    records = await coalescer.run_in_session("ncpdp/messaging", load)
+    return ORJSONResponse(records, headers={"Vary": "Accept"})
+
+def parse_messaging_keys(keys: str):
+    requested = list(dict.fromkeys(key.strip().upper() for key in keys.split(",") if key.strip()))
+    if not requested:
+        raise HTTPException(status_code=400, detail="No NCPDP keys requested")
+    unknown = [key for key in requested if key not in MESSAGING_KEYS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown NCPDP keys: {', '.join(unknown)}")
+    return requested
+
+# GET: Patient record by ID, or just some NCPDP keys with ?keys=AM20,PRV,DT
 @router.get("/ncpdp/messaging/{patient_id}", response_model=PatientRecord)
-def get_messaging_patient_by_id(patient_id: str):
-    with SessionLocal() as db:
-        record = db.query(MTMRecordORM).filter(MTMRecordORM.PATIENT_ID == patient_id).first()
-        if record:
-            return PatientRecord.from_orm_model(record)
-        raise HTTPException(status_code=404, detail="Patient not found")
+async def get_messaging_patient_by_id(patient_id: str, keys: Optional[str] = None):
+    if keys is not None:
+        requested = parse_messaging_keys(keys)
+        values = await run_in_session(get_messaging_values, patient_id, requested)
+        if values is None:
+            raise HTTPException(status_code=404, detail="Patient not found")
+        return JSONResponse(values)
+
+    record = await run_in_session(get_patient_record, patient_id)
+    if record:
+        return PatientRecord.from_orm_model(record)
+    raise HTTPException(status_code=404, detail="Patient not found")
 
 @router.get("/ncpdp/messaging/{patient_id}/{key}", response_model=dict)
-def get_value_by_messaging_key(patient_id: str, key: str):
-    with SessionLocal() as db:
-        record = db.query(MTMRecordORM).filter(MTMRecordORM.PATIENT_ID == patient_id).first()
-        if not record:
-            raise HTTPException(status_code=404, detail="Patient not found")
+async def get_value_by_messaging_key(patient_id: str, key: str):
+    requested = parse_messaging_keys(key)
+    if len(requested) != 1:
+        raise HTTPException(status_code=400, detail="Use ?keys= to request several NCPDP keys")
+    values = await run_in_session(get_messaging_values, patient_id, requested)
+    if values is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    value = values[requested[0]]
+    if value is None:
+        raise HTTPException(status_code=404, detail=f"Key '{key}' not found or value is empty for this patient.")
 
-        patient = PatientRecord.from_orm_model(record)
-        value = getattr(patient, key.upper(), None)
-        if value is None:
-            raise HTTPException(status_code=404, detail=f"Key '{key}' not found or value is empty for this patient.")
+    return values
 
-        return {key.upper(): value}
+
+def gzip_chunks(chunks):
+    # wbits=31 -> gzip container; flush per chunk so clients see data early
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        start = perf_counter()
+        data = compressor.compress(chunk.encode("utf-8"))
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        add_stage("gzip", perf_counter() - start)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def stream_all_records_messaging(since: Optional[str] = None):
+    # The generator owns its session: it outlives the request handler
+    with SessionLocal() as db:
+        if since is None:
+            yield from iter_all_records_messaging(db)
+        else:
+            yield from iter_changed_messaging(db, since)
 
 
 @router.get("/messaging/all", response_class=Response)
-def get_all_records_messaging(db: Session = Depends(get_db)):
-    records = db.query(MTMRecordORM).all()
-    messages = [convert_to_ncpdp_message(PatientRecord.from_orm_model(r)) for r in records]
-    full_text = "\n\n".join(messages)
-    return Response(
-        content=full_text,
-        media_type="text/plain",
-        headers={"Content-Disposition": "attachment; filename=all_patients.txt"}
-    )
\ No newline at end of file
+async def get_all_records_messaging(request: Request, since: Optional[str] = None):
+    stamp = parse_since(since)
+    if stamp is None and ARTIFACTS_ENABLED:
+        artifact = await artifact_store.get("messaging")
+        if artifact is not None:
+            return artifact_response(request, artifact, media_type="text/plain", headers={
+                "Content-Disposition": "attachment; filename=all_patients.txt"})
+    gzipped = columnar.accepts_encoding(request.headers.get("accept-encoding"))
+
+    def start():
+        content = stream_all_records_messaging(stamp)
+        return next_token(), gzip_chunks(content) if gzipped else content
+
+    # Identical concurrent exports share one scan, and its token
+    token, chunks = coalescer.stream(("messaging/all", stamp, gzipped), start)
+    headers = {
+        "Content-Disposition": "attachment; filename=all_patients.txt",
+        "X-Next-Since": token,
+    }
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return StreamingResponse(chunks, media_type="text/plain", headers=headers)
@@ -1,43 +1,319 @@
-from fastapi import APIRouter, Depends, HTTPException, Response
-from sqlalchemy.orm import Session
-from models.mtm_model import MTMRecord
-from services import mtm_service
-from core.database import SessionLocal
-from fastapi.responses import PlainTextResponse
+import os
+from datetime import date
+from email.utils import parsedate_to_datetime
+from typing import List, Optional
+from fastapi import APIRouter, Header, HTTPException, Query, Request, Response
+from models.mtm_model import MTMRecord, BatchLookupRequest
+from services import bulk_ingest, columnar, mtm_service, ndjson, search
+from services.mtm_messaging import iter_messages
+from services.change_tracking import ExpiredToken, next_token, parse_token
+from services.coalesce import coalescer
+from services.render_cache import etag_matches, render_cache
+from services.snapshot import snapshot
+from services.export_artifacts import ARTIFACTS_ENABLED, artifact_store
+from services.serializers import MESSAGING_PLAN, XML_PLAN
+from core.database import SessionLocal, iterate_in_executor, run_db, run_in_session
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 
 router = APIRouter(prefix="/mtm", tags=["MTM"])
 
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+MAX_PAGE_SIZE = 1000
+# Formats of record lists and table dumps: by ?format=, else by Accept
+RECORD_FORMATS = ("json", "ndjson", "msgpack", "arrow", "parquet")
+# Search can also export these, by ?format= only
+SEARCH_EXPORT_FORMATS = ("xml", "messaging")
 
 @router.post("/")
-def create_mtm(record: MTMRecord, db: Session = Depends(get_db)):
-    return mtm_service.create_record(db, record)
+async def create_mtm(record: MTMRecord):
+    created = await run_in_session(mtm_service.create_record, record)
+    return mtm_service.public_record(created)
+
+@router.post("/bulk")
+async def bulk_create_mtm(
+    request: Request,
+    chunk_size: int = Query(bulk_ingest.BULK_CHUNK_SIZE, ge=1, le=bulk_ingest.MAX_CHUNK_SIZE),
+):
+    # NDJSON body, one MTMRecord per line; bad rows are reported, not fatal
+    return await bulk_ingest.ingest(request.stream(), chunk_size)
+
+@router.get("/cache/stats")
+async def get_render_cache_stats():
+    return render_cache.stats()
+
+@router.get("/coalesce/stats")
+async def get_coalesce_stats():
+    return coalescer.stats()
+
+@router.get("/snapshot/stats")
+async def get_snapshot_stats():
+    # Sizing the index walks every key, so keep it off the event loop
+    return await run_db(snapshot.stats)
+
+def render_batch(db, request: BatchLookupRequest):
+    records = mtm_service.get_records_by_ids(db, request.patient_ids)
+    if request.format == "xml":
+        rows = map(XML_PLAN.values_of, records)
+        xml_data = "".join(mtm_service.iter_records_as_ncpdp_xml(rows))
+        return Response(content=xml_data, media_type="application/xml")
+    if request.format == "messaging":
+        rows = map(MESSAGING_PLAN.values_of, records)
+        return Response(content="".join(iter_messages(rows)), media_type="text/plain")
+    return [mtm_service.public_record(record) for record in records]
+
+@router.post("/batch")
+async def batch_lookup(request: BatchLookupRequest):
+    key = ("batch", request.format, tuple(request.patient_ids))
+    return await coalescer.run_in_session(key, render_batch, request)
+
+def stream_search(render, filters):
+    # The generator owns its session: it outlives the request handler
+    with SessionLocal() as db:
+        yield from render(db, filters)
+
+def search_page_with_count(db, filters, limit, after, with_count):
+    rows, next_after = search.search_page(db, filters, limit, after)
+    rows = [mtm_service.public_record(row) for row in rows]
+    return rows, next_after, search.count_matches(db, filters) if with_count else None
+
+# Declared before /{patient_id} so "search" is not taken for a patient ID
+@router.get("/search")
+async def search_mtm(
+    request: Request,
+    response: Response,
+    payer_id: Optional[List[str]] = Query(None),
+    plan_name: Optional[List[str]] = Query(None),
+    intervention_type: Optional[List[str]] = Query(None),
+    mtm_service_code: Optional[List[str]] = Query(None),
+    outcome: Optional[List[str]] = Query(None),
+    start_from: Optional[date] = None,
+    start_to: Optional[date] = None,
+    end_from: Optional[date] = None,
+    end_to: Optional[date] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    count: bool = True,
+    format: Optional[str] = None,
+):
+    """Records matching every given filter; repeat a parameter to match any of several values.
+
+    ``ndjson``, ``xml``, ``messaging``, ``arrow`` and ``parquet`` stream every
+    match as an export; ``json`` and ``msgpack`` are keyset pages with
+    X-Total-Count / X-Next-After.
+    """
+    filters = search.SearchFilters(
+        matches=dict(zip(search.MATCH_COLUMNS,
+                         (payer_id, plan_name, intervention_type, mtm_service_code, outcome))),
+        start_from=start_from, start_to=start_to, end_from=end_from, end_to=end_to,
+    )
+    format = response_format(request, format, extra=SEARCH_EXPORT_FORMATS)
+    if format in columnar.DUMP_FORMATS:
+        names = mtm_service.get_column_names()
+        return dump_response(format, lambda db: search.iter_search_rows(db, filters, names), names,
+                             "search_results")
+    if format == "ndjson":
+        names = mtm_service.get_column_names()
+        return ndjson_response(
+            lambda db: ndjson.iter_row_dicts(search.iter_search_rows(db, filters, names), names))
+    if format == "xml":
+        return StreamingResponse(iterate_in_executor(stream_search(search.iter_search_xml, filters)),
+                                 media_type="application/xml")
+    if format == "messaging":
+        return StreamingResponse(
+            iterate_in_executor(stream_search(search.iter_search_messaging, filters)),
+            media_type="text/plain",
+            headers={"Content-Disposition": "attachment; filename=search_results.txt"},
+        )
+    rows, next_after, total = await run_in_session(search_page_with_count, filters, limit, after, count)
+    headers = {}
+    if total is not None:
+        headers["X-Total-Count"] = str(total)
+    if next_after is not None:
+        headers["X-Next-After"] = next_after
+    return await records_response(format, rows, response, headers)
 
 @router.get("/{patient_id}")
-def read_mtm(patient_id: str, db: Session = Depends(get_db)):
-    record = mtm_service.get_record_by_id(db, patient_id)
+async def read_mtm(patient_id: str):
+    record = await run_in_session(mtm_service.get_record_by_id, patient_id)
     if not record:
         raise HTTPException(status_code=404, detail="Record not found")
-    return record
+    return mtm_service.public_record(record)
+
+def cached_response(entry, if_none_match, media_type, headers=None):
+    """Serve a render-cache entry with its ETag, or 304 if the client has it."""
+    headers = {**(headers or {}), "ETag": entry.etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.content, media_type=media_type, headers=headers)
+
+def not_modified_since(if_modified_since: Optional[str], mtime: float) -> bool:
+    try:
+        return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+def artifact_response(request: Request, artifact, media_type, headers=None):
+    """Serve a materialized export from disk: gzip if accepted, Range, 304s."""
+    gzipped = columnar.accepts_encoding(request.headers.get("accept-encoding"))
+    path = artifact.gzip_path if gzipped else artifact.path
+    stat_result = os.stat(path)
+    headers = {
+        **(headers or {}),
+        "ETag": f'"{artifact.version}-gzip"' if gzipped else f'"{artifact.version}"',
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+        # Issued now rather than at build time: the caller has just checked the
+        # file holds every write so far, and a token saved with a file that
+        # outlives the tombstone retention would only ever be rejected
+        "X-Next-Since": next_token(),
+    }
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+    response = FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
+    if_none_match = request.headers.get("if-none-match")
+    if (etag_matches(if_none_match, headers["ETag"]) if if_none_match
+            else not_modified_since(request.headers.get("if-modified-since"), stat_result.st_mtime)):
+        kept = {name: response.headers[name] for name in ("etag", "last-modified", "cache-control", "vary")}
+        return Response(status_code=304, headers=kept)
+    return response
+
+def response_format(request: Request, format: Optional[str] = None, allowed=RECORD_FORMATS, extra=()) -> str:
+    """``?format=`` if given, else the best of ``allowed`` for the Accept header.
+
+    An Accept header that names none of them gets ``allowed[0]`` (JSON), as
+    before negotiation existed; only an explicit format the route cannot
+    produce is a 406. ``extra`` formats are available by ``?format=`` only.
+    """
+    if format is not None:
+        if format not in allowed and format not in extra:
+            supported = ", ".join(allowed + tuple(extra))
+            raise HTTPException(status_code=406, detail=f"Supported formats: {supported}")
+        return format
+    return columnar.negotiate(request.headers.get("accept"), allowed) or allowed[0]
+
+async def records_response(fmt: str, rows, response: Response, headers=None):
+    headers = {**(headers or {}), "Vary": "Accept"}
+    if fmt == "msgpack":
+        content = await run_db(columnar.pack_records, rows, mtm_service.get_column_names())
+        return Response(content=content, media_type=columnar.MEDIA_TYPES["msgpack"], headers=headers)
+    response.headers.update(headers)
+    return rows
+
+def stream_dump(fmt: str, rows_of, names):
+    # The generator owns its session: it outlives the request handler
+    with SessionLocal() as db:
+        yield from columnar.iter_dump(fmt, rows_of(db), names)
+
+def dump_response(fmt: str, rows_of, names, basename: str):
+    """Stream ``rows_of(db)`` as an Arrow or Parquet download."""
+    return StreamingResponse(
+        iterate_in_executor(stream_dump(fmt, rows_of, names)),
+        media_type=columnar.MEDIA_TYPES[fmt],
+        headers={
+            "Content-Disposition": f"attachment; filename={basename}.{columnar.FILE_EXTENSIONS[fmt]}",
+            "Vary": "Accept",
+        },
+    )
+
+def stream_ndjson(records_of):
+    # The generator owns its session: it outlives the request handler
+    with SessionLocal() as db:
+        yield from ndjson.iter_ndjson(records_of(db))
+
+def ndjson_response(records_of):
+    """Stream the dicts from ``records_of(db)`` one JSON document per line."""
+    return StreamingResponse(iterate_in_executor(stream_ndjson(records_of)),
+                             media_type=ndjson.MEDIA_TYPE, headers={"Vary": "Accept"})
+
+def parse_fields(fields: Optional[str]):
+    if not fields:
+        return None
+    requested = [name.strip().upper() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in mtm_service.get_column_names()]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+def get_page_with_count(db, limit, after, projection):
+    rows, next_after = mtm_service.get_records_page(db, limit, after, projection)
+    if projection is None:
+        rows = [mtm_service.public_record(row) for row in rows]
+    return rows, next_after, mtm_service.count_records(db)
+
+def get_all_public_records(db):
+    return [mtm_service.public_record(record) for record in mtm_service.get_all_records(db)]
 
 @router.get("/")
-def get_all_mtm(db: Session = Depends(get_db)):
-    return mtm_service.get_all_records(db)
+async def get_all_mtm(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    format: Optional[str] = None,
+):
+    # ndjson / arrow / parquet stream the whole table (optionally projected with
+    # ``fields``); json / msgpack return the record list or a keyset page of it
+    format = response_format(request, format)
+    projection = parse_fields(fields)
+    names = projection or mtm_service.get_column_names()
+    if format in columnar.DUMP_FORMATS:
+        return dump_response(format, lambda db: mtm_service.iter_table_rows(db, names), names,
+                             "all_patients")
+    if format == "ndjson":
+        return ndjson_response(
+            lambda db: ndjson.iter_row_dicts(mtm_service.iter_table_rows(db, names), names))
+    if limit is None and after is None and projection is None:
+        rows = await run_in_session(get_all_public_records)
+        return await records_response(format, rows, response)
+
+    rows, next_after, total = await run_in_session(
+        get_page_with_count, limit or MAX_PAGE_SIZE, after, projection
+    )
+    headers = {"X-Total-Count": str(total)}
+    if next_after is not None:
+        headers["X-Next-After"] = next_after
+    return await records_response(format, rows, response, headers)
 
 
 # XML Endpoints
 @router.get("/{patient_id}/xml")
-def get_xml_by_id(patient_id: str, db: Session = Depends(get_db)):
-    xml_data = mtm_service.get_record_as_ncpdp_xml_by_id(db, patient_id)
-    return Response(content=xml_data, media_type="application/xml")
+async def get_xml_by_id(patient_id: str, if_none_match: Optional[str] = Header(None)):
+    def render():
+        with SessionLocal() as db:
+            return mtm_service.get_record_as_ncpdp_xml_by_id(db, patient_id)
+
+    entry = await coalescer.run(("xml", patient_id), render_cache.get_or_render, patient_id, "xml", render)
+    return cached_response(entry, if_none_match, media_type="application/xml")
+
+def parse_since(since: Optional[str]):
+    """MODIFIED_AT stamp for a ``?since=`` token; 400 if malformed, 410 if expired."""
+    if since is None:
+        return None
+    try:
+        return parse_token(since)
+    except ExpiredToken as exc:
+        raise HTTPException(status_code=410, detail=f"{exc}; download a full export")
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+def stream_all_records_xml(since: Optional[str] = None):
+    # The generator owns its session: it outlives the request handler
+    with SessionLocal() as db:
+        if since is None:
+            yield from mtm_service.iter_all_records_as_ncpdp_xml(db)
+        else:
+            yield from mtm_service.iter_changed_records_as_ncpdp_xml(db, since)
 
 @router.get("/xml/all")
-def get_all_records_xml(db: Session = Depends(get_db)):
-    xml_data = mtm_service.get_all_records_as_ncpdp_xml(db)
-    return Response(content=xml_data, media_type="application/xml")
+async def get_all_records_xml(request: Request, since: Optional[str] = None):
+    # Full export, or only what changed since a token from an earlier export.
+    # Either way X-Next-Since carries the token for the next delta.
+    stamp = parse_since(since)
+    if stamp is None and ARTIFACTS_ENABLED:
+        artifact = await artifact_store.get("xml")
+        if artifact is not None:
+            return artifact_response(request, artifact, media_type="application/xml")
+    # Identical concurrent exports share one scan, and its token
+    token, chunks = coalescer.stream(
+        ("xml/all", stamp), lambda: (next_token(), stream_all_records_xml(stamp)))
+    return StreamingResponse(chunks, media_type="application/xml", headers={"X-Next-Since": token})
@@ -1,8 +1,16 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import StaticPool
+import asyncio
+import contextvars
+import logging
 import os
-from typing import Generator
-import snowflake.connector
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Generator, Optional
+
+logger = logging.getLogger(__name__)
 
 # Prefer os.getenv instead of crashing on missing keys
 user = os.getenv("SNOWFLAKE_USER")
@@ -13,18 +21,99 @@ database = os.getenv("SNOWFLAKE_DATABASE")
 schema = os.getenv("SNOWFLAKE_SCHEMA")
 role = os.getenv("SNOWFLAKE_ROLE")
 
-# SQLAlchemy engine for ORM
-DATABASE_URL = (
-    f"snowflake://{user}:{password}@{account}/{database}/{schema}"
-    f"?warehouse={warehouse}&role={role}"
-)
+# Connection pool tuning
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Connections opened at startup; 0 disables the warm-up
+POOL_WARM_UP = int(os.getenv("DB_POOL_WARM_UP", str(POOL_SIZE)))
+
+def get_database_url() -> str:
+    """DATABASE_URL if set (e.g. sqlite:///mtm.db for local runs), else Snowflake."""
+    return os.getenv("DATABASE_URL") or (
+        f"snowflake://{user}:{password}@{account}/{database}/{schema}"
+        f"?warehouse={warehouse}&role={role}"
+    )
+
+def build_engine(url: str, **overrides):
+    """SQLAlchemy engine for ``url`` with the pool settings above.
+
+    SQLite has no MTM_ANALYTICS schema, so tables are mapped to its default one.
+    """
+    options = dict(
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_recycle=POOL_RECYCLE,
+        pool_pre_ping=POOL_PRE_PING,
+    )
+    if url.startswith("sqlite"):
+        options["connect_args"] = {"check_same_thread": False}
+        options["execution_options"] = {"schema_translate_map": {"MTM_ANALYTICS": None}}
+        if url in ("sqlite://", "sqlite:///:memory:"):
+            # One shared connection, otherwise every checkout sees an empty database
+            options = {key: options[key] for key in ("connect_args", "execution_options")}
+            options["poolclass"] = StaticPool
+    options.update(overrides)
+    return create_engine(url, **options)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def use_engine(engine):
+    """Make ``engine`` the shared engine and bind SessionLocal to it."""
+    global _engine
+    with _engine_lock:
+        if _engine is not None and _engine is not engine:
+            _engine.dispose()
+        _engine = engine
+        SessionLocal.configure(bind=engine)
+    return engine
+
+def init_engine(url: Optional[str] = None, **overrides):
+    """(Re)create the shared engine, e.g. from a lifespan hook or a test."""
+    return use_engine(build_engine(url or get_database_url(), **overrides))
+
+def get_engine():
+    """The shared engine, created on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = build_engine(get_database_url())
+                SessionLocal.configure(bind=_engine)
+    return _engine
+
+def __getattr__(name):
+    # `database.engine` still works, it just no longer connects at import time
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class LazySessionMaker(sessionmaker):
+    """sessionmaker that creates the engine the first time a session is opened."""
+
+    def __call__(self, **local_kw):
+        if self.kw.get("bind") is None and "bind" not in local_kw:
+            get_engine()
+        return super().__call__(**local_kw)
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+SessionLocal = LazySessionMaker(autoflush=False, autocommit=False)
 Base = declarative_base()
 
+# Blocking DB work from async handlers runs here. One thread per connection
+# the pool can hand out, so threads never queue on a pool checkout.
+db_executor = ThreadPoolExecutor(
+    max_workers=POOL_SIZE + MAX_OVERFLOW, thread_name_prefix="db"
+)
+
 # Direct Snowflake connector
 def get_snowflake_connection():
+    # Imported here: the connector is slow to import and only this helper needs it
+    import snowflake.connector
+
     return snowflake.connector.connect(
         user=user,
         password=password,
@@ -42,3 +131,54 @@ def get_db() -> Generator:
         yield db
     finally:
         db.close()
+
+async def run_db(fn, *args, **kwargs):
+    """Run blocking DB work on the bounded DB executor.
+
+    Runs in a copy of the caller's context, so per-request metrics follow it.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, partial(context.run, fn, *args, **kwargs))
+
+def call_with_session(fn, *args, **kwargs):
+    with SessionLocal() as db:
+        return fn(db, *args, **kwargs)
+
+async def run_in_session(fn, *args, **kwargs):
+    """Call ``fn(db, *args, **kwargs)`` with a fresh session on the DB executor."""
+    return await run_db(call_with_session, fn, *args, **kwargs)
+
+async def iterate_in_executor(iterator):
+    """Drive a blocking iterator (e.g. a streaming export) on the DB executor."""
+    sentinel = object()
+    try:
+        while True:
+            chunk = await run_db(next, iterator, sentinel)
+            if chunk is sentinel:
+                break
+            yield chunk
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await run_db(close)
+
+def warm_up_pool(connections: int = POOL_WARM_UP):
+    """Open ``connections`` pooled connections up front so first requests skip connect."""
+    opened = []
+    try:
+        engine = get_engine()
+        for _ in range(connections):
+            conn = engine.connect()
+            opened.append(conn)
+            conn.execute(text("SELECT 1"))
+    except Exception as exc:
+        logger.warning("Connection pool warm-up stopped after %d connections: %s", len(opened), exc)
+    finally:
+        for conn in opened:
+            conn.close()
+    return len(opened)
+
+def shutdown():
+    if _engine is not None:
+        _engine.dispose()
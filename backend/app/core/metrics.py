@@ -0,0 +1,275 @@
+"""In-process request metrics exposed in the Prometheus text format.
+
+``MetricsMiddleware`` opens a ``RequestStats`` scratchpad per request. The
+service layer adds DB and serialization time to it through ``timed_query``,
+``timed_fetch`` and ``timed_stage``. When the response is finished, the
+middleware folds the scratchpad into the histograms once, labelled by route
+template. The hot paths only do float additions, and locks are taken once
+per request, so this is cheap enough to leave on in production.
+"""
+import os
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+from typing import Optional
+
+ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                 16777216, 67108864, 268435456)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra="") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, list(counts), total)
+                           for labels, (counts, total) in self._series.items())
+        bounds = [repr(float(bound)) for bound in self.buckets] + ["+Inf"]
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                label_text = _labels(self.labelnames, labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{label_text} {cumulative}"
+            label_text = _labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_text} {total}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_DURATION = registry.register(Histogram(
+    "mtm_http_request_duration_seconds",
+    "Time from request start until the last response byte was sent.",
+    ("route", "method", "status"),
+))
+RESPONSE_SIZE = registry.register(Histogram(
+    "mtm_http_response_size_bytes",
+    "Response body bytes sent, after any content encoding.",
+    ("route", "method"), buckets=BYTES_BUCKETS,
+))
+DB_DURATION = registry.register(Histogram(
+    "mtm_db_query_duration_seconds",
+    "Time per request spent executing queries and fetching rows.",
+    ("route",),
+))
+DB_ROWS = registry.register(Histogram(
+    "mtm_db_rows_fetched",
+    "Rows fetched from the database per request.",
+    ("route",), buckets=ROWS_BUCKETS,
+))
+SERIALIZATION_DURATION = registry.register(Histogram(
+    "mtm_serialization_duration_seconds",
+    "Time per request spent rendering payloads, by serialization stage.",
+    ("route", "stage"),
+))
+REQUESTS_FAILED = registry.register(Counter(
+    "mtm_http_exceptions_total",
+    "Requests that raised instead of completing a response.",
+    ("route", "method"),
+))
+
+
+class RequestStats:
+    """Per-request totals filled in by the service-layer hooks."""
+
+    __slots__ = ("db_seconds", "rows", "stages")
+
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.stages = {}
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("mtm_request_stats", default=None)
+
+
+def add_db(seconds: float, rows: int = 0):
+    stats = _current.get()
+    if stats is not None:
+        stats.db_seconds += seconds
+        stats.rows += rows
+
+def add_stage(stage: str, seconds: float):
+    stats = _current.get()
+    if stats is not None:
+        stats.stages[stage] = stats.stages.get(stage, 0.0) + seconds
+
+
+def _count_rows(result) -> int:
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+def timed_query(rows=_count_rows):
+    """Decorator: count a query function's time and ``rows(result)`` as DB work."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            result = fn(*args, **kwargs)
+            add_db(perf_counter() - start, rows(result))
+            return result
+        return wrapper
+    return decorator
+
+def timed_stage(stage: str):
+    """Decorator: count a function's time as serialization ``stage``."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                add_stage(stage, perf_counter() - start)
+        return wrapper
+    return decorator
+
+def timed_fetch(rows):
+    """Pass rows through, counting the time spent pulling them as DB work.
+
+    For streamed (``yield_per``) queries this covers the execute and every
+    batch fetch, but not whatever the consumer does between rows.
+    """
+    iterator = iter(rows)
+    elapsed = 0.0
+    count = 0
+    try:
+        while True:
+            start = perf_counter()
+            try:
+                row = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += perf_counter() - start
+            count += 1
+            yield row
+    finally:
+        add_db(elapsed, count)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, so streamed bodies are timed to their last chunk."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        status = 500
+        sent = 0
+        start = perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        method = scope["method"]
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            REQUESTS_FAILED.inc((route_of(scope), method))
+            raise
+        finally:
+            _current.reset(token)
+            elapsed = perf_counter() - start
+            route = route_of(scope)
+            REQUEST_DURATION.observe(elapsed, (route, method, str(status)))
+            RESPONSE_SIZE.observe(sent, (route, method))
+            DB_DURATION.observe(stats.db_seconds, (route,))
+            DB_ROWS.observe(stats.rows, (route,))
+            for stage, seconds in stats.stages.items():
+                SERIALIZATION_DURATION.observe(seconds, (route, stage))
+
+
+def route_of(scope) -> str:
+    # The route template, not the raw path, keeps label cardinality bounded
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
@@ -0,0 +1,101 @@
+"""Bring an existing warehouse schema up to date with the ORM models.
+
+newDataset predates some of the columns the API now maps (e.g. MODIFIED_AT),
+and ``create_all`` never alters an existing table. ``ensure_schema`` creates
+missing tables, adds missing nullable columns and, except on Snowflake, which
+has no secondary indexes, creates missing indexes.
+
+It is a deploy step, run once with ``python main.py --update-schema`` before
+the new API version starts. Running it from every worker at boot would have
+scaled-out workers racing each other on DDL and backfills against the
+production table. DB_SCHEMA_AUTO_UPDATE=true still runs it at startup, which
+is handy for a single local process.
+
+When it adds the date shadow columns it also runs ``backfill_date_shadows``,
+which fills them for the rows already in the table.
+"""
+import logging
+import os
+
+from sqlalchemy import String, bindparam, inspect, or_, select, text, update
+
+from models.mtm_orm_model import DATE_SHADOWS, Base, MTMRecordORM, to_ymd
+
+logger = logging.getLogger(__name__)
+
+AUTO_UPDATE = os.getenv("DB_SCHEMA_AUTO_UPDATE", "false").lower() in ("1", "true", "yes")
+# Rows read and updated per backfill transaction
+BACKFILL_BATCH_SIZE = int(os.getenv("DB_BACKFILL_BATCH_SIZE", "5000"))
+
+
+def _column_type(column) -> str:
+    # Every tracked column is a plain string, as in the rest of newDataset
+    return "VARCHAR" if isinstance(column.type, String) else column.type.compile()
+
+
+def ensure_schema(engine):
+    """Create missing tables, columns and indexes. Returns the DDL it ran."""
+    applied = []
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn)
+        translate = conn.get_execution_options().get("schema_translate_map") or {}
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            schema = translate.get(table.schema, table.schema)
+            existing = {
+                column["name"].upper()
+                for column in inspector.get_columns(table.name.lower(), schema=schema)
+            }
+            # Unquoted names, as in the ORM's table options
+            fullname = f"{schema}.{table.name}" if schema else table.name
+            for column in table.columns:
+                if column.name.upper() not in existing:
+                    ddl = f"ALTER TABLE {fullname} ADD COLUMN {column.name} {_column_type(column)}"
+                    conn.execute(text(ddl))
+                    applied.append(ddl)
+            if conn.dialect.name != "snowflake":
+                for index in table.indexes:
+                    index.create(conn, checkfirst=True)
+    for ddl in applied:
+        logger.info("Schema updated: %s", ddl)
+    if any(ddl.endswith(f" {shadow} VARCHAR") for ddl in applied for shadow in DATE_SHADOWS.values()):
+        backfill_date_shadows(engine)
+    return applied
+
+
+def backfill_date_shadows(engine, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """Fill the date shadows of rows written without them. Returns rows updated.
+
+    Walks the rows with a date but no shadow in TRANSACTION_ID order, one
+    transaction per batch, so an interrupted run resumes where it stopped.
+    Dates that do not parse keep a NULL shadow and are re-read by later runs.
+    """
+    table = MTMRecordORM.__table__
+    tid = table.c.TRANSACTION_ID
+    raw = [table.c[name] for name in DATE_SHADOWS]
+    missing = or_(*(
+        table.c[shadow].is_(None) & table.c[name].isnot(None) & (table.c[name] != "")
+        for name, shadow in DATE_SHADOWS.items()
+    ))
+    statement = (
+        update(table)
+        .where(tid == bindparam("_tid"))
+        .values({shadow: bindparam(shadow) for shadow in DATE_SHADOWS.values()})
+    )
+    updated, after = 0, None
+    while True:
+        query = select(tid, *raw).where(missing)
+        if after is not None:
+            query = query.where(tid > after)
+        with engine.begin() as conn:
+            rows = conn.execute(query.order_by(tid).limit(batch_size)).all()
+            if not rows:
+                break
+            conn.execute(statement, [
+                {"_tid": row[0], **{shadow: to_ymd(value) for shadow, value in zip(DATE_SHADOWS.values(), row[1:])}}
+                for row in rows
+            ])
+        updated += len(rows)
+        after = rows[-1][0]
+    logger.info("Backfilled date shadows for %d rows", updated)
+    return updated
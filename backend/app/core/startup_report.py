@@ -0,0 +1,67 @@
+"""Import-time and startup-time report for the API process.
+
+    python main.py --startup-report [--top 15]
+
+Both measurements run in a fresh interpreter so the numbers match a cold
+worker start: imports with ``-X importtime``, then the app's lifespan
+(engine creation and pool warm-up).
+"""
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_imports(module: str = "main"):
+    """[(cumulative_us, self_us, name)] from ``python -X importtime -c 'import module'``."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=APP_DIR, capture_output=True, text=True, check=True,
+    )
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings.append((int(cumulative_us), int(self_us), name.rstrip()))
+    return timings
+
+
+STARTUP_PROBE = """
+import asyncio, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def start_app():
+    async with main.app.router.lifespan_context(main.app):
+        return time.perf_counter()
+
+started = asyncio.run(start_app())
+print(imported - start, started - imported)
+"""
+
+
+def measure_startup():
+    """Seconds a fresh worker spends importing ``main`` and running lifespan startup."""
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_PROBE],
+        cwd=APP_DIR, capture_output=True, text=True, check=True,
+    )
+    import_s, startup_s = result.stdout.split()[-2:]
+    return float(import_s), float(startup_s)
+
+
+def print_report(top: int = 15):
+    timings = measure_imports()
+    total = next((cumulative for cumulative, _, name in timings if name.strip() == "main"), 0)
+    print(f"Import of main: {total / 1000:.1f} ms (fresh interpreter)")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative, self_us, name in sorted(timings, reverse=True)[:top]:
+        print(f"{cumulative / 1000:>14.1f} {self_us / 1000:>9.1f}  {name}")
+
+    import_s, startup_s = measure_startup()
+    print(f"\nimport main:      {import_s * 1000:.1f} ms")
+    print(f"lifespan startup: {startup_s * 1000:.1f} ms")
+    print(f"ready to serve:   {(import_s + startup_s) * 1000:.1f} ms")
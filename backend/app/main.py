@@ -1,8 +1,88 @@
+import argparse
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from api import mtm_routes
 from api import messaging_routes
+from api import metrics_routes
+from core import database, metrics, schema
+from services import export_artifacts, parallel_export, snapshot
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+
+async def keep_snapshot_fresh():
+    # First pass loads the snapshot; reads use the DB until it is ready.
+    # In between, compact the write overlay here so no request pays for it
+    while True:
+        try:
+            await database.run_in_session(snapshot.snapshot.refresh)
+        except Exception:
+            logger.exception("MTM snapshot refresh failed")
+        next_refresh = time.monotonic() + snapshot.REFRESH_SECONDS
+        while time.monotonic() < next_refresh:
+            await asyncio.sleep(min(snapshot.COMPACT_CHECK_SECONDS, max(next_refresh - time.monotonic(), 0)))
+            if snapshot.snapshot.needs_compaction:
+                try:
+                    await database.run_db(snapshot.snapshot.compact)
+                except Exception:
+                    logger.exception("MTM snapshot compaction failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start = time.perf_counter()
+    if schema.AUTO_UPDATE:
+        try:
+            await database.run_db(schema.ensure_schema, database.get_engine())
+        except Exception:
+            logger.exception("Schema update failed; newer columns such as MODIFIED_AT may be missing")
+    warmed = await database.run_db(database.warm_up_pool)
+    refresher = asyncio.create_task(keep_snapshot_fresh()) if snapshot.SNAPSHOT_ENABLED else None
+    # In-memory SQLite is one shared connection, so there exports always stream
+    # live rather than being built by a task interleaving with requests
+    materializer = (asyncio.create_task(export_artifacts.artifact_store.keep_fresh())
+                    if export_artifacts.ARTIFACTS_ENABLED and parallel_export.worker_url() is not None
+                    else None)
+    logger.info("Startup finished in %.1f ms (%d pooled connections warmed)",
+                (time.perf_counter() - start) * 1000, warmed)
+    yield
+    for task in (refresher, materializer):
+        if task is not None:
+            task.cancel()
+    parallel_export.shutdown()
+    database.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(mtm_routes.router)
 app.include_router(messaging_routes.router)
+app.include_router(metrics_routes.router)
+if metrics.ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MTM API utilities")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="print import-time and startup-time timings")
+    parser.add_argument("--top", type=int, default=15, help="modules to list in the report")
+    parser.add_argument("--update-schema", action="store_true",
+                        help="create missing tables, columns and indexes (run once per deploy)")
+    parser.add_argument("--backfill-dates", action="store_true",
+                        help="fill the CCYYMMDD date shadows of rows loaded without them")
+    args = parser.parse_args()
+    if args.startup_report:
+        from core.startup_report import print_report
+        print_report(args.top)
+    elif args.update_schema:
+        logging.basicConfig(level=logging.INFO)
+        schema.ensure_schema(database.get_engine())
+    elif args.backfill_dates:
+        logging.basicConfig(level=logging.INFO)
+        schema.ensure_schema(database.get_engine())
+        schema.backfill_date_shadows(database.get_engine())
+    else:
+        parser.print_help()
@@ -1,5 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import date
+from typing import List, Literal
 
 class MTMRecord(BaseModel):
     RECORD_TYPE: str
@@ -28,4 +29,8 @@ class MTMRecord(BaseModel):
 
     model_config = {
         "from_attributes": True  # This enables from_orm()
-    }
\ No newline at end of file
+    }
+
+class BatchLookupRequest(BaseModel):
+    patient_ids: List[str] = Field(..., min_length=1, max_length=10000)
+    format: Literal["json", "xml", "messaging"] = "json"
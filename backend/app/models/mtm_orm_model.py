@@ -1,18 +1,60 @@
-from sqlalchemy import Column, String, Date
+from datetime import date, datetime
+
+from sqlalchemy import DDL, Column, Index, String, Date, event
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+# Free-form date columns -> their normalised CCYYMMDD shadow columns
+DATE_SHADOWS = {
+    name: f"{name}_YMD" for name in ("DATE", "DOB", "START_DATE", "END_DATE", "FOLLOW_UP_DATE")
+}
+# Date layouts seen in the source data, tried in order
+DATE_FORMATS = ("%Y-%m-%d", "%Y%m%d", "%m/%d/%Y")
+# Bookkeeping columns: stored on every row, never part of the API's records
+INTERNAL_COLUMNS = frozenset(("MODIFIED_AT", *DATE_SHADOWS.values()))
+
+
+def to_ymd(value):
+    """``value`` as CCYYMMDD, or None when it is empty or not a recognisable date."""
+    if isinstance(value, (date, datetime)):
+        return value.strftime("%Y%m%d")
+    if not isinstance(value, str):
+        return None
+    text = value.strip()
+    if len(text) > 10 and text[10] in " T":
+        text = text[:10]  # drop a time of day
+    for layout in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, layout).strftime("%Y%m%d")
+        except ValueError:
+            continue
+    return None
+
+
+def date_shadows(values: dict) -> dict:
+    """Shadow column values for a ``{column: value}`` row."""
+    return {shadow: to_ymd(values.get(name)) for name, shadow in DATE_SHADOWS.items()}
+
+
 class MTMRecordORM(Base):
     __tablename__ = 'newDataset'
-    __table_args__ = {'schema': 'MTM_ANALYTICS', 'quote': False}
+    __table_args__ = (
+        # GET /mtm/search: each filter column leads, TRANSACTION_ID follows so an
+        # equality match is already in keyset order
+        *(Index(f"ix_newDataset_{name}_TID", name, "TRANSACTION_ID")
+          for name in ("PAYER_ID", "PLAN_NAME", "INTERVENTION_TYPE", "MTM_SERVICE_CODE", "OUTCOME")),
+        Index("ix_newDataset_START_DATE_YMD", "START_DATE_YMD"),
+        Index("ix_newDataset_END_DATE_YMD", "END_DATE_YMD"),
+        {'schema': 'MTM_ANALYTICS', 'quote': False},
+    )
 
     RECORD_TYPE = Column(String)
     TRANSACTION_ID = Column(String, primary_key=True, unique=True, index=True)
     DATE = Column(String)
     PHARMACY_NCPDP_ID = Column(String)
     PHARMACIST_NPI = Column(String)
-    PATIENT_ID = Column(String)
+    PATIENT_ID = Column(String, index=True)
     FIRST_NAME = Column(String)
     LAST_NAME = Column(String)
     DOB = Column(String)
@@ -30,3 +72,34 @@ class MTMRecordORM(Base):
     PRESCRIBER_RESPONSE = Column(String)
     FOLLOW_UP_DATE = Column(String)
     NOTES = Column(String)
+    # UTC timestamp of the last write through the API (see services.change_tracking);
+    # NULL for rows loaded before change tracking existed
+    MODIFIED_AT = Column(String, index=True)
+    # DATE_SHADOWS: the date columns parsed once at write time (NULL if
+    # unparseable), so exports copy them and range filters can use an index
+    DATE_YMD = Column(String)
+    DOB_YMD = Column(String)
+    START_DATE_YMD = Column(String)
+    END_DATE_YMD = Column(String)
+    FOLLOW_UP_DATE_YMD = Column(String)
+
+
+class MTMTombstoneORM(Base):
+    """One row per record deleted through the API, for delta exports."""
+    __tablename__ = 'newDatasetTombstones'
+    __table_args__ = {'schema': 'MTM_ANALYTICS', 'quote': False}
+
+    TRANSACTION_ID = Column(String, primary_key=True)
+    PATIENT_ID = Column(String)
+    DELETED_AT = Column(String, index=True)
+
+
+# Snowflake has no secondary indexes on standard tables; clustering on
+# PATIENT_ID gives per-patient lookups the same pruning there. Done as DDL
+# rather than a snowflake_clusterby table option, which would import the
+# Snowflake dialect whenever this module is imported.
+event.listen(
+    MTMRecordORM.__table__,
+    "after_create",
+    DDL("ALTER TABLE %(fullname)s CLUSTER BY (PATIENT_ID)").execute_if(dialect="snowflake"),
+)
@@ -0,0 +1,179 @@
+"""NDJSON bulk ingest for ``POST /mtm/bulk``.
+
+The request body is read as a stream and cut into chunks of
+MTM_BULK_CHUNK_SIZE lines. Each chunk is validated against ``MTMRecord``
+and inserted with one executemany in one transaction on the DB executor,
+so memory stays bounded by the chunk size whatever the body size. Lines
+longer than MTM_BULK_MAX_LINE_BYTES are discarded as they arrive rather
+than buffered. Rows that fail, whether from an over-long line, bad JSON, a
+validation error or an existing TRANSACTION_ID, go into the error report
+and the rest of the chunk is still inserted.
+"""
+import os
+from typing import AsyncIterator, Optional
+
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from core.database import run_in_session
+from core.metrics import timed_query
+from models.mtm_model import MTMRecord
+from models.mtm_orm_model import MTMRecordORM, date_shadows
+from services.change_tracking import clear_tombstones, now_stamp
+from services.coalesce import coalescer
+from services.render_cache import render_cache
+from services.snapshot import snapshot
+
+BULK_CHUNK_SIZE = int(os.getenv("MTM_BULK_CHUNK_SIZE", "1000"))
+MAX_CHUNK_SIZE = 10000
+# Longer lines are skipped and reported as that row's error
+MAX_LINE_BYTES = int(os.getenv("MTM_BULK_MAX_LINE_BYTES", str(1024 * 1024)))
+# Errors listed in the report; the failed count is always exact
+MAX_REPORTED_ERRORS = 1000
+
+
+async def iter_ndjson_lines(chunks: AsyncIterator[bytes]):
+    """``(line_number, line)`` for each non-blank line of a streamed body.
+
+    A line longer than MAX_LINE_BYTES comes out as ``(line_number, None)``.
+    """
+    buffer = bytearray()
+    line_number = 0
+    skipping = False  # inside an over-long line, dropping bytes until its newline
+    async for chunk in chunks:
+        searched = len(buffer)  # the partial line left over has no newline
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", searched)
+            if end < 0:
+                break
+            line_number += 1
+            if skipping:
+                skipping = False
+            elif end - start > MAX_LINE_BYTES:
+                yield line_number, None
+            else:
+                line = bytes(buffer[start:end])
+                if line.strip():
+                    yield line_number, line
+            start = searched = end + 1
+        del buffer[:start]
+        if not skipping and len(buffer) > MAX_LINE_BYTES:
+            yield line_number + 1, None
+            skipping = True
+        if skipping:
+            buffer.clear()
+    if not skipping and buffer.strip():
+        yield line_number + 1, bytes(buffer)
+
+
+def _error(line_number: int, errors, transaction_id: Optional[str] = None) -> dict:
+    return {"line": line_number, "transaction_id": transaction_id, "errors": errors}
+
+
+def validate_lines(lines) -> tuple:
+    """Split ``(line_number, line)`` pairs into ``(valid rows, errors)``."""
+    rows, errors = [], []
+    for line_number, line in lines:
+        if line is None:
+            errors.append(_error(line_number, [{"type": "line_too_long", "loc": [],
+                                                "msg": f"Line is longer than {MAX_LINE_BYTES} bytes"}]))
+            continue
+        try:
+            record = MTMRecord.model_validate_json(line)
+        except ValidationError as exc:
+            errors.append(_error(line_number, exc.errors(include_url=False, include_input=False)))
+            continue
+        rows.append((line_number, record.model_dump()))
+    return rows, errors
+
+
+@timed_query(rows=lambda result: result[0])
+def insert_chunk(db: Session, lines) -> tuple:
+    """Validate and insert one chunk in one transaction; returns ``(inserted, errors)``."""
+    rows, errors = validate_lines(lines)
+    # Snowflake does not enforce primary keys, so check for duplicates ourselves
+    tids = [row["TRANSACTION_ID"] for _, row in rows]
+    existing = {
+        tid for (tid,) in
+        db.query(MTMRecordORM.TRANSACTION_ID).filter(MTMRecordORM.TRANSACTION_ID.in_(tids))
+    } if tids else set()
+    accepted, seen = [], set()
+    for line_number, row in rows:
+        tid = row["TRANSACTION_ID"]
+        if tid in existing or tid in seen:
+            errors.append(_error(line_number, [{"type": "duplicate", "loc": ["TRANSACTION_ID"],
+                                                "msg": "TRANSACTION_ID already exists"}], tid))
+            continue
+        seen.add(tid)
+        accepted.append((line_number, row))
+
+    stamp = now_stamp()
+    for _, row in accepted:
+        row.update(date_shadows(row))
+        row["MODIFIED_AT"] = stamp
+    try:
+        if accepted:
+            db.execute(insert(MTMRecordORM), [row for _, row in accepted])
+            clear_tombstones(db, list(seen))
+        db.commit()
+    except IntegrityError:
+        # A concurrent writer took one of the keys: retry row by row
+        db.rollback()
+        accepted, errors = _insert_one_by_one(db, accepted, errors)
+
+    inserted = [row for _, row in accepted]
+    render_cache.invalidate_patients(row["PATIENT_ID"] for row in inserted)
+    coalescer.invalidate()
+    snapshot.apply_inserts(inserted)
+    errors.sort(key=lambda error: error["line"])
+    return len(inserted), errors
+
+
+def _insert_one_by_one(db: Session, accepted, errors) -> tuple:
+    inserted = []
+    for line_number, row in accepted:
+        try:
+            db.execute(insert(MTMRecordORM), [row])
+            clear_tombstones(db, [row["TRANSACTION_ID"]])
+            db.commit()
+        except IntegrityError as exc:
+            db.rollback()
+            errors.append(_error(line_number, [{"type": "integrity", "loc": ["TRANSACTION_ID"],
+                                                "msg": str(exc.orig)}], row["TRANSACTION_ID"]))
+            continue
+        inserted.append((line_number, row))
+    return inserted, errors
+
+
+async def ingest(chunks: AsyncIterator[bytes], chunk_size: int = BULK_CHUNK_SIZE) -> dict:
+    """Ingest a streamed NDJSON body chunk by chunk and report per-row errors."""
+    received = inserted = failed = 0
+    errors = []
+
+    async def flush(lines):
+        nonlocal inserted, failed
+        count, chunk_errors = await run_in_session(insert_chunk, lines)
+        inserted += count
+        failed += len(chunk_errors)
+        errors.extend(chunk_errors[:MAX_REPORTED_ERRORS - len(errors)])
+
+    pending = []
+    async for line_number, line in iter_ndjson_lines(chunks):
+        received += 1
+        pending.append((line_number, line))
+        if len(pending) >= chunk_size:
+            await flush(pending)
+            pending = []
+    if pending:
+        await flush(pending)
+    return {
+        "received": received,
+        "inserted": inserted,
+        "failed": failed,
+        "errors": errors,
+        "errors_truncated": failed > len(errors),
+    }
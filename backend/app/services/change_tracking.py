@@ -0,0 +1,100 @@
+"""Modification stamps, delete tombstones and ``?since=`` tokens for delta exports.
+
+Writes through ``mtm_service`` stamp MODIFIED_AT with a fixed-width UTC
+timestamp, so string order is time order, and deletes leave a row in
+newDatasetTombstones. A since-token is an opaque encoding of such a
+timestamp.
+
+The token handed out with an export is the export's start time minus
+DELTA_OVERLAP_SECONDS. That way a write committed while the export ran, or
+stamped by a worker with a slightly slow clock, still shows up in the next
+delta. A record can therefore appear in two consecutive deltas, so
+consumers should upsert by TRANSACTION_ID.
+"""
+import base64
+import binascii
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from models.mtm_orm_model import MTMRecordORM, MTMTombstoneORM
+
+STAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+TOKEN_PREFIX = "v1:"
+
+DELTA_OVERLAP_SECONDS = float(os.getenv("MTM_DELTA_OVERLAP", "300"))
+# Tombstones older than this are pruned; older tokens need a full export
+TOMBSTONE_RETENTION_DAYS = float(os.getenv("MTM_TOMBSTONE_RETENTION_DAYS", "30"))
+
+
+class ExpiredToken(ValueError):
+    """The token predates the tombstone retention window."""
+
+
+def now_stamp(now: Optional[datetime] = None) -> str:
+    return (now or datetime.now(timezone.utc)).strftime(STAMP_FORMAT)
+
+def make_token(stamp: str) -> str:
+    return base64.urlsafe_b64encode((TOKEN_PREFIX + stamp).encode("ascii")).decode("ascii").rstrip("=")
+
+def next_token() -> str:
+    """Token to hand out with an export that starts now."""
+    return make_token(now_stamp(datetime.now(timezone.utc) - timedelta(seconds=DELTA_OVERLAP_SECONDS)))
+
+def parse_token(token: str) -> str:
+    """The MODIFIED_AT stamp in ``token``; ValueError if malformed, ExpiredToken if too old."""
+    try:
+        decoded = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("ascii")
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError("Malformed since token") from None
+    if not decoded.startswith(TOKEN_PREFIX):
+        raise ValueError("Malformed since token")
+    stamp = decoded[len(TOKEN_PREFIX):]
+    try:
+        moment = datetime.strptime(stamp, STAMP_FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise ValueError("Malformed since token") from None
+    if moment < datetime.now(timezone.utc) - timedelta(days=TOMBSTONE_RETENTION_DAYS):
+        raise ExpiredToken("Since token is older than the tombstone retention window")
+    return stamp
+
+
+def record_tombstone(db: Session, record):
+    """Stage a tombstone for ``record`` in the caller's transaction."""
+    db.merge(MTMTombstoneORM(
+        TRANSACTION_ID=record.TRANSACTION_ID, PATIENT_ID=record.PATIENT_ID, DELETED_AT=now_stamp()))
+
+def clear_tombstone(db: Session, transaction_id: str):
+    """Stage removal of a tombstone for a key that is being re-created."""
+    db.query(MTMTombstoneORM).filter(
+        MTMTombstoneORM.TRANSACTION_ID == transaction_id).delete(synchronize_session=False)
+
+def clear_tombstones(db: Session, transaction_ids):
+    """Stage removal of tombstones for a batch of keys being re-created."""
+    db.query(MTMTombstoneORM).filter(
+        MTMTombstoneORM.TRANSACTION_ID.in_(transaction_ids)).delete(synchronize_session=False)
+
+def prune_tombstones(db: Session):
+    cutoff = now_stamp(datetime.now(timezone.utc) - timedelta(days=TOMBSTONE_RETENTION_DAYS))
+    db.query(MTMTombstoneORM).filter(
+        MTMTombstoneORM.DELETED_AT < cutoff).delete(synchronize_session=False)
+
+
+def changed_rows_query(db: Session, columns, since: str):
+    """Rows (``columns`` tuples) written after ``since``, by TRANSACTION_ID."""
+    return (
+        db.query(*columns)
+        .filter(MTMRecordORM.MODIFIED_AT > since)
+        .order_by(MTMRecordORM.TRANSACTION_ID)
+    )
+
+def deleted_since(db: Session, since: str) -> list:
+    """``(TRANSACTION_ID, PATIENT_ID)`` of records deleted after ``since``."""
+    return [
+        tuple(row) for row in
+        db.query(MTMTombstoneORM.TRANSACTION_ID, MTMTombstoneORM.PATIENT_ID)
+        .filter(MTMTombstoneORM.DELETED_AT > since)
+        .order_by(MTMTombstoneORM.TRANSACTION_ID)
+    ]
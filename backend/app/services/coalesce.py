@@ -0,0 +1,218 @@
+"""Single-flight coalescing of identical concurrent reads.
+
+When many clients ask for the same expensive thing at once (everyone
+downloading the full export at a deadline, the same batch lookup retried by
+several tabs), only the first request runs it; the others wait for that
+call and get the same result. Calls are keyed by route, parameters and the
+data generation, and forgotten as soon as they finish, so this shares work
+between overlapping requests without caching anything.
+
+The generation is bumped by every write through this process
+(``invalidate``), so a request that arrives after a write never joins a call
+that started before it. Writes by other workers are seen by the next call,
+as with the render cache and the snapshot.
+
+``run`` shares a result computed on the DB executor. ``stream`` shares a
+streamed export: a request that joins while it runs replays the chunks sent
+so far, for as long as the start of the export is still held, then follows
+the live ones at the pace of the slowest client.
+"""
+import asyncio
+import itertools
+import os
+import weakref
+from typing import Callable, Hashable
+
+from core.database import call_with_session, iterate_in_executor, run_db
+
+COALESCE_ENABLED = os.getenv("MTM_COALESCE", "true").lower() in ("1", "true", "yes")
+# Start of a shared export kept so requests arriving after it began can join
+REPLAY_BYTES = int(os.getenv("MTM_COALESCE_REPLAY_BYTES", str(16 * 1024 * 1024)))
+# Chunks a shared export may run ahead of its slowest client
+LAG_CHUNKS = int(os.getenv("MTM_COALESCE_LAG_CHUNKS", "4"))
+
+
+def _wake(event: asyncio.Event) -> asyncio.Event:
+    """Release everything waiting on ``event`` and return a fresh one."""
+    event.set()
+    return asyncio.Event()
+
+
+class SharedStream:
+    """One producer's chunks fanned out to every subscriber.
+
+    The start of the export is kept, up to ``replay_bytes``, so a request
+    that arrives after it began can still join and replay it. Once the
+    export outgrows that, chunks every subscriber has sent are dropped and
+    nobody else can join. The producer pauses while the slowest subscriber
+    is more than ``lag_chunks`` behind, so a slow client slows the export
+    down rather than making it buffer: at most ``replay_bytes`` plus
+    ``lag_chunks + 1`` chunks are held.
+    """
+
+    def __init__(self, iterator, replay_bytes: int, lag_chunks: int):
+        self.chunks = []
+        self.dropped = 0  # chunks before self.chunks, already sent to everyone
+        self.buffered = 0
+        self.replay_bytes = replay_bytes
+        self.lag_chunks = lag_chunks
+        self.done = False
+        self.error = None
+        self._positions = {}  # subscriber -> index of its next chunk
+        self._produced = asyncio.Event()
+        self._consumed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(iterator))
+
+    @property
+    def joinable(self) -> bool:
+        return not self.done and self.dropped == 0
+
+    def _lag(self) -> int:
+        """How many chunks the slowest subscriber has yet to send."""
+        if not self._positions:
+            return 0
+        return self.dropped + len(self.chunks) - min(self._positions.values())
+
+    async def _pump(self, iterator):
+        try:
+            async for chunk in iterate_in_executor(iterator):
+                self.chunks.append(chunk)
+                self.buffered += len(chunk)
+                self._produced = _wake(self._produced)
+                self._trim()
+                while self._lag() > self.lag_chunks:
+                    await self._consumed.wait()
+        except asyncio.CancelledError:
+            self.error = ConnectionAbortedError("shared export cancelled")
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.done = True
+            self._produced = _wake(self._produced)
+
+    def _trim(self):
+        if not self._positions or (self.dropped == 0 and self.buffered <= self.replay_bytes):
+            return
+        sent = min(self._positions.values()) - self.dropped
+        if sent > 0:
+            self.buffered -= sum(len(chunk) for chunk in self.chunks[:sent])
+            del self.chunks[:sent]
+            self.dropped += sent
+
+    def subscribe(self):
+        token = object()
+        # Registered now, not on first iteration, so the producer is not
+        # cancelled between a join and the joiner's first read
+        self._positions[token] = 0
+        chunks = self._follow(token)
+        # A response dropped before it starts iterating never runs _follow's
+        # finally; the producer must not keep waiting for it
+        weakref.finalize(chunks, self._leave, token).atexit = False
+        return chunks
+
+    async def _follow(self, token):
+        try:
+            while True:
+                position = self._positions[token]
+                if position < self.dropped + len(self.chunks):
+                    chunk = self.chunks[position - self.dropped]
+                    self._positions[token] = position + 1
+                    self._advanced()
+                    yield chunk
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    await self._produced.wait()
+        finally:
+            self._leave(token)
+
+    def _advanced(self):
+        self._trim()
+        self._consumed = _wake(self._consumed)
+
+    def _leave(self, token):
+        if self._positions.pop(token, None) is None:
+            return
+        if not self._positions and not self.done:
+            # Nobody left to send it to
+            self.task.cancel()
+        else:
+            self._advanced()
+
+
+class RequestCoalescer:
+    def __init__(self, enabled: bool = True, replay_bytes: int = REPLAY_BYTES,
+                 lag_chunks: int = LAG_CHUNKS):
+        self.enabled = enabled
+        self.replay_bytes = replay_bytes
+        self.lag_chunks = lag_chunks
+        self.started = 0
+        self.joined = 0
+        self._calls = {}
+        self._streams = {}
+        self._generations = itertools.count(1)
+        self.generation = 0
+
+    def invalidate(self):
+        """A write happened: later requests must not join calls already in flight."""
+        self.generation = next(self._generations)
+
+    def _forget(self, table: dict, key, value):
+        if table.get(key) is value:
+            del table[key]
+
+    async def run(self, key: Hashable, fn: Callable, *args, **kwargs):
+        """``await run_db(fn, *args, **kwargs)``, shared with identical concurrent calls."""
+        if not self.enabled:
+            return await run_db(fn, *args, **kwargs)
+        key = (self.generation, key)
+        call = self._calls.get(key)
+        if call is None:
+            self.started += 1
+            call = asyncio.ensure_future(run_db(fn, *args, **kwargs))
+            self._calls[key] = call
+            call.add_done_callback(lambda _: self._forget(self._calls, key, call))
+        else:
+            self.joined += 1
+        # shield: one client disconnecting must not cancel the call others wait on
+        return await asyncio.shield(call)
+
+    async def run_in_session(self, key: Hashable, fn: Callable, *args, **kwargs):
+        """``run_in_session(fn, ...)``, shared with identical concurrent calls."""
+        return await self.run(key, call_with_session, fn, *args, **kwargs)
+
+    def stream(self, key: Hashable, start: Callable):
+        """``(meta, chunks)`` for ``start() -> (meta, blocking iterator)``, shared.
+
+        ``meta`` (e.g. the delta token for the response headers) comes from
+        the call that is actually producing the chunks.
+        """
+        if not self.enabled:
+            meta, iterator = start()
+            return meta, iterate_in_executor(iterator)
+        key = (self.generation, key)
+        entry = self._streams.get(key)
+        if entry is None or not entry[1].joinable:
+            self.started += 1
+            meta, iterator = start()
+            shared = SharedStream(iterator, self.replay_bytes, self.lag_chunks)
+            entry = self._streams[key] = (meta, shared)
+            shared.task.add_done_callback(lambda _: self._forget(self._streams, key, entry))
+        else:
+            self.joined += 1
+        meta, shared = entry
+        return meta, shared.subscribe()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "started": self.started,
+            "joined": self.joined,
+            "in_flight": len(self._calls) + len(self._streams),
+            "generation": self.generation,
+        }
+
+
+coalescer = RequestCoalescer(enabled=COALESCE_ENABLED)
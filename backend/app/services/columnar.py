@@ -0,0 +1,177 @@
+"""Binary response formats: Arrow IPC stream, Parquet and msgpack.
+
+``negotiate`` picks among these and the JSON / NDJSON formats for a
+request's Accept header; ``accepts_encoding`` reads Accept-Encoding the same
+way.
+
+Arrow and Parquet are for table dumps. Rows come from the DB cursor (or the
+snapshot) ``COLUMNAR_BATCH_SIZE`` at a time. Each batch becomes one Arrow
+record batch or one Parquet row group and is sent as soon as it is encoded,
+so memory is bounded by the batch size rather than the table. msgpack is a
+compact drop-in for the JSON record lists.
+
+Every newDataset column is a string, so the Arrow schema is all
+``pa.string()``; NULLs stay nulls. pyarrow is imported on first use, which
+keeps it out of API startup.
+"""
+import os
+from itertools import islice
+from time import perf_counter
+from typing import Optional, Sequence
+
+import msgpack
+
+from core.metrics import add_stage
+
+MEDIA_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "msgpack": "application/msgpack",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+# Older or unofficial media types clients send for the same formats
+MEDIA_ALIASES = {
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "application/x-msgpack": "msgpack",
+    "application/vnd.msgpack": "msgpack",
+    "application/x-parquet": "parquet",
+}
+DUMP_FORMATS = ("arrow", "parquet")
+FILE_EXTENSIONS = {"arrow": "arrows", "parquet": "parquet"}
+
+# Rows per Arrow record batch / Parquet row group
+COLUMNAR_BATCH_SIZE = int(os.getenv("MTM_COLUMNAR_BATCH_SIZE", "16384"))
+
+
+def _weighted(header: str) -> list:
+    """``(value, quality)`` for each entry of an Accept-style header, best first."""
+    ranges = []
+    for position, part in enumerate(header.split(",")):
+        value, *params = [piece.strip() for piece in part.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, number = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        ranges.append((-quality, position, value.lower()))
+    return [(value, -negative) for negative, _, value in sorted(ranges)]
+
+
+def negotiate(accept: Optional[str], allowed: Sequence[str]) -> Optional[str]:
+    """Best of ``allowed`` for an Accept header; None if it accepts none of them."""
+    if not accept:
+        return allowed[0]
+    for media_type, quality in _weighted(accept):
+        if quality <= 0:
+            continue
+        if media_type in ("*/*", "application/*"):
+            return allowed[0]
+        for fmt in allowed:
+            if MEDIA_TYPES.get(fmt) == media_type or MEDIA_ALIASES.get(media_type) == fmt:
+                return fmt
+    return None
+
+
+def accepts_encoding(accept_encoding: Optional[str], coding: str = "gzip") -> bool:
+    """Whether an Accept-Encoding header allows ``coding``: named or ``*``, with q > 0."""
+    if not accept_encoding:
+        return False
+    qualities = {}
+    for value, quality in _weighted(accept_encoding):
+        qualities.setdefault(value, quality)
+    quality = qualities.get(coding, qualities.get("*", 0.0))
+    return quality > 0
+
+
+def _string_schema(names):
+    import pyarrow as pa
+    return pa.schema([(name, pa.string()) for name in names])
+
+
+def _record_batches(rows, schema, batch_size: int):
+    import pyarrow as pa
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            return
+        start = perf_counter()
+        columns = zip(*chunk)
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(column, type=pa.string()) for column in columns], schema=schema
+        )
+        add_stage("columnar_encode", perf_counter() - start)
+        yield batch
+
+
+class _Sink:
+    """File-like target that hands back whatever was written since the last drain."""
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_arrow_stream(rows, names, batch_size: int = COLUMNAR_BATCH_SIZE):
+    """``rows`` (tuples in ``names`` order) as an Arrow IPC stream, batch by batch."""
+    import pyarrow as pa
+    schema = _string_schema(names)
+    sink = _Sink()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for batch in _record_batches(rows, schema, batch_size):
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def iter_parquet(rows, names, batch_size: int = COLUMNAR_BATCH_SIZE):
+    """``rows`` as a Parquet file, one row group per batch; the footer comes last."""
+    import pyarrow.parquet as pq
+    schema = _string_schema(names)
+    sink = _Sink()
+    with pq.ParquetWriter(sink, schema, compression="snappy") as writer:
+        for batch in _record_batches(rows, schema, batch_size):
+            start = perf_counter()
+            writer.write_batch(batch)
+            add_stage("columnar_encode", perf_counter() - start)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def iter_dump(fmt: str, rows, names, batch_size: int = COLUMNAR_BATCH_SIZE):
+    writer = iter_arrow_stream if fmt == "arrow" else iter_parquet
+    return writer(rows, names, batch_size)
+
+
+def pack_records(records, names) -> bytes:
+    """msgpack array of ``{column: value}`` maps, the same records the JSON response holds."""
+    start = perf_counter()
+    packed = msgpack.packb([
+        record if isinstance(record, dict) else {name: getattr(record, name) for name in names}
+        for record in records
+    ])
+    add_stage("msgpack_encode", perf_counter() - start)
+    return packed
@@ -0,0 +1,271 @@
+"""Materialized full-table exports, written to disk once per data version.
+
+``ArtifactStore.get`` checks the data version, which is one cheap aggregate
+query over MODIFIED_AT and the tombstones. If the files on disk match, it
+returns them. Otherwise it starts a rebuild in the background and returns
+None, and the route streams the export live as before. A download never
+waits for a rebuild. The rebuild streams the export once from the DB, never
+the snapshot (which can lag behind writes by other processes that the
+version already counts), into a plain file and a gzip file side by side.
+
+Builds are single-flight across processes. Within a process concurrent
+callers share one build, and across workers sharing MTM_EXPORT_DIR a lock
+file lets one worker build while the others keep streaming until the new
+manifest appears. A lock older than MTM_EXPORT_LOCK_TIMEOUT is taken to be
+left over from a crashed build; the builder refreshes it while it works.
+
+Each build gets version-named files plus a small JSON manifest. Files a
+newer build has superseded are kept for MTM_EXPORT_RETAIN seconds, so any
+worker that read the previous manifest can still open them and downloads
+already in progress keep their bytes.
+
+In-memory SQLite is one connection shared by every session, so building
+beside live requests is unsafe there and exports are always streamed live.
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from typing import Callable, NamedTuple, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from core.database import SessionLocal, db_executor, run_in_session
+from models.mtm_orm_model import MTMRecordORM, MTMTombstoneORM
+from services import mtm_service, parallel_export
+from services.mtm_messaging import iter_all_records_messaging
+
+logger = logging.getLogger(__name__)
+
+ARTIFACTS_ENABLED = os.getenv("MTM_EXPORT_ARTIFACTS", "true").lower() in ("1", "true", "yes")
+EXPORT_DIR = os.getenv("MTM_EXPORT_DIR", os.path.join(tempfile.gettempdir(), "mtm-exports"))
+# How often the background materializer checks for changed data
+REFRESH_SECONDS = float(os.getenv("MTM_EXPORT_REFRESH", "60"))
+# A build lock untouched for this long belongs to a build that died
+LOCK_TIMEOUT_SECONDS = float(os.getenv("MTM_EXPORT_LOCK_TIMEOUT", "600"))
+# How long superseded files stay on disk for workers and downloads still using them
+RETAIN_SECONDS = float(os.getenv("MTM_EXPORT_RETAIN", "3600"))
+
+
+class ExportFormat(NamedTuple):
+    basename: str
+    extension: str
+    render: Callable
+
+
+FORMATS = {
+    "xml": ExportFormat("all_patients", "xml", mtm_service.iter_all_records_as_ncpdp_xml),
+    "messaging": ExportFormat("all_patients", "txt", iter_all_records_messaging),
+}
+
+
+class Artifact(NamedTuple):
+    version: str
+    path: str
+    gzip_path: str
+    built_at: float
+
+
+# Part of every version: bump when the rendered output changes for the same data
+RENDER_VERSION = 2
+
+
+def data_version(db: Session) -> str:
+    """Changes whenever a record is written, loaded or deleted."""
+    count, modified = db.query(func.count(MTMRecordORM.TRANSACTION_ID),
+                               func.max(MTMRecordORM.MODIFIED_AT)).one()
+    tombstones, deleted = db.query(func.count(MTMTombstoneORM.TRANSACTION_ID),
+                                   func.max(MTMTombstoneORM.DELETED_AT)).one()
+    return hashlib.sha256(repr((RENDER_VERSION, count, modified, tombstones, deleted)).encode()).hexdigest()[:16]
+
+
+class ArtifactStore:
+    def __init__(self, directory: str = EXPORT_DIR):
+        self.directory = directory
+        self._current = {}
+        self._building = {}
+
+    def _manifest_path(self, fmt: str) -> str:
+        spec = FORMATS[fmt]
+        return os.path.join(self.directory, f"{spec.basename}.{spec.extension}.json")
+
+    def _load_manifest(self, fmt: str) -> Optional[Artifact]:
+        try:
+            with open(self._manifest_path(fmt), encoding="utf-8") as f:
+                artifact = Artifact(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+        if os.path.exists(artifact.path) and os.path.exists(artifact.gzip_path):
+            return artifact
+        return None
+
+    def current(self, fmt: str, version: str) -> Optional[Artifact]:
+        for artifact in (self._current.get(fmt), self._load_manifest(fmt)):
+            if artifact is not None and artifact.version == version and os.path.exists(artifact.path):
+                self._current[fmt] = artifact
+                return artifact
+        return None
+
+    def _lock_path(self, fmt: str) -> str:
+        spec = FORMATS[fmt]
+        return os.path.join(self.directory, f"{spec.basename}.{spec.extension}.lock")
+
+    def _acquire(self, lock_path: str) -> bool:
+        """Take the cross-process build lock; False if another live build holds it."""
+        for _ in range(2):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) < LOCK_TIMEOUT_SECONDS:
+                        return False
+                    logger.warning("Removing abandoned export lock %s", lock_path)
+                    os.remove(lock_path)
+                except OSError:
+                    pass  # released or taken over meanwhile; try once more
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(str(os.getpid()))
+            return True
+        return False
+
+    def build(self, fmt: str, version: str) -> Optional[Artifact]:
+        """Render ``fmt`` into new plain + gzip files and publish them (blocking).
+
+        Returns None if another worker is already building it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        lock_path = self._lock_path(fmt)
+        if not self._acquire(lock_path):
+            return None
+        try:
+            # Another worker may have published this version while we waited
+            artifact = self.current(fmt, version)
+            return artifact if artifact is not None else self._build(fmt, lock_path)
+        finally:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+    def _build(self, fmt: str, lock_path: str) -> Artifact:
+        spec = FORMATS[fmt]
+        start = time.perf_counter()
+        touched = time.time()
+        with SessionLocal() as db:
+            # Tagged with the version read just before rendering, so the body is
+            # never older than its tag; a write landing meanwhile only changes
+            # the version and brings another build
+            version = data_version(db)
+            stem = os.path.join(self.directory, f"{spec.basename}.{version}.{uuid.uuid4().hex[:8]}")
+            path, gzip_path = f"{stem}.{spec.extension}", f"{stem}.{spec.extension}.gz"
+            try:
+                with open(path, "w", encoding="utf-8", newline="") as plain, \
+                        open(gzip_path, "wb") as raw, \
+                        gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6, mtime=0) as packed:
+                    # From the DB, not the snapshot: that can lag behind writes
+                    # by other workers or the loader, which data_version counts
+                    for chunk in spec.render(db, use_replica=False):
+                        plain.write(chunk)
+                        packed.write(chunk.encode("utf-8"))
+                        if time.time() - touched > LOCK_TIMEOUT_SECONDS / 4:
+                            # Still alive: keep other workers from taking the lock over
+                            os.utime(lock_path)
+                            touched = time.time()
+            except BaseException:
+                for leftover in (path, gzip_path):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+                raise
+
+        artifact = Artifact(version, path, gzip_path, time.time())
+        tmp_manifest = f"{self._manifest_path(fmt)}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_manifest, "w", encoding="utf-8") as f:
+            json.dump(artifact._asdict(), f)
+        os.replace(tmp_manifest, self._manifest_path(fmt))
+        self._current[fmt] = artifact
+        self._remove_stale(fmt, artifact)
+        logger.info("Materialized %s export %s in %.1fs (%d bytes, %d gzipped)",
+                    fmt, version, time.perf_counter() - start,
+                    os.path.getsize(path), os.path.getsize(gzip_path))
+        return artifact
+
+    def _remove_stale(self, fmt: str, current: Artifact):
+        """Delete generations superseded more than RETAIN_SECONDS ago."""
+        spec = FORMATS[fmt]
+        prefix = f"{spec.basename}."
+        generations = {}  # stem -> (built at, [paths])
+        for name in os.listdir(self.directory):
+            if not name.startswith(prefix):
+                continue
+            for suffix in (f".{spec.extension}", f".{spec.extension}.gz"):
+                if name.endswith(suffix):
+                    path = os.path.join(self.directory, name)
+                    try:
+                        built_at = os.path.getmtime(path)
+                    except OSError:
+                        break
+                    stem = name[:-len(suffix)]
+                    previous = generations.get(stem, (built_at, []))
+                    generations[stem] = (max(previous[0], built_at), previous[1] + [path])
+                    break
+        # A generation stops being served when the next one is built
+        ordered = sorted(generations.values(), key=lambda generation: generation[0])
+        now = time.time()
+        for (_, paths), (superseded_at, _) in zip(ordered, ordered[1:]):
+            if current.path in paths or now - superseded_at < RETAIN_SECONDS:
+                continue
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _start_build(self, fmt: str, version: str) -> asyncio.Future:
+        """The in-process build of ``fmt`` in flight, started if there is none."""
+        building = self._building.get(fmt)
+        if building is None:
+            loop = asyncio.get_running_loop()
+            building = loop.run_in_executor(db_executor, self.build, fmt, version)
+            self._building[fmt] = building
+            building.add_done_callback(lambda done: self._finish_build(fmt, done))
+        return building
+
+    def _finish_build(self, fmt: str, building: asyncio.Future):
+        self._building.pop(fmt, None)
+        if not building.cancelled() and building.exception() is not None:
+            logger.error("Materializing the %s export failed", fmt, exc_info=building.exception())
+
+    async def get(self, fmt: str) -> Optional[Artifact]:
+        """Up-to-date artifact for ``fmt``, or None (stream live) while one is built."""
+        if parallel_export.worker_url() is None:
+            return None
+        version = await run_in_session(data_version)
+        artifact = self.current(fmt, version)
+        if artifact is None:
+            self._start_build(fmt, version)
+        return artifact
+
+    async def keep_fresh(self):
+        """Background materializer: rebuild changed exports every REFRESH_SECONDS."""
+        while True:
+            for fmt in FORMATS:
+                try:
+                    version = await run_in_session(data_version)
+                except Exception:
+                    logger.exception("Checking the export data version failed")
+                    break
+                if self.current(fmt, version) is None:
+                    # wait rather than await: cancelling the loop must not cancel
+                    # a build mid-write, and _finish_build logs failures
+                    await asyncio.wait([self._start_build(fmt, version)])
+            await asyncio.sleep(REFRESH_SECONDS)
+
+
+artifact_store = ArtifactStore()
@@ -1,5 +1,15 @@
+from time import perf_counter
+from sqlalchemy.orm import Session
+from core.metrics import add_stage, timed_fetch, timed_query, timed_stage
 from models.mtm_messaging_model import PatientRecord
+from services.mtm_service import EXPORT_BATCH_SIZE, iter_table_rows
+from models.mtm_orm_model import MTMRecordORM
+from services.change_tracking import changed_rows_query, deleted_since
+from services import parallel_export
+from services.serializers import MESSAGING_KEYS, MESSAGING_PLAN
+from services.snapshot import read_replica
 
+@timed_stage("ncpdp_message")
 def convert_to_ncpdp_message(record: PatientRecord):
     lines = [
         f"AM20 {record.AM20}",
@@ -38,3 +48,114 @@ def convert_to_ncpdp_message(record: PatientRecord):
         lines.append(f"PAT {record.NOTES or record.RECOMMENDATIONS}")
 
     return "\n".join(lines)
+
+@timed_query()
+def get_messaging_values(db: Session, patient_id: str, keys):
+    """Values of the NCPDP ``keys`` for one patient, or None if there is no record.
+
+    Only the columns those keys are built from are selected. ``keys`` must
+    already be validated against ``MESSAGING_KEYS``.
+    """
+    specs = [MESSAGING_KEYS[key] for key in keys]
+    columns = list(dict.fromkeys(column for spec in specs for column in spec.columns))
+    replica = read_replica()
+    if replica is not None:
+        values = replica.get_record_by_id(patient_id)
+    else:
+        row = (
+            db.query(MTMRecordORM.PATIENT_ID, *(getattr(MTMRecordORM, name) for name in columns))
+            .filter(MTMRecordORM.PATIENT_ID == patient_id)
+            .first()
+        )
+        values = None if row is None else dict(zip(columns, row[1:]))
+    if values is None:
+        return None
+    return {
+        key: spec.value(*(values[column] for column in spec.columns))
+        for key, spec in zip(keys, specs)
+    }
+
+def iter_patient_records(db: Session, batch_size: int = EXPORT_BATCH_SIZE):
+    """Every record as a ``PatientRecord``-shaped dict, in TRANSACTION_ID order.
+
+    Built straight from the source columns with ``MESSAGING_KEYS``, so the
+    streaming path skips both the model construction and its validation.
+    """
+    specs = list(MESSAGING_KEYS.items())
+    columns = list(dict.fromkeys(column for _, spec in specs for column in spec.columns))
+    builders = [
+        (key, spec.value, [columns.index(column) for column in spec.columns])
+        for key, spec in specs
+    ]
+    for row in iter_table_rows(db, columns, batch_size):
+        yield {key: value(*(row[i] for i in positions)) for key, value, positions in builders}
+
+def iter_all_records_messaging(db: Session, batch_size: int = EXPORT_BATCH_SIZE, use_replica: bool = True):
+    """Yield the all-records NCPDP messaging export one batch at a time.
+
+    Messages are separated by a blank line, same as joining them with "\n\n",
+    and come in TRANSACTION_ID order. ``use_replica=False`` reads the DB even
+    when the snapshot is loaded.
+    """
+    replica = read_replica() if use_replica else None
+    if replica is not None:
+        rows = replica.iter_rows(MESSAGING_PLAN.columns, batch_size=batch_size)
+    else:
+        shards = parallel_export.render_shards(db, "messaging")
+        if shards is not None:
+            return iter_sharded_messages(shards)
+        rows = (
+            db.query(*MESSAGING_PLAN.select())
+            .order_by(MTMRecordORM.TRANSACTION_ID)
+            .yield_per(batch_size)
+        )
+    return iter_messages(timed_fetch(rows), batch_size)
+
+def iter_sharded_messages(shards):
+    """Stitch ``parallel_export`` shards into the same text as the serial path."""
+    first = True
+    for rows, text in shards:
+        if not rows:
+            continue
+        yield text if first else "\n\n" + text
+        first = False
+
+def iter_changed_messaging(db: Session, since: str, batch_size: int = EXPORT_BATCH_SIZE):
+    """Delta export: messages for records written after ``since``, then deletions.
+
+    Always read from the DB, where MODIFIED_AT is indexed.
+    """
+    deleted = deleted_since(db, since)
+    rows = changed_rows_query(db, MESSAGING_PLAN.select(), since).yield_per(batch_size)
+    return iter_messages(timed_fetch(rows), batch_size, deleted)
+
+def iter_messages(rows, batch_size: int = EXPORT_BATCH_SIZE, deleted=()):
+    """Render ``MESSAGING_PLAN``-ordered rows, separated by a blank line.
+
+    Delta exports pass ``deleted`` (TRANSACTION_ID, PATIENT_ID) pairs, each
+    sent after the records as an AM20/AM25 header plus a ``DEL Y`` segment.
+    """
+    render = MESSAGING_PLAN.render
+    out = []
+    count = 0
+    rendering = 0.0
+    try:
+        for row in rows:
+            if count:
+                out.append("\n\n")
+            start = perf_counter()
+            out.append(render(row))
+            rendering += perf_counter() - start
+            count += 1
+            if count % batch_size == 0:
+                yield "".join(out)
+                out = []
+    finally:
+        add_stage("messaging_render", rendering)
+    for transaction_id, patient_id in deleted:
+        if count:
+            out.append("\n\n")
+        out.append(f"AM20 {transaction_id}\nAM25 {patient_id}A\nDEL Y")
+        count += 1
+    if out:
+        yield "".join(out)
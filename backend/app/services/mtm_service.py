@@ -1,32 +1,146 @@
+from time import perf_counter
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from models.mtm_orm_model import MTMRecordORM as MTMRecord  # ORM model
+from models.mtm_orm_model import DATE_SHADOWS, INTERNAL_COLUMNS, date_shadows
 from dicttoxml import dicttoxml
 from xml.dom.minidom import parseString
+from core.metrics import add_stage, timed_fetch, timed_query, timed_stage
+from services.change_tracking import (
+    changed_rows_query, clear_tombstone, deleted_since, now_stamp, prune_tombstones, record_tombstone,
+)
+from services import parallel_export
+from services.coalesce import coalescer
+from services.render_cache import render_cache
+from services.serializers import XML_PLAN, xml_escape
+from services.snapshot import read_replica, snapshot
 
+# Rows fetched per round-trip when streaming full-table exports
+EXPORT_BATCH_SIZE = 1000
+# Patient IDs bound into a single IN (...) clause by batch lookups
+LOOKUP_CHUNK_SIZE = 1000
+
+@timed_query()
 def get_record_by_id(db: Session, patient_id: str):
+    replica = read_replica()
+    if replica is not None:
+        return replica.get_record_by_id(patient_id)
     return db.query(MTMRecord).filter(MTMRecord.PATIENT_ID == patient_id).first()
 
+@timed_query()
 def get_all_records(db: Session):
+    replica = read_replica()
+    if replica is not None:
+        return replica.get_all_records()
     return db.query(MTMRecord).all()
 
+@timed_query()
+def get_records_by_ids(db: Session, patient_ids, chunk_size: int = LOOKUP_CHUNK_SIZE):
+    """All records for the given patients, one IN query per ``chunk_size`` IDs.
+
+    Records come back grouped in the order the IDs were requested.
+    """
+    replica = read_replica()
+    if replica is not None:
+        return replica.get_records_by_ids(patient_ids)
+    unique_ids = list(dict.fromkeys(patient_ids))
+    by_patient = {patient_id: [] for patient_id in unique_ids}
+    for start in range(0, len(unique_ids), chunk_size):
+        chunk = unique_ids[start:start + chunk_size]
+        rows = (
+            db.query(MTMRecord)
+            .filter(MTMRecord.PATIENT_ID.in_(chunk))
+            .order_by(MTMRecord.TRANSACTION_ID)
+            .all()
+        )
+        for row in rows:
+            by_patient[row.PATIENT_ID].append(row)
+    return [row for patient_id in unique_ids for row in by_patient[patient_id]]
+
+# What the API returns for a record: the table less its bookkeeping columns
+PUBLIC_COLUMNS = tuple(
+    column.name for column in MTMRecord.__table__.columns if column.name not in INTERNAL_COLUMNS)
+
+def get_column_names():
+    return list(PUBLIC_COLUMNS)
+
+def public_record(record) -> dict:
+    """An ORM or snapshot record as a ``{column: value}`` dict of PUBLIC_COLUMNS."""
+    return {name: getattr(record, name) for name in PUBLIC_COLUMNS}
+
+@timed_query()
+def count_records(db: Session) -> int:
+    replica = read_replica()
+    if replica is not None:
+        return replica.count()
+    return db.query(func.count(MTMRecord.TRANSACTION_ID)).scalar()
+
+@timed_query(rows=lambda page: len(page[0]))
+def get_records_page(db: Session, limit: int, after: str = None, fields=None):
+    """Keyset page of records ordered by TRANSACTION_ID.
+
+    Returns ``(rows, next_after)``; ``next_after`` is None on the last page.
+    With ``fields`` only those columns are loaded and rows come back as dicts.
+    """
+    replica = read_replica()
+    if replica is not None:
+        return replica.get_records_page(limit, after, fields)
+    if fields:
+        columns = [getattr(MTMRecord, name) for name in fields]
+        if "TRANSACTION_ID" not in fields:
+            columns.append(MTMRecord.TRANSACTION_ID)
+        query = db.query(*columns)
+    else:
+        query = db.query(MTMRecord)
+    if after is not None:
+        query = query.filter(MTMRecord.TRANSACTION_ID > after)
+    # One extra row tells us whether another page exists
+    rows = query.order_by(MTMRecord.TRANSACTION_ID).limit(limit + 1).all()
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = rows[-1].TRANSACTION_ID
+    if fields:
+        rows = [{name: getattr(row, name) for name in fields} for row in rows]
+    return rows, next_after
+
+@timed_query()
 def create_record(db: Session, record):
     # 'record' here should be a Pydantic model or similar with .dict()
-    orm_record = MTMRecord(**record.dict())
+    values = record.dict()
+    orm_record = MTMRecord(**values, **date_shadows(values), MODIFIED_AT=now_stamp())
+    clear_tombstone(db, orm_record.TRANSACTION_ID)
     db.add(orm_record)
     db.commit()
     db.refresh(orm_record)
+    render_cache.invalidate_patient(orm_record.PATIENT_ID)
+    coalescer.invalidate()
+    snapshot.apply_insert(orm_record)
     return orm_record
 
+@timed_query()
 def delete_record_by_id(db: Session, patient_id: str):
     record = db.query(MTMRecord).filter(MTMRecord.PATIENT_ID == patient_id).first()
     if record:
         db.delete(record)
+        record_tombstone(db, record)
+        prune_tombstones(db)
         db.commit()
+        render_cache.invalidate_patient(patient_id)
+        coalescer.invalidate()
+        snapshot.apply_delete(record.TRANSACTION_ID)
     return record
 
 
+@timed_stage("record_to_dict")
 def convert_record_to_dict(record):
-    def date_to_str(d):
+    def date_to_str(name):
+        # The CCYYMMDD shadow written with the row; rows not yet backfilled
+        # fall back to reformatting the raw value
+        shadow = getattr(record, DATE_SHADOWS[name], None)
+        if shadow is not None:
+            return shadow
+        d = getattr(record, name)
         if d is None:
             return ""
         if isinstance(d, str):
@@ -35,7 +149,7 @@ def convert_record_to_dict(record):
 
     return {
         "MessageID": record.TRANSACTION_ID,
-        "MessageDate": date_to_str(record.DATE),
+        "MessageDate": date_to_str("DATE"),
         "Pharmacy": {
             "NCPDPID": record.PHARMACY_NCPDP_ID,
             "PharmacistNPI": record.PHARMACIST_NPI
@@ -46,7 +160,7 @@ def convert_record_to_dict(record):
                 "First": record.FIRST_NAME
             },
             "Gender": record.GENDER,
-            "DOB": date_to_str(record.DOB)
+            "DOB": date_to_str("DOB")
         },
         "Payer": {
             "PayerID": record.PAYER_ID,
@@ -55,8 +169,8 @@ def convert_record_to_dict(record):
         "MTMService": {
             "ServiceCode": record.MTM_SERVICE_CODE,
             "InterventionType": record.INTERVENTION_TYPE,
-            "StartDate": date_to_str(record.START_DATE),
-            "EndDate": date_to_str(record.END_DATE),
+            "StartDate": date_to_str("START_DATE"),
+            "EndDate": date_to_str("END_DATE"),
             "Outcome": record.OUTCOME,
             "Recommendation": record.RECOMMENDATIONS
         },
@@ -65,29 +179,114 @@ def convert_record_to_dict(record):
             "NPI": record.PRESCRIBER_NPI,
             "Response": record.PRESCRIBER_RESPONSE
         },
-        "FollowUpDate": date_to_str(record.FOLLOW_UP_DATE),
+        "FollowUpDate": date_to_str("FOLLOW_UP_DATE"),
         "Notes": record.NOTES
     }
 
-def get_all_records_as_ncpdp_xml(db: Session) -> str:
-    records = db.query(MTMRecord).all()
+def iter_records_as_ncpdp_xml(rows, batch_size: int = EXPORT_BATCH_SIZE, deleted=()):
+    """Yield a multi-record XML document chunk by chunk.
+
+    ``rows`` are tuples in ``XML_PLAN.columns`` order. Produces exactly what
+    dicttoxml + minidom pretty-printing would, without holding the records or
+    a DOM in memory: one chunk per ``batch_size`` records.
+
+    Delta exports pass ``deleted`` (TRANSACTION_ID, PATIENT_ID) pairs, listed
+    in a ``<Deleted>`` element after the records.
+    """
+    render = XML_PLAN.render
+    yield '<?xml version="1.0" ?>\n<MTMRequest>\n'
+
+    out = []
+    count = 0
+    rendering = 0.0
+    try:
+        for row in rows:
+            if count == 0:
+                out.append("  <Record>\n")
+            start = perf_counter()
+            out.append(render(row))
+            rendering += perf_counter() - start
+            count += 1
+            if count % batch_size == 0:
+                yield "".join(out)
+                out = []
+    finally:
+        add_stage("xml_render", rendering)
+
+    if count:
+        out.append("  </Record>\n")
+    else:
+        out.append("  <Record/>\n")
+    if deleted:
+        out.append("  <Deleted>\n")
+        for transaction_id, patient_id in deleted:
+            out.append(
+                f"    <item>\n      <MessageID>{xml_escape(transaction_id)}</MessageID>\n"
+                f"      <PatientID>{xml_escape(patient_id)}</PatientID>\n    </item>\n"
+            )
+        out.append("  </Deleted>\n")
+    out.append("</MTMRequest>\n")
+    yield "".join(out)
 
-    all_records_dicts = [convert_record_to_dict(rec) for rec in records]
+def iter_sharded_xml(shards):
+    """Stitch ``parallel_export`` shards into the same document as the serial path."""
+    yield '<?xml version="1.0" ?>\n<MTMRequest>\n'
+    count = 0
+    for rows, text in shards:
+        if rows and not count:
+            text = "  <Record>\n" + text
+        count += rows
+        if text:
+            yield text
+    yield ("  </Record>\n" if count else "  <Record/>\n") + "</MTMRequest>\n"
 
-    root_dict = {"Record": all_records_dicts}
+def iter_all_records_as_ncpdp_xml(db: Session, batch_size: int = EXPORT_BATCH_SIZE, use_replica: bool = True):
+    """The full XML export, in TRANSACTION_ID order.
 
-    # Generate raw XML bytes from dicttoxml
-    xml_bytes = dicttoxml(root_dict, custom_root="MTMRequest", attr_type=False)
+    ``use_replica=False`` reads the DB even when the snapshot is loaded.
+    """
+    replica = read_replica() if use_replica else None
+    if replica is not None:
+        rows = replica.iter_rows(XML_PLAN.columns, batch_size=batch_size)
+    else:
+        shards = parallel_export.render_shards(db, "xml")
+        if shards is not None:
+            return iter_sharded_xml(shards)
+        rows = (
+            db.query(*XML_PLAN.select())
+            .order_by(MTMRecord.TRANSACTION_ID)
+            .yield_per(batch_size)
+        )
+    return iter_records_as_ncpdp_xml(timed_fetch(rows), batch_size)
 
-    # Parse and pretty print with minidom
-    dom = parseString(xml_bytes)
-    pretty_xml_as_str = dom.toprettyxml(indent="  ")  # 2 spaces indent
+def iter_table_rows(db: Session, names, batch_size: int = EXPORT_BATCH_SIZE):
+    """Every record as a tuple of ``names`` columns, in TRANSACTION_ID order, streamed."""
+    replica = read_replica()
+    if replica is not None:
+        rows = replica.iter_rows(tuple(names), batch_size=batch_size)
+    else:
+        rows = (
+            db.query(*(getattr(MTMRecord, name) for name in names))
+            .order_by(MTMRecord.TRANSACTION_ID)
+            .yield_per(batch_size)
+        )
+    return timed_fetch(rows)
 
-    return pretty_xml_as_str
+def iter_changed_records_as_ncpdp_xml(db: Session, since: str, batch_size: int = EXPORT_BATCH_SIZE):
+    """Delta export: records written after ``since``, then those deleted after it.
+
+    Always read from the DB, where MODIFIED_AT is indexed.
+    """
+    deleted = deleted_since(db, since)
+    rows = changed_rows_query(db, XML_PLAN.select(), since).yield_per(batch_size)
+    return iter_records_as_ncpdp_xml(timed_fetch(rows), batch_size, deleted)
+
+def get_all_records_as_ncpdp_xml(db: Session) -> str:
+    return "".join(iter_all_records_as_ncpdp_xml(db))
 
 
 def get_record_as_ncpdp_xml_by_id(db: Session, patient_id: str) -> str:
-    record = db.query(MTMRecord).filter(MTMRecord.PATIENT_ID == patient_id).first()
+    record = get_record_by_id(db, patient_id)
 
     if not record:
         return "<Error>Record not found</Error>"
@@ -95,7 +294,11 @@ def get_record_as_ncpdp_xml_by_id(db: Session, patient_id: str) -> str:
     record_dict = convert_record_to_dict(record)
     wrapped = {"Record": record_dict}
 
+    start = perf_counter()
     xml_bytes = dicttoxml(wrapped, custom_root="MTMRequest", attr_type=False)
+    parsed = perf_counter()
     pretty_xml = parseString(xml_bytes).toprettyxml(indent="  ")
+    add_stage("dicttoxml", parsed - start)
+    add_stage("minidom", perf_counter() - parsed)
 
     return pretty_xml
\ No newline at end of file
@@ -0,0 +1,43 @@
+"""Newline-delimited JSON (``application/x-ndjson``) for the list endpoints.
+
+One record per line, encoded with orjson and sent a chunk of
+``batch_size`` lines at a time while the cursor is still fetching. A client
+can process the first records before the last ones are read, and the
+server never holds the whole list.
+"""
+from time import perf_counter
+
+import orjson
+
+from core.metrics import add_stage
+from services.columnar import MEDIA_TYPES
+from services.mtm_service import EXPORT_BATCH_SIZE
+
+MEDIA_TYPE = MEDIA_TYPES["ndjson"]
+
+
+def iter_ndjson(records, batch_size: int = EXPORT_BATCH_SIZE):
+    """Yield ``records`` (dicts) as NDJSON, ``batch_size`` lines per chunk."""
+    dumps = orjson.dumps
+    lines = []
+    encoding = 0.0
+    try:
+        for record in records:
+            start = perf_counter()
+            lines.append(dumps(record))
+            encoding += perf_counter() - start
+            if len(lines) == batch_size:
+                lines.append(b"")
+                yield b"\n".join(lines)
+                lines = []
+    finally:
+        add_stage("ndjson_encode", encoding)
+    if lines:
+        lines.append(b"")
+        yield b"\n".join(lines)
+
+
+def iter_row_dicts(rows, names):
+    """``{name: value}`` for each row tuple in ``names`` order."""
+    for row in rows:
+        yield dict(zip(names, row))
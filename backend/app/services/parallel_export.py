@@ -0,0 +1,139 @@
+"""Multi-process rendering for the full-table exports.
+
+Rendering is CPU-bound and the GIL holds it to one core, however the rows
+are streamed. With MTM_EXPORT_WORKERS > 1 the table is split into
+TRANSACTION_ID ranges of about MTM_EXPORT_SHARD_ROWS rows. Each range is
+queried and rendered with the compiled plans in a worker process, and the
+parent yields the shards back in key order. The serial exports are also in
+TRANSACTION_ID order, so the output is byte-identical either way.
+
+Workers open their own engine from the shared engine's URL. An in-memory
+SQLite database cannot be reached from another process, so those exports
+stay serial.
+"""
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from time import perf_counter
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from core import database
+from core.metrics import add_db, add_stage
+from models.mtm_orm_model import MTMRecordORM
+from services.serializers import MESSAGING_PLAN, XML_PLAN
+
+EXPORT_WORKERS = int(os.getenv("MTM_EXPORT_WORKERS", "0"))
+SHARD_ROWS = int(os.getenv("MTM_EXPORT_SHARD_ROWS", "20000"))
+
+PLANS = {"xml": XML_PLAN, "messaging": MESSAGING_PLAN}
+# What goes between two rendered records in each format
+SEPARATORS = {"xml": "", "messaging": "\n\n"}
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+
+# --- Worker side -------------------------------------------------------------
+
+_worker_engine = None
+
+def _init_worker(url: str):
+    global _worker_engine
+    _worker_engine = database.build_engine(url, pool_size=1, max_overflow=0)
+
+def _render_shard(fmt: str, low: str, high: Optional[str]):
+    """Render TRANSACTION_IDs in [low, high); returns (rows, text, db secs, render secs)."""
+    plan = PLANS[fmt]
+    start = perf_counter()
+    with Session(_worker_engine) as db:
+        query = db.query(*plan.select()).filter(MTMRecordORM.TRANSACTION_ID >= low)
+        if high is not None:
+            query = query.filter(MTMRecordORM.TRANSACTION_ID < high)
+        rows = query.order_by(MTMRecordORM.TRANSACTION_ID).all()
+    fetched = perf_counter()
+    text = SEPARATORS[fmt].join(map(plan.render, rows))
+    return len(rows), text, fetched - start, perf_counter() - fetched
+
+
+# --- Parent side -------------------------------------------------------------
+
+def worker_url() -> Optional[str]:
+    """URL worker processes can open, or None if the database is process-local."""
+    url = database.get_engine().url
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return None
+    return url.render_as_string(hide_password=False)
+
+def get_pool(workers: int, url: str) -> ProcessPoolExecutor:
+    global _pool, _pool_key
+    with _pool_lock:
+        if _pool is None or _pool_key != (workers, url):
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            # spawn, not fork: the API process runs threads (event loop, DB executor)
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(url,),
+            )
+            _pool_key = (workers, url)
+        return _pool
+
+def shutdown():
+    global _pool, _pool_key
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = _pool_key = None
+
+def shard_ranges(db: Session, shard_rows: int) -> list:
+    """[low, high) TRANSACTION_ID ranges of ``shard_rows`` rows each, in key order."""
+    tid = MTMRecordORM.TRANSACTION_ID
+    numbered = db.query(
+        tid.label("tid"), func.row_number().over(order_by=tid).label("n")
+    ).subquery()
+    starts = [
+        low for (low,) in
+        db.query(numbered.c.tid).filter(numbered.c.n % shard_rows == 1).order_by(numbered.c.tid)
+    ]
+    return list(zip(starts, starts[1:] + [None]))
+
+def render_shards(db: Session, fmt: str, workers: Optional[int] = None,
+                  shard_rows: Optional[int] = None):
+    """``(rows, text)`` per shard in key order, or None if the export should stay serial."""
+    workers = EXPORT_WORKERS if workers is None else workers
+    shard_rows = shard_rows or SHARD_ROWS
+    if workers <= 1:
+        return None
+    url = worker_url()
+    if url is None:
+        return None
+    ranges = shard_ranges(db, shard_rows)
+    if len(ranges) < 2:
+        return None
+    return _iter_shards(get_pool(workers, url), fmt, ranges, workers)
+
+def _iter_shards(pool: ProcessPoolExecutor, fmt: str, ranges: list, workers: int):
+    # At most two shards per worker in flight, so memory stays bounded
+    remaining = iter(ranges)
+    pending = deque(pool.submit(_render_shard, fmt, low, high)
+                    for low, high in islice(remaining, workers * 2))
+    try:
+        while pending:
+            rows, text, db_seconds, render_seconds = pending.popleft().result()
+            for low, high in islice(remaining, 1):
+                pending.append(pool.submit(_render_shard, fmt, low, high))
+            add_db(db_seconds, rows)
+            add_stage(f"{fmt}_render", render_seconds)
+            yield rows, text
+    finally:
+        for future in pending:
+            future.cancel()
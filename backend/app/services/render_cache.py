@@ -0,0 +1,146 @@
+"""In-process LRU + TTL cache of rendered per-patient payloads.
+
+Entries are keyed by (patient_id, format) and carry a strong ETag computed
+from the exact bytes served. Writes through ``mtm_service`` invalidate the
+affected patient; the TTL bounds staleness for writes made by other workers.
+
+Rendering runs outside the lock, so an invalidation can land between a
+render's DB read and its ``put``. Each render holds a ticket that
+invalidation marks stale, and a stale render is served once but not stored.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional
+
+
+class CachedPayload(NamedTuple):
+    content: str
+    etag: str
+    expires_at: float
+
+
+def make_etag(content: str) -> str:
+    return '"' + hashlib.sha256(content.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check (weak comparison, as RFC 9110 requires for it)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+class _Render:
+    """An in-flight render; ``stale`` once its patient is invalidated."""
+    __slots__ = ("stale",)
+
+    def __init__(self):
+        self.stale = False
+
+
+class RenderCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._rendering = {}  # patient_id -> in-flight _Render tickets
+        self._lock = threading.Lock()
+
+    def get(self, patient_id: str, fmt: str) -> Optional[CachedPayload]:
+        key = (patient_id, fmt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, patient_id: str, fmt: str, content: str,
+            render: Optional[_Render] = None) -> CachedPayload:
+        """Store ``content``, unless ``render`` was invalidated while it ran."""
+        entry = CachedPayload(content, make_etag(content), time.monotonic() + self.ttl)
+        if self.maxsize <= 0:
+            return entry
+        with self._lock:
+            if render is not None and render.stale:
+                return entry
+            self._entries[(patient_id, fmt)] = entry
+            self._entries.move_to_end((patient_id, fmt))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def get_or_render(self, patient_id: str, fmt: str,
+                      render: Callable[[], Optional[str]]) -> Optional[CachedPayload]:
+        """Cached payload, rendering on a miss. ``render`` returning None is not cached."""
+        entry = self.get(patient_id, fmt)
+        if entry is not None:
+            return entry
+        ticket = _Render()
+        with self._lock:
+            self._rendering.setdefault(patient_id, []).append(ticket)
+        try:
+            content = render()
+        finally:
+            with self._lock:
+                tickets = self._rendering[patient_id]
+                tickets.remove(ticket)
+                if not tickets:
+                    del self._rendering[patient_id]
+        if content is None:
+            return None
+        return self.put(patient_id, fmt, content, ticket)
+
+    def _mark_stale(self, patient_ids):
+        # Caller holds the lock
+        for patient_id in patient_ids:
+            for ticket in self._rendering.get(patient_id, ()):
+                ticket.stale = True
+
+    def invalidate_patient(self, patient_id: str):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == patient_id]:
+                del self._entries[key]
+            self._mark_stale((patient_id,))
+
+    def invalidate_patients(self, patient_ids):
+        patient_ids = set(patient_ids)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] in patient_ids]:
+                del self._entries[key]
+            self._mark_stale(patient_ids & self._rendering.keys())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._mark_stale(self._rendering)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+            }
+
+
+render_cache = RenderCache(
+    maxsize=int(os.getenv("RENDER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("RENDER_CACHE_TTL", "300")),
+)
@@ -0,0 +1,281 @@
+"""Compiled serializers for the bulk export paths.
+
+The single-record endpoints build a validated ``PatientRecord`` (or a nested
+dict for dicttoxml) per request. That is far too much work per row when
+rendering a whole table, so the column-to-segment mapping is compiled once
+into a flat render plan and applied directly to row tuples. Output is text
+identical to ``convert_to_ncpdp_message(PatientRecord.from_orm_model(r))``
+and to the dicttoxml + minidom pretty-printed XML.
+"""
+from datetime import date
+from operator import attrgetter
+from typing import Callable, NamedTuple
+
+from models.mtm_orm_model import DATE_SHADOWS, MTMRecordORM
+
+
+def _message_date(value):
+    # PatientRecord.format_date
+    if isinstance(value, date):
+        return value.strftime("%m%d%Y")
+    return value
+
+def _xml_date(value):
+    # convert_record_to_dict.date_to_str, for rows with no date shadow
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value.replace("-", "")
+    return value.strftime("%Y%m%d")
+
+def xml_escape(value) -> str:
+    # Mirrors dicttoxml escaping followed by the minidom parse/pretty-print
+    # round trip (line endings normalised, apostrophes left as-is)
+    text = str(value).replace("\r\n", "\n").replace("\r", "\n")
+    return (text.replace("&", "&amp;").replace("<", "&lt;")
+                .replace('"', "&quot;").replace(">", "&gt;"))
+
+
+class RenderPlan:
+    """Columns to select plus a renderer taking a tuple in that column order."""
+
+    def __init__(self, columns, render):
+        self.columns = tuple(columns)
+        self.render = render
+        self.values_of = attrgetter(*self.columns)
+
+    def select(self):
+        return [getattr(MTMRecordORM, name) for name in self.columns]
+
+    def render_record(self, record) -> str:
+        return self.render(self.values_of(record))
+
+
+# --- NCPDP messaging ---------------------------------------------------------
+
+# Segments present in every message: (template, source columns)
+MESSAGE_SEGMENTS = [
+    ("AM20 {}", ("TRANSACTION_ID",)),
+    ("AM25 {}A", ("PATIENT_ID",)),
+    ("AM29 CA {}{}", ("FIRST_NAME", "LAST_NAME")),
+    ("CBS {}", ("LAST_NAME",)),
+    ("PRV {}", ("PHARMACIST_NPI",)),
+    ("RX {}", ("MTM_SERVICE_CODE",)),
+    ("DT {}", ("DATE",)),
+    ("DOS {}", ("START_DATE",)),
+    ("PR {}", ("PRESCRIBER_NPI",)),
+]
+MESSAGE_DATE_COLUMNS = ("DATE", "START_DATE")
+
+# Optional segments convert_to_ncpdp_message can emit from PatientRecord
+# fields; only compiled in when the source column exists on the table.
+MESSAGE_OPTIONAL_SEGMENTS = [("NDC", "NDC"), ("DAW", "DAW"), ("DUR", "DUR")]
+
+def _is_empty(value):
+    return value is None or value == "" or value == 0
+
+
+def compile_messaging_plan() -> RenderPlan:
+    columns = []
+    def index_of(name):
+        if name not in columns:
+            columns.append(name)
+        return columns.index(name)
+
+    parts = []
+    arg_indexes = []
+    for template, sources in MESSAGE_SEGMENTS:
+        parts.append(template)
+        arg_indexes.extend(index_of(name) for name in sources)
+    template = "\n".join(parts) + "\nPAT {}"
+
+    date_positions = tuple(
+        pos for pos, i in enumerate(arg_indexes) if columns[i] in MESSAGE_DATE_COLUMNS
+    )
+    recommendations, notes = index_of("RECOMMENDATIONS"), index_of("NOTES")
+    table_columns = set(MTMRecordORM.__table__.columns.keys())
+    optional = tuple(
+        (f"\n{segment} ", index_of(column))
+        for segment, column in MESSAGE_OPTIONAL_SEGMENTS
+        if column in table_columns
+    )
+    fmt = template.format
+    arg_indexes = tuple(arg_indexes)
+
+    def render(row) -> str:
+        args = [row[i] for i in arg_indexes]
+        for pos in date_positions:
+            args[pos] = _message_date(args[pos])
+        pat = row[recommendations] or row[notes]
+        args.append(None if _is_empty(pat) else pat)
+        text = fmt(*args)
+        for prefix, i in optional:
+            if not _is_empty(row[i]):
+                text += prefix + str(row[i])
+        return text
+
+    return RenderPlan(columns, render)
+
+
+# --- NCPDP XML ---------------------------------------------------------------
+
+# Same shape as mtm_service.convert_record_to_dict: (tag, column or children)
+XML_LAYOUT = [
+    ("MessageID", "TRANSACTION_ID"),
+    ("MessageDate", "DATE"),
+    ("Pharmacy", [
+        ("NCPDPID", "PHARMACY_NCPDP_ID"),
+        ("PharmacistNPI", "PHARMACIST_NPI"),
+    ]),
+    ("Patient", [
+        ("Name", [
+            ("Last", "LAST_NAME"),
+            ("First", "FIRST_NAME"),
+        ]),
+        ("Gender", "GENDER"),
+        ("DOB", "DOB"),
+    ]),
+    ("Payer", [
+        ("PayerID", "PAYER_ID"),
+        ("PlanName", "PLAN_NAME"),
+    ]),
+    ("MTMService", [
+        ("ServiceCode", "MTM_SERVICE_CODE"),
+        ("InterventionType", "INTERVENTION_TYPE"),
+        ("StartDate", "START_DATE"),
+        ("EndDate", "END_DATE"),
+        ("Outcome", "OUTCOME"),
+        ("Recommendation", "RECOMMENDATIONS"),
+    ]),
+    ("Prescriber", [
+        ("Contacted", "PRESCRIBER_CONTACTED"),
+        ("NPI", "PRESCRIBER_NPI"),
+        ("Response", "PRESCRIBER_RESPONSE"),
+    ]),
+    ("FollowUpDate", "FOLLOW_UP_DATE"),
+    ("Notes", "NOTES"),
+]
+XML_DATE_COLUMNS = ("DATE", "DOB", "START_DATE", "END_DATE", "FOLLOW_UP_DATE")
+
+
+def compile_xml_plan(tag: str = "item", indent: str = "    ") -> RenderPlan:
+    """Plan rendering one record as a pretty-printed ``<tag>`` element."""
+    columns = []
+    # Flat list of steps: a str is static markup, a tuple is a leaf
+    # (column index, shadow column index or None, open, close, empty).
+    steps = []
+
+    def emit(layout, depth):
+        for child_tag, source in layout:
+            pad = indent + "  " * depth
+            if isinstance(source, list):
+                steps.append(f"{pad}<{child_tag}>\n")
+                emit(source, depth + 1)
+                steps.append(f"{pad}</{child_tag}>\n")
+            else:
+                columns.append(source)
+                index, shadow = len(columns) - 1, None
+                if source in XML_DATE_COLUMNS:
+                    columns.append(DATE_SHADOWS[source])
+                    shadow = len(columns) - 1
+                steps.append((
+                    index,
+                    shadow,
+                    f"{pad}<{child_tag}>",
+                    f"</{child_tag}>\n",
+                    f"{pad}<{child_tag}/>\n",
+                ))
+
+    steps.append(f"{indent}<{tag}>\n")
+    emit(XML_LAYOUT, 1)
+    steps.append(f"{indent}</{tag}>\n")
+
+    # Merge adjacent static markup so rendering touches as few steps as possible
+    merged = []
+    for step in steps:
+        if isinstance(step, str) and merged and isinstance(merged[-1], str):
+            merged[-1] += step
+        else:
+            merged.append(step)
+    steps = tuple(merged)
+
+    def render(row) -> str:
+        out = []
+        append = out.append
+        for step in steps:
+            if step.__class__ is str:
+                append(step)
+                continue
+            i, shadow, open_tag, close_tag, empty_tag = step
+            value = row[i]
+            if shadow is not None:
+                # Normalised at write time; parse only rows not yet backfilled
+                value = row[shadow]
+                if value is None:
+                    value = _xml_date(row[i])
+            if value is None or value == "":
+                append(empty_tag)
+            else:
+                append(open_tag + xml_escape(value) + close_tag)
+        return "".join(out)
+
+    return RenderPlan(columns, render)
+
+
+# --- Single NCPDP keys -------------------------------------------------------
+
+class MessagingKey(NamedTuple):
+    """Columns one ``PatientRecord`` field is built from, and how."""
+    columns: tuple
+    value: Callable
+
+def _optional(*values):
+    # PatientRecord.from_orm_model drops empty optional fields
+    value = values[0] if values else None
+    return None if _is_empty(value) else value
+
+def _as_is(value):
+    return value
+
+def _note(recommendations, notes):
+    return _optional(recommendations or notes)
+
+# NCPDP key -> (source columns, value). Mirrors PatientRecord.from_orm_model.
+MESSAGING_KEY_SOURCES = {
+    "AM20": (("TRANSACTION_ID",), None),
+    "AM25": (("PATIENT_ID",), None),
+    "AM29": (("FIRST_NAME", "LAST_NAME"), "{}{}".format),
+    "CBS": (("LAST_NAME",), None),
+    "PRV": (("PHARMACIST_NPI",), None),
+    "RX": (("MTM_SERVICE_CODE",), None),
+    "DT": (("DATE",), _message_date),
+    "DOS": (("START_DATE",), _message_date),
+    "PR": (("PRESCRIBER_NPI",), None),
+    "F01": (("FILL_NUMBER",), _optional),
+    "QTY": (("QUANTITY_DISPENSED",), _optional),
+    "DAY": (("DAYS_SUPPLY",), _optional),
+    "NDC": (("NDC",), _optional),
+    "DAW": (("DAW",), _optional),
+    "DUR": (("DUR",), _optional),
+    "DX": (("DIAGNOSIS_CODE",), _optional),
+    "UC": (("USUAL_CUSTOMARY_CHARGE",), _optional),
+    "PAY": (("PAYMENT_AMOUNT",), _optional),
+    "PAT": (("RECOMMENDATIONS", "NOTES"), _note),
+}
+
+
+def compile_messaging_keys() -> dict:
+    """Keys whose source columns are missing from the table select nothing and are always empty."""
+    table_columns = set(MTMRecordORM.__table__.columns.keys())
+    keys = {}
+    for key, (columns, value) in MESSAGING_KEY_SOURCES.items():
+        if not set(columns) <= table_columns:
+            keys[key] = MessagingKey((), _optional)
+        else:
+            keys[key] = MessagingKey(columns, value or _as_is)
+    return keys
+
+
+MESSAGING_PLAN = compile_messaging_plan()
+XML_PLAN = compile_xml_plan()
+MESSAGING_KEYS = compile_messaging_keys()
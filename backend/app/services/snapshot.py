@@ -0,0 +1,550 @@
+"""Optional in-memory read replica of newDataset.
+
+With MTM_SNAPSHOT=true the table is loaded once into compact NumPy column
+arrays, kept sorted by TRANSACTION_ID, with a PATIENT_ID -> row offset hash
+index. Low-cardinality columns are dictionary-encoded (small integer codes
+plus the distinct values). The rest are stored as UTF-8 bytes back to back
+in one buffer with per-row offsets and a null mask, so memory follows the
+data rather than the longest value.
+
+The loaded arrays are never mutated. ``create_record`` and
+``delete_record_by_id`` patch a small overlay instead: rows added since the
+load and base offsets deleted since the load. Each write swaps in a new
+immutable ``SnapshotState``, so readers never lock. Once the overlay passes
+MTM_SNAPSHOT_COMPACT_AFTER rows the refresher folds it into a fresh set of
+arrays, so no write pays for the rebuild.
+
+``refresh`` runs every MTM_SNAPSHOT_REFRESH seconds to pick up writes made by
+other workers. It pulls rows whose MODIFIED_AT is at or after the previous
+load or refresh, less DELTA_OVERLAP_SECONDS, as delta tokens do. The API, the bulk ingest and the loader's sync all
+stamp the rows they insert or replace, so this catches in-place updates as
+well as inserts. It also pulls rows past the highest TRANSACTION_ID, for
+loads that predate the stamp, then compares row counts. Only on a mismatch
+does it diff the full key set, which catches deletes and out-of-order
+inserts. Every MTM_SNAPSHOT_FULL_RELOAD seconds the refresh reloads the
+whole table instead, for UPDATEs made without touching MODIFIED_AT.
+
+numpy is imported when the first column is built, so it stays out of API
+startup when the snapshot is disabled.
+"""
+import heapq
+import logging
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from operator import itemgetter
+from typing import NamedTuple, Optional
+
+from sqlalchemy.orm import Session
+
+from models.mtm_orm_model import MTMRecordORM
+from services.change_tracking import DELTA_OVERLAP_SECONDS, now_stamp
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_ENABLED = os.getenv("MTM_SNAPSHOT", "false").lower() in ("1", "true", "yes")
+REFRESH_SECONDS = float(os.getenv("MTM_SNAPSHOT_REFRESH", "300"))
+COMPACT_AFTER = int(os.getenv("MTM_SNAPSHOT_COMPACT_AFTER", "10000"))
+# How often the refresher checks, between refreshes, whether to compact
+COMPACT_CHECK_SECONDS = 5.0
+# Full reload interval (0 disables), for updates that leave MODIFIED_AT alone
+FULL_RELOAD_SECONDS = float(os.getenv("MTM_SNAPSHOT_FULL_RELOAD", "21600"))
+
+# Rows pulled per round-trip, and encoded per chunk, while loading
+LOAD_CHUNK_SIZE = 50000
+# Dictionary-encode a column when distinct values are at most this share of rows
+DICTIONARY_MAX_RATIO = 0.1
+# TRANSACTION_IDs bound into one IN (...) clause when reconciling
+RECONCILE_CHUNK_SIZE = 1000
+
+COLUMNS = tuple(MTMRecordORM.__table__.columns.keys())
+TID = COLUMNS.index("TRANSACTION_ID")
+PID = COLUMNS.index("PATIENT_ID")
+
+
+class SnapshotRecord(dict):
+    """A row as a plain dict that also answers ``record.COLUMN`` like the ORM model."""
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+def to_record(row) -> SnapshotRecord:
+    return SnapshotRecord(zip(COLUMNS, row))
+
+
+# --- Columns -----------------------------------------------------------------
+
+class DictionaryColumn:
+    encoding = "dictionary"
+
+    def __init__(self):
+        self.values = []
+        self._code_of = {}
+        self._chunks = []
+        self.codes = None
+
+    def extend(self, values):
+        import numpy as np
+        code_of = self._code_of
+        codes = []
+        for value in values:
+            code = code_of.get(value)
+            if code is None:
+                code = code_of[value] = len(self.values)
+                self.values.append(value)
+            codes.append(code)
+        self._chunks.append(np.array(codes, dtype=np.uint32))
+
+    def finish(self):
+        import numpy as np
+        codes = np.concatenate(self._chunks) if self._chunks else np.zeros(0, np.uint32)
+        self.codes = codes.astype(np.min_scalar_type(max(len(self.values) - 1, 0)))
+        self._chunks = self._code_of = None
+        return self
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def take(self, start, stop) -> list:
+        values = self.values
+        return [values[code] for code in self.codes[start:stop].tolist()]
+
+    def nbytes(self) -> int:
+        return self.codes.nbytes + sys.getsizeof(self.values) + sum(
+            sys.getsizeof(value) for value in self.values)
+
+
+class BytesColumn:
+    """UTF-8 values back to back in one buffer, found by per-row offsets.
+
+    Each row costs its own length plus one offset, so a few long values
+    (e.g. NOTES) do not widen every other row.
+    """
+
+    encoding = "utf8"
+
+    def __init__(self):
+        self._chunks = []
+        self._length_chunks = []
+        self._null_chunks = []
+        self.data = None
+        self.offsets = None
+        self.nulls = None
+
+    def extend(self, values):
+        import numpy as np
+        encoded = [b"" if value is None else value.encode("utf-8") for value in values]
+        self._chunks.append(b"".join(encoded))
+        self._length_chunks.append(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+        self._null_chunks.append(np.array([value is None for value in values], dtype=np.bool_))
+
+    def finish(self):
+        import numpy as np
+        self.data = b"".join(self._chunks)
+        lengths = np.concatenate(self._length_chunks) if self._length_chunks else np.zeros(0, np.int64)
+        offsets = np.zeros(len(lengths) + 1, np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        self.offsets = offsets.astype(np.min_scalar_type(len(self.data)))
+        nulls = np.concatenate(self._null_chunks) if self._null_chunks else np.zeros(0, np.bool_)
+        # Most columns have no NULLs at all; skip the mask for those
+        self.nulls = nulls if nulls.any() else None
+        self._chunks = self._length_chunks = self._null_chunks = None
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self.nulls is not None and self.nulls[i]:
+            return None
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def take(self, start, stop) -> list:
+        data = self.data
+        offsets = self.offsets[start:stop + 1].tolist()
+        values = [data[begin:end].decode("utf-8") for begin, end in zip(offsets, offsets[1:])]
+        if self.nulls is not None:
+            import numpy as np
+            for i in np.flatnonzero(self.nulls[start:stop]).tolist():
+                values[i] = None
+        return values
+
+    def nbytes(self) -> int:
+        return len(self.data) + self.offsets.nbytes + (self.nulls.nbytes if self.nulls is not None else 0)
+
+
+# --- Immutable generation ----------------------------------------------------
+
+class Generation:
+    """Column arrays for rows sorted by TRANSACTION_ID, plus the PATIENT_ID index."""
+
+    def __init__(self, columns: dict, size: int):
+        self.columns = columns
+        self.size = size
+        self.tids = columns["TRANSACTION_ID"]
+        # PATIENT_ID -> offset, or a list of offsets for patients with several records
+        index = {}
+        for offset, patient_id in enumerate(columns["PATIENT_ID"].take(0, size)):
+            existing = index.get(patient_id)
+            if existing is None:
+                index[patient_id] = offset
+            elif isinstance(existing, list):
+                existing.append(offset)
+            else:
+                index[patient_id] = [existing, offset]
+        self.index = index
+
+    @classmethod
+    def build(cls, rows):
+        """Encode ``rows`` (full tuples, sorted by TRANSACTION_ID) chunk by chunk."""
+        builders = None
+        size = 0
+        while True:
+            chunk = list(islice(rows, LOAD_CHUNK_SIZE))
+            if not chunk:
+                break
+            values_by_column = list(zip(*chunk))
+            if builders is None:
+                # The first chunk decides each column's encoding
+                builders = [
+                    DictionaryColumn()
+                    if name not in ("TRANSACTION_ID", "PATIENT_ID")
+                    and len(set(values)) <= len(values) * DICTIONARY_MAX_RATIO
+                    else BytesColumn()
+                    for name, values in zip(COLUMNS, values_by_column)
+                ]
+            for builder, values in zip(builders, values_by_column):
+                builder.extend(values)
+            size += len(chunk)
+        if builders is None:
+            builders = [BytesColumn() for _ in COLUMNS]
+        return cls({name: builder.finish() for name, builder in zip(COLUMNS, builders)}, size)
+
+    def offsets_of(self, patient_id) -> list:
+        offsets = self.index.get(patient_id)
+        if offsets is None:
+            return []
+        return offsets if isinstance(offsets, list) else [offsets]
+
+    def offset_of_tid(self, tid: str) -> Optional[int]:
+        offset = bisect_left(self.tids, tid, 0, self.size)
+        if offset < self.size and self.tids[offset] == tid:
+            return offset
+        return None
+
+    def start_after(self, tid: Optional[str]) -> int:
+        if tid is None:
+            return 0
+        return bisect_right(self.tids, tid, 0, self.size)
+
+    def row(self, offset: int) -> tuple:
+        return tuple(self.columns[name][offset] for name in COLUMNS)
+
+    def iter_rows(self, names, start: int, deleted, batch_size: int):
+        """Yield ``(tid, row)`` from ``start`` on, with ``row`` in ``names`` order."""
+        columns = [self.columns[name] for name in names]
+        tids = self.columns["TRANSACTION_ID"]
+        for batch_start in range(start, self.size, batch_size):
+            batch_stop = min(batch_start + batch_size, self.size)
+            batch_tids = tids.take(batch_start, batch_stop)
+            rows = zip(*(column.take(batch_start, batch_stop) for column in columns))
+            if deleted:
+                for offset, tid, row in zip(range(batch_start, batch_stop), batch_tids, rows):
+                    if offset not in deleted:
+                        yield tid, row
+            else:
+                yield from zip(batch_tids, rows)
+
+    def memory_report(self) -> dict:
+        columns = {
+            name: {"encoding": column.encoding, "bytes": column.nbytes()}
+            for name, column in self.columns.items()
+        }
+        index_bytes = sys.getsizeof(self.index) + sum(
+            sys.getsizeof(key) + (sys.getsizeof(value) if isinstance(value, list) else 0)
+            for key, value in self.index.items()
+        )
+        column_bytes = sum(column["bytes"] for column in columns.values())
+        return {"columns": columns, "column_bytes": column_bytes, "index_bytes": index_bytes}
+
+
+class SnapshotState(NamedTuple):
+    base: Generation
+    deleted: frozenset       # base offsets deleted since the load
+    appended: tuple          # full row tuples added since the load, by TRANSACTION_ID
+    appended_tids: tuple
+    appended_by_patient: dict
+
+
+def _watermark() -> str:
+    # Taken before a read: a write committed during it, or stamped by a worker
+    # with a slightly slow clock, is still at or after the watermark
+    return now_stamp(datetime.now(timezone.utc) - timedelta(seconds=DELTA_OVERLAP_SECONDS))
+
+
+def _state(base, deleted=frozenset(), appended=()):
+    appended = tuple(sorted(appended, key=itemgetter(TID)))
+    by_patient = {}
+    for row in appended:
+        by_patient.setdefault(row[PID], []).append(row)
+    return SnapshotState(base, frozenset(deleted), appended,
+                         tuple(row[TID] for row in appended), by_patient)
+
+
+def _iter_state(state, names, after=None, batch_size=1000):
+    base = state.base.iter_rows(names, state.base.start_after(after), state.deleted, batch_size)
+    first = 0 if after is None else bisect_right(state.appended_tids, after)
+    if first == len(state.appended):
+        for _, row in base:
+            yield row
+        return
+    positions = [COLUMNS.index(name) for name in names]
+    extra = (
+        (row[TID], tuple(row[i] for i in positions))
+        for row in islice(state.appended, first, None)
+    )
+    for _, row in heapq.merge(base, extra, key=itemgetter(0)):
+        yield row
+
+
+# --- Snapshot ----------------------------------------------------------------
+
+class Snapshot:
+    def __init__(self):
+        self._state: Optional[SnapshotState] = None
+        # Serializes loads, refreshes and patches; readers never take it
+        self._lock = threading.RLock()
+        self.loaded_at = None
+        self.refreshed_at = None
+        # Rows stamped at or after this may be newer than the snapshot
+        self.modified_watermark = None
+        self.load_seconds = None
+
+    @property
+    def ready(self) -> bool:
+        return self._state is not None
+
+    # Loading and refreshing
+
+    def load(self, db: Session):
+        """Read the whole table into a new generation.
+
+        The arrays are built without the lock, so writes are not held up by a
+        reload. Patches they make to the old state are lost on the swap, but
+        their rows are stamped after the watermark taken here and the next
+        ``refresh`` pulls them back in.
+        """
+        start = time.perf_counter()
+        watermark = _watermark()
+        query = (
+            db.query(*(getattr(MTMRecordORM, name) for name in COLUMNS))
+            .order_by(MTMRecordORM.TRANSACTION_ID)
+            .yield_per(LOAD_CHUNK_SIZE)
+        )
+        base = Generation.build(tuple(row) for row in query)
+        with self._lock:
+            self._state = _state(base)
+            self.modified_watermark = watermark
+            self.load_seconds = time.perf_counter() - start
+            self.loaded_at = self.refreshed_at = time.time()
+        logger.info("MTM snapshot loaded: %d rows in %.1fs", self.count(), self.load_seconds)
+
+    def refresh(self, db: Session):
+        """Pull in changes made outside this process since the last load or refresh."""
+        if self._state is None:
+            return self.load(db)
+        if FULL_RELOAD_SECONDS > 0 and time.time() - self.loaded_at >= FULL_RELOAD_SECONDS:
+            self.load(db)
+        with self._lock:
+            next_watermark = _watermark()
+            columns = [getattr(MTMRecordORM, name) for name in COLUMNS]
+            # Inserted or replaced since the last pass; rows in the overlap are
+            # pulled twice, and re-patching a row is harmless
+            query = db.query(*columns).filter(MTMRecordORM.MODIFIED_AT >= self.modified_watermark)
+            changed = {row[TID]: row for row in map(tuple, query)}
+            # Rows loaded without a stamp
+            watermark = self._max_tid()
+            query = db.query(*columns)
+            if watermark is not None:
+                query = query.filter(MTMRecordORM.TRANSACTION_ID > watermark)
+            changed.update((row[TID], row) for row in map(tuple, query))
+            if changed:
+                self._patch(inserted=list(changed.values()))
+            self.modified_watermark = next_watermark
+
+            total = db.query(MTMRecordORM.TRANSACTION_ID).count()
+            if total != self.count():
+                self._reconcile(db)
+            self.refreshed_at = time.time()
+
+    def _reconcile(self, db: Session):
+        db_tids = {tid for (tid,) in db.query(MTMRecordORM.TRANSACTION_ID)}
+        state = self._state
+        base_tids = state.base.columns["TRANSACTION_ID"].take(0, state.base.size)
+        ours = {tid for offset, tid in enumerate(base_tids) if offset not in state.deleted}
+        ours.update(state.appended_tids)
+        missing = sorted(db_tids - ours)
+        inserted = []
+        for start in range(0, len(missing), RECONCILE_CHUNK_SIZE):
+            chunk = missing[start:start + RECONCILE_CHUNK_SIZE]
+            inserted.extend(
+                tuple(row) for row in
+                db.query(*(getattr(MTMRecordORM, name) for name in COLUMNS))
+                .filter(MTMRecordORM.TRANSACTION_ID.in_(chunk))
+            )
+        logger.info("MTM snapshot reconciled: %d added, %d removed",
+                    len(inserted), len(ours - db_tids))
+        self._patch(inserted=inserted, deleted_tids=ours - db_tids)
+
+    def _max_tid(self) -> Optional[str]:
+        state = self._state
+        candidates = list(state.appended_tids[-1:])
+        for offset in range(state.base.size - 1, -1, -1):
+            if offset not in state.deleted:
+                candidates.append(state.base.columns["TRANSACTION_ID"][offset])
+                break
+        return max(candidates, default=None)
+
+    # Patches from this process's writes
+
+    def apply_insert(self, record):
+        if self._state is None:
+            return
+        with self._lock:
+            self._patch(inserted=[tuple(getattr(record, name) for name in COLUMNS)])
+
+    def apply_inserts(self, rows):
+        """Patch in a batch of inserted rows (column-name dicts) at once."""
+        if self._state is None or not rows:
+            return
+        with self._lock:
+            self._patch(inserted=[tuple(row.get(name) for name in COLUMNS) for row in rows])
+
+    def apply_delete(self, transaction_id: str):
+        if self._state is None:
+            return
+        with self._lock:
+            self._patch(deleted_tids=[transaction_id])
+
+    def _patch(self, inserted=(), deleted_tids=()):
+        state = self._state
+        base = state.base
+        deleted = set(state.deleted)
+        appended = {row[TID]: row for row in state.appended}
+        # An insert over an existing key replaces it, so patches are idempotent
+        for tid in [row[TID] for row in inserted] + list(deleted_tids):
+            if appended.pop(tid, None) is None:
+                offset = base.offset_of_tid(tid)
+                if offset is not None:
+                    deleted.add(offset)
+        appended.update((row[TID], row) for row in inserted)
+        self._state = _state(base, deleted, appended.values())
+
+    @property
+    def needs_compaction(self) -> bool:
+        state = self._state
+        return state is not None and len(state.deleted) + len(state.appended) > COMPACT_AFTER
+
+    def compact(self):
+        """Fold the overlay into freshly encoded arrays (on the refresher, not on writes).
+
+        Like ``load``, the arrays are built without the lock. Patches made
+        meanwhile are then replayed onto the new generation.
+        """
+        state = self._state
+        base = Generation.build(_iter_state(state, COLUMNS))
+        with self._lock:
+            current = self._state
+            if current.base is not state.base:
+                return  # reloaded meanwhile
+            before = {row[TID]: row for row in state.appended}
+            after = {row[TID]: row for row in current.appended}
+            inserted = [row for tid, row in after.items() if before.get(tid) is not row]
+            deleted_tids = [tid for tid in before if tid not in after]
+            deleted_tids += [state.base.tids[offset] for offset in current.deleted - state.deleted]
+            self._state = _state(base)
+            if inserted or deleted_tids:
+                self._patch(inserted=inserted, deleted_tids=deleted_tids)
+        logger.info("MTM snapshot compacted: %d rows", self.count())
+
+    # Reads
+
+    def count(self) -> int:
+        state = self._state
+        return state.base.size - len(state.deleted) + len(state.appended)
+
+    def iter_rows(self, names=COLUMNS, after: Optional[str] = None, batch_size: int = 1000):
+        """Row tuples in ``names`` order, by TRANSACTION_ID, optionally after a key."""
+        return _iter_state(self._state, names, after, batch_size)
+
+    def records_for(self, patient_id: str) -> list:
+        state = self._state
+        rows = [
+            state.base.row(offset)
+            for offset in state.base.offsets_of(patient_id)
+            if offset not in state.deleted
+        ]
+        extra = state.appended_by_patient.get(patient_id)
+        if extra:
+            rows = sorted(rows + extra, key=itemgetter(TID))
+        return [to_record(row) for row in rows]
+
+    def get_record_by_id(self, patient_id: str) -> Optional[SnapshotRecord]:
+        records = self.records_for(patient_id)
+        return records[0] if records else None
+
+    def get_records_by_ids(self, patient_ids) -> list:
+        return [record for patient_id in dict.fromkeys(patient_ids)
+                for record in self.records_for(patient_id)]
+
+    def get_all_records(self) -> list:
+        return [to_record(row) for row in self.iter_rows(COLUMNS)]
+
+    def get_records_page(self, limit: int, after: Optional[str] = None, fields=None):
+        rows = list(islice(self.iter_rows(COLUMNS, after), limit + 1))
+        next_after = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_after = rows[-1][TID]
+        if fields:
+            positions = [COLUMNS.index(name) for name in fields]
+            return [{name: row[i] for name, i in zip(fields, positions)} for row in rows], next_after
+        return [to_record(row) for row in rows], next_after
+
+    def stats(self) -> dict:
+        state = self._state
+        if state is None:
+            return {"enabled": SNAPSHOT_ENABLED, "ready": False}
+        rows = self.count()
+        memory = state.base.memory_report()
+        total = memory["column_bytes"] + memory["index_bytes"]
+        return {
+            "enabled": SNAPSHOT_ENABLED,
+            "ready": True,
+            "rows": rows,
+            "overlay": {"appended": len(state.appended), "deleted": len(state.deleted)},
+            "loaded_at": self.loaded_at,
+            "refreshed_at": self.refreshed_at,
+            "load_seconds": self.load_seconds,
+            "memory": {
+                **memory,
+                "total_bytes": total,
+                "bytes_per_record": total / state.base.size if state.base.size else 0.0,
+            },
+        }
+
+
+snapshot = Snapshot()
+
+def read_replica() -> Optional[Snapshot]:
+    """The snapshot if it is enabled and loaded, else None (read from the DB)."""
+    return snapshot if snapshot.ready else None
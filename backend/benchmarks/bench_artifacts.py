@@ -0,0 +1,102 @@
+"""Full exports served from materialized files versus streamed live.
+
+Times GET /mtm/xml/all and /mtm/messaging/all both ways with the snapshot
+loaded. It then inserts a row straight into newDataset, as another worker
+or the --sync loader would, and checks that the rebuilt files match a live
+render from the DB even though this process's snapshot has not seen it:
+
+    python benchmarks/bench_artifacts.py --rows 20000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault("MTM_EXPORT_DIR", tempfile.mkdtemp(prefix="mtm-exports-"))
+
+from common import build_engine, make_row
+
+from fastapi.testclient import TestClient
+
+from api import messaging_routes, mtm_routes
+from core import database
+from main import app
+from models.mtm_orm_model import MTMRecordORM, date_shadows
+from services.change_tracking import now_stamp
+from services.mtm_messaging import iter_all_records_messaging
+from services.mtm_service import iter_all_records_as_ncpdp_xml
+from services.snapshot import snapshot
+
+EXPORTS = {
+    "xml": ("/mtm/xml/all", iter_all_records_as_ncpdp_xml),
+    "messaging": ("/mtm/messaging/all", iter_all_records_messaging),
+}
+IDENTITY = {"Accept-Encoding": "identity"}
+
+
+def set_artifacts(enabled: bool):
+    mtm_routes.ARTIFACTS_ENABLED = messaging_routes.ARTIFACTS_ENABLED = enabled
+
+
+def served_artifact(client, url: str, not_etag: str = None, timeout: float = 120):
+    """The export once it is served from a file (with an ETag other than ``not_etag``)."""
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get(url, headers=IDENTITY)
+        response.raise_for_status()
+        etag = response.headers.get("etag")
+        if etag is not None and etag != not_etag:
+            return response
+        assert time.monotonic() < deadline, f"{url}: no artifact after {timeout}s"
+        time.sleep(0.05)
+
+
+def timed_get(client, url: str, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        client.get(url, headers=IDENTITY).raise_for_status()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.use_engine(build_engine(args.rows, url=f"sqlite:///{os.path.join(tmp, 'mtm.db')}"))
+        with TestClient(app) as client:
+            with database.SessionLocal() as db:
+                snapshot.load(db)
+
+            print(f"{'export':<10} {'live ms':>9} {'file ms':>9} {'speedup':>8}")
+            etags = {}
+            for fmt, (url, _) in EXPORTS.items():
+                set_artifacts(True)
+                etags[fmt] = served_artifact(client, url).headers["etag"]
+                file_ms = timed_get(client, url, args.repeat) * 1000
+                set_artifacts(False)
+                live_ms = timed_get(client, url, args.repeat) * 1000
+                print(f"{fmt:<10} {live_ms:>9.1f} {file_ms:>9.1f} {live_ms / file_ms:>7.1f}x")
+            set_artifacts(True)
+
+            # A write this process never sees: the snapshot is not refreshed
+            row = {key: value or "" for key, value in make_row(args.rows, random.Random(1)).items()}
+            row = {**row, **date_shadows(row), "MODIFIED_AT": now_stamp()}
+            with database.get_engine().begin() as conn:
+                conn.execute(MTMRecordORM.__table__.insert(), [row])
+            for fmt, (url, render) in EXPORTS.items():
+                body = served_artifact(client, url, not_etag=etags[fmt]).text
+                with database.SessionLocal() as db:
+                    live = "".join(render(db, use_replica=False))
+                assert row["TRANSACTION_ID"] in body or row["PATIENT_ID"] in body, \
+                    f"{fmt}: rebuilt export is missing the out-of-process write"
+                assert body == live, f"{fmt}: rebuilt export differs from a live DB render"
+        database.shutdown()
+    print("Rebuilt exports match the DB after an out-of-process write")
+
+
+if __name__ == "__main__":
+    main()
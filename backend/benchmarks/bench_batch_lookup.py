@@ -0,0 +1,45 @@
+"""Compare N single-patient lookups against one POST /mtm/batch call.
+
+Runs the app against an in-memory SQLite copy of newDataset:
+
+    python benchmarks/bench_batch_lookup.py --rows 20000 --lookups 500
+"""
+import argparse
+import random
+import time
+
+from common import build_engine
+
+from fastapi.testclient import TestClient
+
+from core import database
+from main import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--lookups", type=int, default=500)
+    args = parser.parse_args()
+
+    database.use_engine(build_engine(args.rows))
+    client = TestClient(app)
+    patient_ids = [f"P{i:08d}" for i in random.Random(0).sample(range(args.rows), args.lookups)]
+
+    start = time.perf_counter()
+    for patient_id in patient_ids:
+        client.get(f"/mtm/{patient_id}").raise_for_status()
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    response = client.post("/mtm/batch", json={"patient_ids": patient_ids})
+    response.raise_for_status()
+    batch = time.perf_counter() - start
+
+    assert len(response.json()) == args.lookups
+    print(f"{args.lookups} single lookups: {single * 1000:.1f} ms")
+    print(f"1 batch lookup:      {batch * 1000:.1f} ms ({single / batch:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""POST /mtm/ one record at a time vs POST /mtm/bulk NDJSON, through the app.
+
+Both paths load the same records into an empty SQLite file database:
+
+    python benchmarks/bench_bulk_ingest.py --rows 5000 --chunk-sizes 100,1000,5000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from common import generate_rows
+
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from core import database
+from main import app
+from models.mtm_orm_model import Base
+
+
+def request_rows(rows: int, offset: int):
+    # MTMRecord fields are required strings; give each run its own keys
+    for row in generate_rows(rows):
+        record = {key: value or "" for key, value in row.items()}
+        record["TRANSACTION_ID"] = f"{offset}-{record['TRANSACTION_ID']}"
+        yield record
+
+
+def ndjson_body(records, piece: int = 64 * 1024):
+    # Streamed like a real upload, not one in-memory blob
+    buffer = []
+    size = 0
+    for record in records:
+        line = json.dumps(record) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= piece:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def count(engine) -> int:
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT COUNT(*) FROM newDataset")).scalar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--single-rows", type=int, default=None,
+                        help="records for the one-at-a-time path (default: --rows)")
+    parser.add_argument("--chunk-sizes", default="100,1000,5000")
+    args = parser.parse_args()
+    single_rows = args.single_rows or args.rows
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = database.build_engine(f"sqlite:///{os.path.join(tmp, 'mtm.db')}")
+        Base.metadata.create_all(engine)
+        database.use_engine(engine)
+
+        with TestClient(app) as client:
+            print(f"{'path':<22} {'rows':>7} {'seconds':>9} {'rows/s':>10} {'speedup':>8}")
+            start = time.perf_counter()
+            for record in request_rows(single_rows, 0):
+                client.post("/mtm/", json=record).raise_for_status()
+            single = (time.perf_counter() - start) / single_rows
+            print(f"{'POST /mtm/':<22} {single_rows:>7} {single * single_rows:>9.2f} "
+                  f"{1 / single:>10.0f} {1:>7.1f}x")
+
+            for run, chunk_size in enumerate(int(size) for size in args.chunk_sizes.split(",")):
+                before = count(engine)
+                start = time.perf_counter()
+                response = client.post("/mtm/bulk", params={"chunk_size": chunk_size},
+                                       content=ndjson_body(request_rows(args.rows, run + 1)))
+                seconds = time.perf_counter() - start
+                report = response.json()
+                assert report["inserted"] == args.rows and not report["errors"], report
+                assert count(engine) - before == args.rows
+                print(f"{f'bulk chunk={chunk_size}':<22} {args.rows:>7} {seconds:>9.2f} "
+                      f"{args.rows / seconds:>10.0f} {single * args.rows / seconds:>7.1f}x")
+        database.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""N simultaneous identical heavy requests, with and without request coalescing.
+
+Fires --clients identical requests at once at each heavy read route (full
+exports, a batch lookup, a per-patient XML render) and counts the queries
+that read newDataset while they run. With coalescing on, every route should
+cost one query however many clients there are, and every client must get
+the same body. The full exports are also requested by --staggered clients
+arriving one after another over the first half of a single export, while
+the first is still streaming, which must cost one query as well:
+
+    python benchmarks/bench_coalesce.py --rows 20000 --clients 50
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+# Exercise the streamed exports: the export artifacts have their own
+# single-flight build
+os.environ.setdefault("MTM_EXPORT_ARTIFACTS", "false")
+
+from common import build_engine
+
+import httpx
+from sqlalchemy import event
+
+from core import database
+from main import app
+from services.coalesce import coalescer
+from services.render_cache import render_cache
+
+
+EXPORTS = {
+    "xml/all": ("GET", "/mtm/xml/all", {}),
+    "messaging/all": ("GET", "/mtm/messaging/all", {}),
+    "messaging/all gzip": ("GET", "/mtm/messaging/all", {"headers": {"Accept-Encoding": "gzip"}}),
+}
+
+
+def scenarios(rows: int):
+    patient_ids = [f"P{i:08d}" for i in range(0, rows, max(1, rows // 1000))]
+    return {
+        **EXPORTS,
+        "batch xml": ("POST", "/mtm/batch", {"json": {"patient_ids": patient_ids, "format": "xml"}}),
+        "patient xml": ("GET", f"/mtm/{patient_ids[0]}/xml", {}),
+    }
+
+
+async def burst(client, clients: int, method: str, url: str, kwargs, stagger: float = 0) -> tuple:
+    render_cache.clear()
+
+    async def request(i):
+        await asyncio.sleep(i * stagger)
+        return await client.request(method, url, **kwargs)
+
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(request(i) for i in range(clients)))
+    elapsed = time.perf_counter() - start
+    for response in responses:
+        response.raise_for_status()
+    bodies = {response.content for response in responses}
+    assert len(bodies) == 1, f"{url}: clients got different bodies"
+    return elapsed, len(bodies.pop())
+
+
+async def run(clients: int, rows: int, staggered: int):
+    scans = 0
+
+    def count_scans(conn, cursor, statement, parameters, context, executemany):
+        nonlocal scans
+        if "newDataset" in statement and statement.lstrip().upper().startswith("SELECT"):
+            scans += 1
+
+    event.listen(database.get_engine(), "before_cursor_execute", count_scans)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async with app.router.lifespan_context(app):
+            print(f"{'route':<20} {'coalesce':>8} {'queries':>8} {'seconds':>8} {'KB':>9}")
+            for name, (method, url, kwargs) in scenarios(rows).items():
+                for enabled in (False, True):
+                    coalescer.enabled = enabled
+                    scans = 0
+                    elapsed, size = await burst(client, clients, method, url, kwargs)
+                    print(f"{name:<20} {'on' if enabled else 'off':>8} {scans:>8} {elapsed:>8.2f} {size / 1024:>9.0f}")
+                    if enabled:
+                        assert scans == 1, f"{name}: {clients} coalesced requests ran {scans} queries"
+            print(f"\n{staggered} requests spread over half an export")
+            print(f"{'route':<20} {'coalesce':>8} {'queries':>8} {'seconds':>8} {'KB':>9} {'apart ms':>9}")
+            for name, (method, url, kwargs) in EXPORTS.items():
+                coalescer.enabled = False
+                single, _ = await burst(client, 1, method, url, kwargs)
+                stagger = single / 2 / staggered
+                for enabled in (False, True):
+                    coalescer.enabled = enabled
+                    scans = 0
+                    elapsed, size = await burst(client, staggered, method, url, kwargs, stagger)
+                    print(f"{name:<20} {'on' if enabled else 'off':>8} {scans:>8} {elapsed:>8.2f} "
+                          f"{size / 1024:>9.0f} {stagger * 1000:>9.1f}")
+                    if enabled:
+                        assert scans == 1, f"{name}: {staggered} staggered requests ran {scans} queries"
+    print(f"{clients} simultaneous and {staggered} staggered requests per route ran one query each "
+          f"with coalescing on")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--staggered", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'mtm.db')}"
+        database.use_engine(build_engine(args.rows, url=url))
+        asyncio.run(run(args.clients, args.rows, args.staggered))
+        database.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""JSON vs NDJSON vs msgpack vs Arrow IPC vs Parquet for a full GET /mtm/ dump.
+
+For each format: response size, time to produce the response through the
+app, and the time an analytics client spends turning the body into a
+pandas DataFrame. Every format is checked against the JSON rows:
+
+    python benchmarks/bench_columnar.py --rows 100000
+"""
+import argparse
+import io
+import json
+import time
+
+from common import build_engine
+
+import msgpack
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fastapi.testclient import TestClient
+
+from core import database
+from main import app
+
+DECODERS = {
+    "json": lambda body: pd.DataFrame(json.loads(body)),
+    "ndjson": lambda body: pd.DataFrame(map(json.loads, body.splitlines())),
+    "msgpack": lambda body: pd.DataFrame(msgpack.unpackb(body)),
+    "arrow": lambda body: pa.ipc.open_stream(body).read_all().to_pandas(),
+    "parquet": lambda body: pq.read_table(io.BytesIO(body)).to_pandas(),
+}
+
+
+def as_rows(frame: pd.DataFrame) -> list:
+    # NaN/None differences are pandas' doing, not the format's
+    frame = frame.sort_values("TRANSACTION_ID")[sorted(frame.columns)]
+    return frame.astype(object).where(frame.notna(), None).values.tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3, help="best of N runs per format")
+    args = parser.parse_args()
+
+    print(f"Seeding {args.rows} records...")
+    database.use_engine(build_engine(args.rows))
+    with TestClient(app) as client:
+        print(f"{'format':<9} {'MB':>8} {'vs json':>8} {'server s':>9} {'decode s':>9} {'total s':>8}")
+        expected = baseline = None
+        for fmt, decode in DECODERS.items():
+            server = decoding = float("inf")
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                response = client.get("/mtm/", params={"format": fmt})
+                response.raise_for_status()
+                body = response.content
+                server = min(server, time.perf_counter() - start)
+                start = time.perf_counter()
+                frame = decode(body)
+                decoding = min(decoding, time.perf_counter() - start)
+            rows = as_rows(frame)
+            if expected is None:
+                expected, baseline = rows, len(body)
+            assert rows == expected, f"{fmt} rows differ from JSON"
+            print(f"{fmt:<9} {len(body) / 1e6:>8.2f} {len(body) / baseline:>7.2f}x {server:>9.3f} "
+                  f"{decoding:>9.3f} {server + decoding:>8.3f}")
+    database.shutdown()
+
+
+if __name__ == "__main__":
+    main()
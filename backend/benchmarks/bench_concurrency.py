@@ -0,0 +1,74 @@
+"""p50/p99 latency of single-patient lookups under N concurrent clients.
+
+Serves the app over ASGI against a SQLite file that stands in for Snowflake,
+using the same pool settings (DB_POOL_SIZE, DB_MAX_OVERFLOW, ...) as production:
+
+    python benchmarks/bench_concurrency.py --rows 20000 --clients 50 --requests 2000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from common import build_engine
+
+import httpx
+
+from core import database
+from main import app
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run_clients(clients: int, requests: int, patient_ids):
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(patient_ids[i % len(patient_ids)])
+
+    async def client_loop(client):
+        while not queue.empty():
+            patient_id = queue.get_nowait()
+            start = time.perf_counter()
+            response = await client.get(f"/mtm/{patient_id}")
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async with app.router.lifespan_context(app):
+            start = time.perf_counter()
+            await asyncio.gather(*(client_loop(client) for _ in range(clients)))
+            elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'mtm.db')}"
+        database.use_engine(build_engine(args.rows, url=url))
+
+        patient_ids = [f"P{i:08d}" for i in random.Random(0).sample(range(args.rows), min(args.rows, 1000))]
+        latencies, elapsed = asyncio.run(run_clients(args.clients, args.requests, patient_ids))
+
+    print(f"{args.clients} clients, {len(latencies)} requests in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:,.0f} req/s)")
+    print(f"p50 {percentile(latencies, 50) * 1000:.1f} ms  "
+          f"p99 {percentile(latencies, 99) * 1000:.1f} ms  "
+          f"mean {statistics.mean(latencies) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
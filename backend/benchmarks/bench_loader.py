@@ -0,0 +1,54 @@
+"""Throughput of connect_mongo_snowflake.load against mongomock + SQLite.
+
+Needs mongomock (pip install mongomock):
+
+    python benchmarks/bench_loader.py --rows 100000 --workers 4
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+from common import make_row
+
+import mongomock
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import connect_mongo_snowflake as loader
+from core import database
+from models.mtm_orm_model import Base
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--chunk-size", type=int, default=loader.DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=loader.DEFAULT_WORKERS)
+    args = parser.parse_args()
+
+    # Documents use the MongoDB field names the loader renames from
+    source_names = {column: field for field, column in loader.rename_map.items()}
+    rnd = random.Random(0)
+    collection = mongomock.MongoClient()["healthcare"]["Dataset1"]
+    collection.insert_many([
+        {source_names.get(key, key): value for key, value in make_row(i, rnd).items()}
+        for i in range(args.rows)
+    ])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = database.build_engine(f"sqlite:///{os.path.join(tmp, 'target.db')}")
+        Base.metadata.create_all(engine)
+        loaded, elapsed = loader.load(
+            collection, engine, chunk_size=args.chunk_size, workers=args.workers,
+            checkpoint_path=os.path.join(tmp, "checkpoint.json"),
+        )
+        with engine.connect() as conn:
+            assert conn.execute(text("SELECT COUNT(*) FROM newDataset")).scalar() == loaded
+
+    print(f"loaded {loaded} rows in {elapsed:.2f}s ({loaded / elapsed:,.0f} rows/sec)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Serial vs process-pool sharded rendering of the full-table exports.
+
+Seeds a SQLite file (worker processes need a database they can open) and
+renders the XML and messaging exports with increasing worker counts,
+checking every run against the serial bytes:
+
+    python benchmarks/bench_parallel_export.py --rows 200000 --workers 1,2,4
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from common import build_engine
+
+from core import database
+from services import mtm_messaging, mtm_service, parallel_export
+
+EXPORTS = {
+    "xml": mtm_service.iter_all_records_as_ncpdp_xml,
+    "messaging": mtm_messaging.iter_all_records_messaging,
+}
+
+
+def render(export) -> tuple:
+    start = time.perf_counter()
+    with database.SessionLocal() as db:
+        text = "".join(export(db))
+    return text, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--workers", default=f"1,2,{os.cpu_count() or 4}",
+                        help="comma-separated worker counts; 1 is the serial path")
+    parser.add_argument("--shard-rows", type=int, default=parallel_export.SHARD_ROWS)
+    args = parser.parse_args()
+    worker_counts = [int(count) for count in args.workers.split(",")]
+    parallel_export.SHARD_ROWS = args.shard_rows
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"Seeding {args.rows} records...")
+        database.use_engine(build_engine(args.rows, url=f"sqlite:///{os.path.join(tmp, 'mtm.db')}"))
+        print(f"{'export':<10} {'workers':>7} {'seconds':>9} {'rows/s':>10} {'speedup':>8}")
+        for name, export in EXPORTS.items():
+            parallel_export.EXPORT_WORKERS = 1
+            expected, serial = render(export)
+            for workers in worker_counts:
+                parallel_export.EXPORT_WORKERS = workers
+                if workers > 1:
+                    # Spawning the pool is a one-off cost, not part of the export
+                    render(export)
+                text, seconds = render(export)
+                assert text == expected, f"{name} output with {workers} workers differs from serial"
+                print(f"{name:<10} {workers:>7} {seconds:>9.2f} {args.rows / seconds:>10.0f} "
+                      f"{serial / seconds:>7.1f}x")
+        parallel_export.shutdown()
+        database.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Records/second of the compiled bulk serializers vs the per-record path.
+
+Also checks that both produce identical text (golden output):
+
+    python benchmarks/bench_serializers.py --rows 20000
+"""
+import argparse
+import time
+
+from common import build_engine
+
+from dicttoxml import dicttoxml
+from sqlalchemy.orm import Session
+from xml.dom.minidom import parseString
+
+from models.mtm_messaging_model import PatientRecord
+from models.mtm_orm_model import MTMRecordORM
+from services.mtm_messaging import convert_to_ncpdp_message, iter_messages
+from services.mtm_service import convert_record_to_dict, iter_records_as_ncpdp_xml
+from services.serializers import MESSAGING_PLAN, XML_PLAN
+
+
+def timed(label: str, rows: int, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<10} {rows / elapsed:>12,.0f} records/s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    args = parser.parse_args()
+
+    with Session(build_engine(args.rows)) as db:
+        records = db.query(MTMRecordORM).all()
+        messaging_rows = db.query(*MESSAGING_PLAN.select()).all()
+        xml_rows = db.query(*XML_PLAN.select()).all()
+
+    print("NCPDP messaging")
+    before = timed("pydantic", args.rows, lambda: "\n\n".join(
+        convert_to_ncpdp_message(PatientRecord.from_orm_model(r)) for r in records))
+    after = timed("compiled", args.rows, lambda: "".join(iter_messages(messaging_rows)))
+    assert before == after, "messaging output differs"
+
+    print("NCPDP XML")
+    before = timed("dicttoxml", args.rows, lambda: parseString(dicttoxml(
+        {"Record": [convert_record_to_dict(r) for r in records]},
+        custom_root="MTMRequest", attr_type=False,
+    )).toprettyxml(indent="  "))
+    after = timed("compiled", args.rows, lambda: "".join(iter_records_as_ncpdp_xml(xml_rows)))
+    assert before == after, "XML output differs"
+
+    print("golden output: identical")
+
+
+if __name__ == "__main__":
+    main()
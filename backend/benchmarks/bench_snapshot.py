@@ -0,0 +1,82 @@
+"""Compare the in-memory snapshot against the DB path, plus its memory per record.
+
+Runs the app against a SQLite file copy of newDataset, first reading from
+the DB and then from a loaded snapshot:
+
+    python benchmarks/bench_snapshot.py --rows 100000 --lookups 500
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from common import build_engine
+
+from fastapi.testclient import TestClient
+
+from core import database
+from main import app
+from services.render_cache import render_cache
+from services.snapshot import snapshot
+
+
+def time_requests(client, urls) -> float:
+    render_cache.clear()
+    start = time.perf_counter()
+    for url in urls:
+        client.get(url, headers={"Accept-Encoding": "identity"}).raise_for_status()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--lookups", type=int, default=500)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    patient_ids = [f"P{i:08d}" for i in rnd.sample(range(args.rows), args.lookups)]
+    after = [f"T{i:08d}" for i in rnd.sample(range(args.rows), args.lookups)]
+    workloads = {
+        "lookup by patient": [f"/mtm/{patient_id}" for patient_id in patient_ids],
+        "NCPDP keys": [f"/mtm/ncpdp/messaging/{patient_id}?keys=AM20,PRV,DT,PAT"
+                       for patient_id in patient_ids],
+        "page of 100": [f"/mtm/?limit=100&after={key}" for key in after],
+        "XML export": ["/mtm/xml/all"],
+        "messaging export": ["/mtm/messaging/all"],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.use_engine(build_engine(args.rows, url=f"sqlite:///{os.path.join(tmp, 'mtm.db')}"))
+        with TestClient(app) as client:
+            db_times = {name: time_requests(client, urls) for name, urls in workloads.items()}
+
+            with database.SessionLocal() as db:
+                snapshot.load(db)
+            snapshot_times = {name: time_requests(client, urls) for name, urls in workloads.items()}
+
+            with database.SessionLocal() as db:
+                start = time.perf_counter()
+                snapshot.refresh(db)
+                refresh = time.perf_counter() - start
+        database.shutdown()
+
+    stats = snapshot.stats()
+    memory = stats["memory"]
+    print(f"Snapshot of {stats['rows']} rows loaded in {stats['load_seconds']:.2f}s, "
+          f"no-op refresh in {refresh * 1000:.1f} ms")
+    print(f"Memory: {memory['column_bytes'] / 2**20:.1f} MiB columns + "
+          f"{memory['index_bytes'] / 2**20:.1f} MiB index = "
+          f"{memory['bytes_per_record']:.0f} bytes per record")
+    for name, column in sorted(memory["columns"].items(), key=lambda item: -item[1]["bytes"]):
+        print(f"  {name:<22} {column['encoding']:<11} {column['bytes'] / stats['rows']:>7.1f} B/record")
+    print()
+    print(f"{'workload':<18} {'requests':>8} {'DB ms':>10} {'snapshot ms':>12} {'speedup':>8}")
+    for name, urls in workloads.items():
+        db_ms, snap_ms = db_times[name] * 1000, snapshot_times[name] * 1000
+        print(f"{name:<18} {len(urls):>8} {db_ms:>10.1f} {snap_ms:>12.1f} {db_ms / snap_ms:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Incremental connect_mongo_snowflake.sync against mongomock + SQLite.
+
+Runs one initial sync of the whole collection, then edits and adds
+--changes documents and syncs again. The second run should take time
+proportional to the changes, not the collection. Needs mongomock
+(pip install mongomock):
+
+    python benchmarks/bench_sync.py --rows 100000 --changes 1000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+from common import make_row
+
+import mongomock
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import connect_mongo_snowflake as loader
+from core import database
+from models.mtm_orm_model import Base
+
+UPDATED_FIELD = "updatedAt"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--changes", type=int, default=1000, help="documents edited and added before the resync")
+    parser.add_argument("--chunk-size", type=int, default=loader.DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    source_names = {column: field for field, column in loader.rename_map.items()}
+    rnd = random.Random(0)
+    base = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+    def document(i, updated):
+        fields = {source_names.get(key, key): value for key, value in make_row(i, rnd).items()}
+        return {**fields, UPDATED_FIELD: updated}
+
+    collection = mongomock.MongoClient()["healthcare"]["Dataset1"]
+    collection.create_index([(UPDATED_FIELD, 1), ("_id", 1)])
+    collection.insert_many([document(i, base + timedelta(seconds=i)) for i in range(args.rows)])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = database.build_engine(f"sqlite:///{os.path.join(tmp, 'target.db')}")
+        Base.metadata.create_all(engine)
+        state = os.path.join(tmp, "sync_state.json")
+
+        def run(label):
+            synced, elapsed = loader.sync(collection, engine, chunk_size=args.chunk_size,
+                                          state_path=state, updated_field=UPDATED_FIELD)
+            print(f"{label:<18} {synced:>8} rows {elapsed:>8.2f}s")
+            return synced
+
+        print(f"{'run':<18} {'upserted':>13} {'seconds':>9}")
+        assert run("initial") == args.rows
+        assert run("no changes") == 0
+
+        later = base + timedelta(days=365)
+        edited = rnd.sample(range(args.rows), args.changes // 2)
+        for i in edited:
+            collection.update_one({source_names["TRANSACTION_ID"]: f"T{i:08d}"},
+                                  {"$set": {source_names["OUTCOME"]: "Resolved", UPDATED_FIELD: later}})
+        added = args.changes - len(edited)
+        collection.insert_many([document(args.rows + i, later) for i in range(added)])
+        assert run(f"{args.changes} changes") == args.changes
+
+        with engine.connect() as conn:
+            total, distinct = conn.execute(
+                text("SELECT COUNT(*), COUNT(DISTINCT TRANSACTION_ID) FROM newDataset")).one()
+        assert total == distinct == args.rows + added, "sync created duplicates"
+    print("no duplicate TRANSACTION_IDs")
+
+
+if __name__ == "__main__":
+    main()
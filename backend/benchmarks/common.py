@@ -0,0 +1,112 @@
+"""Shared setup for the benchmark scripts: a seeded synthetic newDataset.
+
+The generator can also write a standalone SQLite file to run the API against:
+
+    python benchmarks/common.py --rows 1000000 --out mtm.db
+    DATABASE_URL=sqlite:///mtm.db uvicorn main:app --app-dir app
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+from itertools import islice
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from core import database
+from models.mtm_orm_model import Base, MTMRecordORM, date_shadows
+
+INSERT_BATCH = 10000
+
+FIRST_NAMES = ["James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda",
+               "David", "Elizabeth", "Maria", "Wei", "Aisha", "Carlos", "Nguyen", "Fatima"]
+LAST_NAMES = ["Smith", "Johnson", "Garcia", "O'Neil", "Lee & Sons", "Brown", "Martinez",
+              "Davis", "Lopez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Chen"]
+PAYERS = [("AETNA01", "Aetna Medicare Premier"), ("HUMANA7", "Humana Gold Plus"),
+          ("UHC0042", "AARP Medicare Advantage"), ("CIGNA33", "Cigna True Choice <PPO>"),
+          ("BCBS115", "Blue Cross Medicare Rx")]
+INTERVENTIONS = [("CMR", "1"), ("TMR", "2"), ("Adherence", "3"), ("Drug Interaction", "4"),
+                 ("Dose Adjustment", "5")]
+OUTCOMES = ["Resolved", "Improved", "Unchanged", '"Pending" review', ""]
+RECOMMENDATIONS = ["Reduce dose of lisinopril to 10mg", "Switch to generic atorvastatin",
+                   "Discontinue duplicate NSAID therapy\r\nRecheck renal function in 2 weeks",
+                   "Start pill organizer", "", None]
+RESPONSES = ["Accepted", "Declined", "Modified", "No response", ""]
+NOTES = ["Patient reports dizziness", "Follow up by phone", "Caregiver present & agreed",
+         "", None]
+BASE_DATE = date(2024, 1, 1)
+
+
+def npi(rnd: random.Random) -> str:
+    return str(rnd.randint(1000000000, 1999999999))
+
+
+def make_row(i: int, rnd: random.Random) -> dict:
+    """One realistic record; mixes in empty values and XML-special characters."""
+    start = BASE_DATE + timedelta(days=rnd.randint(0, 365))
+    payer_id, plan_name = rnd.choice(PAYERS)
+    intervention, service_code = rnd.choice(INTERVENTIONS)
+    contacted = rnd.random() < 0.6
+    return {
+        "RECORD_TYPE": "MTM",
+        "TRANSACTION_ID": f"T{i:08d}",
+        "DATE": (start - timedelta(days=rnd.randint(0, 14))).isoformat(),
+        "PHARMACY_NCPDP_ID": str(rnd.randint(1000000, 9999999)),
+        "PHARMACIST_NPI": npi(rnd),
+        "PATIENT_ID": f"P{i:08d}",
+        "FIRST_NAME": rnd.choice(FIRST_NAMES),
+        "LAST_NAME": rnd.choice(LAST_NAMES),
+        "DOB": date(rnd.randint(1930, 1990), rnd.randint(1, 12), rnd.randint(1, 28)).isoformat(),
+        "GENDER": rnd.choice(["M", "F"]),
+        "PAYER_ID": payer_id,
+        "PLAN_NAME": plan_name,
+        "INTERVENTION_TYPE": intervention,
+        "MTM_SERVICE_CODE": service_code,
+        "START_DATE": start.isoformat(),
+        "END_DATE": rnd.choice([(start + timedelta(days=rnd.randint(1, 90))).isoformat(), "", None]),
+        "OUTCOME": rnd.choice(OUTCOMES),
+        "RECOMMENDATIONS": rnd.choice(RECOMMENDATIONS),
+        "PRESCRIBER_CONTACTED": "Y" if contacted else "N",
+        "PRESCRIBER_NPI": npi(rnd),
+        "PRESCRIBER_RESPONSE": rnd.choice(RESPONSES) if contacted else None,
+        "FOLLOW_UP_DATE": (start + timedelta(days=rnd.randint(14, 120))).isoformat(),
+        "NOTES": rnd.choice(NOTES),
+    }
+
+
+def generate_rows(rows: int, seed: int = 0):
+    rnd = random.Random(seed)
+    return (make_row(i, rnd) for i in range(rows))
+
+
+def populate(engine, rows: int, seed: int = 0):
+    """Create newDataset and insert ``rows`` records in bounded batches."""
+    Base.metadata.create_all(engine)
+    generated = generate_rows(rows, seed)
+    while True:
+        batch = list(islice(generated, INSERT_BATCH))
+        if not batch:
+            break
+        with engine.begin() as conn:
+            conn.execute(MTMRecordORM.__table__.insert(), [{**row, **date_shadows(row)} for row in batch])
+
+
+def build_engine(rows: int, seed: int = 0, url: str = "sqlite://"):
+    """Seeded SQLite newDataset, in memory unless a file ``url`` is given."""
+    engine = database.build_engine(url)
+    populate(engine, rows, seed)
+    return engine
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic newDataset to a SQLite file.")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="mtm.db")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    build_engine(args.rows, args.seed, url=f"sqlite:///{args.out}").dispose()
+    print(f"✅ {args.rows} records written to {args.out} in {time.perf_counter() - start:.1f}s")
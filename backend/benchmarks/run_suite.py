@@ -0,0 +1,199 @@
+"""End-to-end benchmark suite for every MTM API route.
+
+Seeds a synthetic newDataset into SQLite, drives each route through the ASGI
+test client and records latency percentiles, throughput and peak traced
+memory per scenario:
+
+    python benchmarks/run_suite.py --rows 10000 --out results.json
+    python benchmarks/run_suite.py --rows 10000 --compare results.json --threshold 0.2
+
+With --compare the run exits non-zero if any scenario's p50 latency or peak
+memory regressed by more than the threshold against the baseline file.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from common import build_engine, make_row
+
+from fastapi.testclient import TestClient
+
+from core import database
+from main import app
+from services.render_cache import render_cache
+
+# Metrics compared in --compare mode; higher is worse for all of them
+COMPARED_METRICS = ("p50_ms", "peak_memory_kb")
+
+
+class Scenario:
+    """One route exercised ``iterations`` times; ``request(i)`` -> (method, url, kwargs)."""
+
+    def __init__(self, name, request, iterations):
+        self.name = name
+        self.request = request
+        self.iterations = iterations
+
+
+def build_scenarios(rows: int, lookups: int, exports: int):
+    rnd = random.Random(1)
+    ids = [f"P{i:08d}" for i in (rnd.randrange(rows) for _ in range(max(lookups, 1)))]
+    batch_ids = ids[:100]
+    created = iter(range(rows, rows + 10 ** 9))
+
+    def pick(i):
+        return ids[i % len(ids)]
+
+    def new_record(i):
+        record = {key: value or "" for key, value in make_row(next(created), rnd).items()}
+        return "POST", "/mtm/", {"json": record}
+
+    return [
+        # mtm_routes
+        Scenario("cache_stats", lambda i: ("GET", "/mtm/cache/stats", {}), lookups),
+        Scenario("read_by_patient_id", lambda i: ("GET", f"/mtm/{pick(i)}", {}), lookups),
+        Scenario("xml_by_patient_id", lambda i: ("GET", f"/mtm/{pick(i)}/xml", {}), lookups),
+        Scenario("list_page_100", lambda i: ("GET", "/mtm/", {"params": {"limit": 100}}), lookups),
+        Scenario("list_all", lambda i: ("GET", "/mtm/", {}), exports),
+        Scenario("batch_json_100", lambda i: ("POST", "/mtm/batch", {"json": {"patient_ids": batch_ids}}), exports),
+        Scenario("batch_xml_100", lambda i: ("POST", "/mtm/batch", {"json": {"patient_ids": batch_ids, "format": "xml"}}), exports),
+        Scenario("batch_messaging_100", lambda i: ("POST", "/mtm/batch", {"json": {"patient_ids": batch_ids, "format": "messaging"}}), exports),
+        Scenario("xml_all", lambda i: ("GET", "/mtm/xml/all", {}), exports),
+        # messaging_routes
+        Scenario("messaging_download_by_id", lambda i: ("GET", f"/mtm/ncpdp/messaging/download/{pick(i)}", {}), lookups),
+        Scenario("messaging_by_patient_id", lambda i: ("GET", f"/mtm/ncpdp/messaging/{pick(i)}", {}), lookups),
+        Scenario("messaging_key", lambda i: ("GET", f"/mtm/ncpdp/messaging/{pick(i)}/AM20", {}), lookups),
+        Scenario("messaging_list_all", lambda i: ("GET", "/mtm/ncpdp/messaging", {}), exports),
+        Scenario("messaging_all", lambda i: ("GET", "/mtm/messaging/all", {"headers": {"Accept-Encoding": "identity"}}), exports),
+        # metrics_routes
+        Scenario("metrics", lambda i: ("GET", "/metrics", {}), lookups),
+        # Last, so the rows it adds don't change what the other scenarios read
+        Scenario("create_record", new_record, lookups),
+    ]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_scenario(client: TestClient, scenario: Scenario) -> dict:
+    latencies = []
+    total_bytes = 0
+    render_cache.clear()
+    start = time.perf_counter()
+    for i in range(scenario.iterations):
+        method, url, kwargs = scenario.request(i)
+        began = time.perf_counter()
+        response = client.request(method, url, **kwargs)
+        latencies.append(time.perf_counter() - began)
+        response.raise_for_status()
+        total_bytes += len(response.content)
+    elapsed = time.perf_counter() - start
+
+    # Separate pass: tracemalloc slows allocation-heavy code enough to skew latency
+    render_cache.clear()
+    method, url, kwargs = scenario.request(scenario.iterations)
+    tracemalloc.start()
+    client.request(method, url, **kwargs).raise_for_status()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "requests": scenario.iterations,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "requests_per_s": scenario.iterations / elapsed,
+        "bytes_per_response": total_bytes // scenario.iterations,
+        "peak_memory_kb": peak // 1024,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Human-readable regressions of ``results`` against ``baseline``."""
+    regressions = []
+    for name, metrics in results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = before.get(metric), metrics.get(metric)
+            if old and new is not None and new > old * (1 + threshold):
+                regressions.append(
+                    f"{name}.{metric}: {old:.1f} -> {new:.1f} (+{(new / old - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000, help="synthetic records to seed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lookups", type=int, default=200, help="iterations for per-record routes")
+    parser.add_argument("--exports", type=int, default=3, help="iterations for full-table routes")
+    parser.add_argument("--only", help="comma-separated scenario names to run")
+    parser.add_argument("--out", help="write results JSON here")
+    parser.add_argument("--compare", help="baseline results JSON to check against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed relative regression in --compare mode (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    scenarios = build_scenarios(args.rows, args.lookups, args.exports)
+    if args.only:
+        wanted = set(args.only.split(","))
+        scenarios = [scenario for scenario in scenarios if scenario.name in wanted]
+
+    results = {
+        "meta": {
+            "rows": args.rows,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        },
+        "results": {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"Seeding {args.rows} records...")
+        database.use_engine(build_engine(args.rows, args.seed, url=f"sqlite:///{os.path.join(tmp, 'mtm.db')}"))
+        with TestClient(app) as client:
+            print(f"{'scenario':<26} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>9} {'peak KB':>10}")
+            for scenario in scenarios:
+                metrics = run_scenario(client, scenario)
+                results["results"][scenario.name] = metrics
+                print(f"{scenario.name:<26} {metrics['p50_ms']:>9.2f} {metrics['p99_ms']:>9.2f} "
+                      f"{metrics['requests_per_s']:>9.1f} {metrics['peak_memory_kb']:>10}")
+        database.shutdown()
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"✅ Results written to {args.out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("meta", {}).get("rows") != args.rows:
+            print(f"⚠️ Baseline was recorded with {baseline.get('meta', {}).get('rows')} rows, "
+                  f"this run used {args.rows}")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"❌ {len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"✅ No regressions beyond {args.threshold:.0%} against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,114 +1,424 @@
-import pandas as pd
-from pymongo import MongoClient
-import snowflake.connector
-from dotenv import load_dotenv
+import argparse
 import os
+import sys
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from bson import json_util
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from sqlalchemy import Column, MetaData, String, Table, create_engine, inspect, text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"))
+
+# The API's normalised CCYYMMDD date columns, parsed here once per load
+# rather than on every export, and its MODIFIED_AT stamps
+from models.mtm_orm_model import DATE_SHADOWS, to_ymd
+from services.change_tracking import now_stamp
 
 # Load environment variables
 load_dotenv()
 
-try:
-    # Step 1: Connect to MongoDB
-    mongo_url = os.environ.get('MONGO_URL', "mongodb://localhost:27017")
-    mongo_client = MongoClient(mongo_url)
-    db = mongo_client["healthcare"]
-    collection = db["Dataset1"]
-
-    # Step 2: Load data from MongoDB
-    documents = list(collection.find())
-    if not documents:
-        raise ValueError("No documents found in MongoDB collection.")
-
-    # Step 3: Convert to DataFrame
-    df = pd.DataFrame(documents)
-
-    # Step 4: Drop MongoDB internal _id field
-    if '_id' in df.columns:
-        df.drop(columns=['_id'], inplace=True)
-
-    # Step 5: Define the expected Snowflake columns
-    expected_columns = [
-        "RECORD_TYPE", "TRANSACTION_ID", "DATE", "PHARMACY_NCPDP_ID", "PHARMACIST_NPI",
-        "PATIENT_ID", "PATIENT_NAME", "DOB", "GENDER", "PAYER_ID", "PLAN_NAME",
-        "INTERVENTION_TYPE", "MTM_SERVICE_CODE", "START_DATE", "END_DATE", "OUTCOME",
-        "RECOMMENDATIONS", "PRESCRIBER_CONTACTED", "PRESCRIBER_NPI", "PRESCRIBER_RESPONSE",
-        "FOLLOW_UP_DATE", "NOTES"
-    ]
-
-    # Step 6: Rename columns to match expected format
-    rename_map = {
-        "Record Type": "RECORD_TYPE",
-        "Transaction ID": "TRANSACTION_ID",
-        "Date": "DATE",
-        "Pharmacy NCPDP ID": "PHARMACY_NCPDP_ID",
-        "Pharmacist NPI": "PHARMACIST_NPI",
-        "Patient ID": "PATIENT_ID",
-        "Patient Name": "PATIENT_NAME",
-        "DOB": "DOB",
-        "Gender": "GENDER",
-        "Payer ID": "PAYER_ID",
-        "Plan Name": "PLAN_NAME",
-        "Intervention Type": "INTERVENTION_TYPE",
-        "MTM Service Code": "MTM_SERVICE_CODE",
-        "Start Date": "START_DATE",
-        "End Date": "END_DATE",
-        "Outcome": "OUTCOME",
-        "Recommendations": "RECOMMENDATIONS",
-        "Prescriber Contacted": "PRESCRIBER_CONTACTED",
-        "Prescriber NPI": "PRESCRIBER_NPI",
-        "Prescriber Response": "PRESCRIBER_RESPONSE",
-        "Follow-up Date": "FOLLOW_UP_DATE",
-        "Notes": "NOTES"
-    }
-    df.rename(columns=rename_map, inplace=True)
-
-    # Step 7: Keep only expected columns
-    df = df[[col for col in expected_columns if col in df.columns]]
-
-    # Step 8: Clean data (convert datetimes and lists/dicts to string)
-    for col in df.columns:
-        if pd.api.types.is_datetime64_any_dtype(df[col]):
-            df[col] = df[col].astype(str)
-        elif df[col].apply(lambda x: isinstance(x, (dict, list))).any():
-            df[col] = df[col].apply(lambda x: str(x) if isinstance(x, (dict, list)) else x)
-
-    # Step 9: Connect to Snowflake
-    conn = snowflake.connector.connect(
-        user=os.environ.get('SNOWFLAKE_USER'),
-        password=os.environ.get('SNOWFLAKE_PASSWORD'),
-        account=os.environ.get('SNOWFLAKE_ACCOUNT'),
-        warehouse=os.environ.get('SNOWFLAKE_WAREHOUSE'),
-        database=os.environ.get('SNOWFLAKE_DATABASE'),
-        schema=os.environ.get('SNOWFLAKE_SCHEMA'),
-        role=os.environ.get('SNOWFLAKE_ROLE')
+# Expected Snowflake columns
+expected_columns = [
+    "RECORD_TYPE", "TRANSACTION_ID", "DATE", "PHARMACY_NCPDP_ID", "PHARMACIST_NPI",
+    "PATIENT_ID", "PATIENT_NAME", "DOB", "GENDER", "PAYER_ID", "PLAN_NAME",
+    "INTERVENTION_TYPE", "MTM_SERVICE_CODE", "START_DATE", "END_DATE", "OUTCOME",
+    "RECOMMENDATIONS", "PRESCRIBER_CONTACTED", "PRESCRIBER_NPI", "PRESCRIBER_RESPONSE",
+    "FOLLOW_UP_DATE", "NOTES"
+]
+
+# MongoDB field name -> Snowflake column
+rename_map = {
+    "Record Type": "RECORD_TYPE",
+    "Transaction ID": "TRANSACTION_ID",
+    "Date": "DATE",
+    "Pharmacy NCPDP ID": "PHARMACY_NCPDP_ID",
+    "Pharmacist NPI": "PHARMACIST_NPI",
+    "Patient ID": "PATIENT_ID",
+    "Patient Name": "PATIENT_NAME",
+    "DOB": "DOB",
+    "Gender": "GENDER",
+    "Payer ID": "PAYER_ID",
+    "Plan Name": "PLAN_NAME",
+    "Intervention Type": "INTERVENTION_TYPE",
+    "MTM Service Code": "MTM_SERVICE_CODE",
+    "Start Date": "START_DATE",
+    "End Date": "END_DATE",
+    "Outcome": "OUTCOME",
+    "Recommendations": "RECOMMENDATIONS",
+    "Prescriber Contacted": "PRESCRIBER_CONTACTED",
+    "Prescriber NPI": "PRESCRIBER_NPI",
+    "Prescriber Response": "PRESCRIBER_RESPONSE",
+    "Follow-up Date": "FOLLOW_UP_DATE",
+    "Notes": "NOTES"
+}
+
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_WORKERS = 4
+DEFAULT_CHECKPOINT = "output/load_checkpoint.json"
+DEFAULT_SYNC_STATE = "output/sync_state.json"
+
+
+def snowflake_url():
+    return (
+        f"snowflake://{os.environ.get('SNOWFLAKE_USER')}:{os.environ.get('SNOWFLAKE_PASSWORD')}"
+        f"@{os.environ.get('SNOWFLAKE_ACCOUNT')}/{os.environ.get('SNOWFLAKE_DATABASE')}"
+        f"/{os.environ.get('SNOWFLAKE_SCHEMA')}"
+        f"?warehouse={os.environ.get('SNOWFLAKE_WAREHOUSE')}&role={os.environ.get('SNOWFLAKE_ROLE')}"
     )
-    cursor = conn.cursor()
 
-    # Step 10: Prepare insert query
-    table_name = 'newDataset'
-    columns = list(df.columns)
-    quoted_columns = ', '.join([f'"{col}"' for col in columns])
-    placeholders = ', '.join(['%s'] * len(columns))
 
-    insert_query = f"""
-        INSERT INTO {table_name} ({quoted_columns})
-        VALUES ({placeholders})
+def clean_value(value):
+    # Datetimes and lists/dicts become strings, missing values become ""
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return str(value)
+    if isinstance(value, (dict, list)):
+        return str(value)
+    return value
+
+
+def to_row(document, columns):
+    """Map one MongoDB document onto the target table's column names."""
+    renamed = {rename_map.get(key, key): value for key, value in document.items()}
+    return {target: clean_value(renamed.get(source)) for source, target in columns.items()}
+
+
+# --- Checkpointing ---
+# The checkpoint holds a contiguous watermark (every document with a smaller
+# _id is loaded) plus the _id ranges of chunks that finished out of order.
+
+def load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return {"watermark": None, "done": []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json_util.loads(f.read())
+
+
+def save_checkpoint(path, checkpoint):
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(json_util.dumps(checkpoint))
+    os.replace(tmp_path, path)
+
+
+def already_loaded(doc_id, done):
+    return any(first <= doc_id <= last for first, last in done)
+
+
+def iter_chunks(collection, chunk_size, checkpoint):
+    """Yield lists of documents in _id order, skipping what is already loaded."""
+    query = {}
+    if checkpoint["watermark"] is not None:
+        query = {"_id": {"$gt": checkpoint["watermark"]}}
+    projection = {field: 1 for field in rename_map}
+    cursor = collection.find(query, projection).sort("_id", 1).batch_size(chunk_size)
+
+    chunk = []
+    for document in cursor:
+        if already_loaded(document["_id"], checkpoint["done"]):
+            continue
+        chunk.append(document)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def reflect_columns(engine, table_name):
+    """Target table plus {expected column: actual column name} for those it has."""
+    # Unquoted, case-insensitive name, same as the plain INSERT this replaced
+    table = Table(table_name.lower(), MetaData(), autoload_with=engine)
+    actual = {column.name.upper(): column.name for column in table.columns}
+    columns = {name: actual[name] for name in expected_columns if name in actual}
+    return table, columns
+
+
+def stamp_modified(table, rows):
+    # Stamped as the API's change tracking does, so delta exports see loads
+    modified_at = next((column.name for column in table.columns if column.name.upper() == "MODIFIED_AT"), None)
+    if modified_at:
+        stamp = now_stamp()
+        for row in rows:
+            row[modified_at] = stamp
+    return rows
+
+
+def fill_date_shadows(table, columns, rows):
+    # Only for targets the API has already added the shadow columns to
+    actual = {column.name.upper(): column.name for column in table.columns}
+    pairs = [(columns[name], actual[shadow]) for name, shadow in DATE_SHADOWS.items()
+             if name in columns and shadow in actual]
+    for row in rows:
+        for source, shadow in pairs:
+            row[shadow] = to_ymd(row[source])
+    return rows
+
+
+def prepare_rows(table, columns, documents):
+    rows = [to_row(document, columns) for document in documents]
+    return fill_date_shadows(table, columns, stamp_modified(table, rows))
+
+
+def insert_chunk(engine, table, columns, documents):
+    rows = prepare_rows(table, columns, documents)
+    # One transaction per chunk; executemany under the hood
+    with engine.begin() as conn:
+        conn.execute(table.insert(), rows)
+    return len(rows)
+
+
+def load(collection, engine, table_name='newDataset', chunk_size=DEFAULT_CHUNK_SIZE,
+         workers=DEFAULT_WORKERS, checkpoint_path=DEFAULT_CHECKPOINT):
+    """Copy the collection into the target table in parallel, resumable chunks.
+
+    Returns (rows loaded, seconds taken).
     """
+    table, columns = reflect_columns(engine, table_name)
+    checkpoint = load_checkpoint(checkpoint_path)
+    # Chunks in submission order: [first_id, last_id, finished]
+    pending = []
+    loaded = 0
+    start = time.perf_counter()
+
+    def advance():
+        # Move the watermark over the finished prefix of pending chunks
+        while pending and pending[0][2]:
+            first_id, last_id, _ = pending.pop(0)
+            checkpoint["watermark"] = last_id
+        checkpoint["done"] = [
+            [first_id, last_id] for first_id, last_id, finished in pending if finished
+        ]
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    def collect(futures, return_when):
+        # Record finished chunks, checkpoint, and hand back the first failure
+        nonlocal loaded
+        error = None
+        finished, _ = wait(futures, return_when=return_when)
+        for future in finished:
+            entry = futures.pop(future)
+            try:
+                loaded += future.result()
+                entry[2] = True
+            except Exception as exc:
+                error = error or exc
+        advance()
+        return error
+
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        try:
+            for documents in iter_chunks(collection, chunk_size, checkpoint):
+                entry = [documents[0]["_id"], documents[-1]["_id"], False]
+                pending.append(entry)
+                futures[pool.submit(insert_chunk, engine, table, columns, documents)] = entry
+                # Bound the number of chunks held in memory
+                if len(futures) >= workers * 2:
+                    error = collect(futures, FIRST_COMPLETED)
+                    if error:
+                        raise error
+                    print(f"  {loaded} rows, {loaded / (time.perf_counter() - start):.0f} rows/sec")
+        finally:
+            # Let in-flight chunks finish so the checkpoint covers them
+            if futures:
+                error = collect(futures, ALL_COMPLETED)
+    if error:
+        raise error
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return loaded, time.perf_counter() - start
+
+
+# --- Incremental sync ---
+# The sync state is a persistent high-water mark: the watermark field's value
+# and _id of the last document upserted. Each run reads only documents after
+# it, ordered by (field, _id) so documents sharing a timestamp are neither
+# skipped nor read twice, and upserts them by TRANSACTION_ID.
+#
+# With the default field, _id, only new documents are seen; pass an updated-at
+# field (indexed together with _id in MongoDB) to also pick up edits.
+
+def load_sync_state(path, field):
+    state = {"field": field, "watermark": None, "last_id": None}
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json_util.loads(f.read())
+        if state["field"] != field:
+            raise ValueError(f"Sync state at {path} tracks '{state['field']}', not '{field}'; "
+                             f"pass --updated-field {state['field']} or use a new --state file")
+    return state
+
+
+def iter_changes(collection, chunk_size, state):
+    """Yield lists of documents after the sync state's mark, in (field, _id) order."""
+    field, watermark, last_id = state["field"], state["watermark"], state["last_id"]
+    if field == "_id":
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        order = [("_id", 1)]
+    else:
+        # Documents without the field are never picked up in this mode
+        query = {field: {"$exists": True}}
+        if watermark is not None:
+            query = {"$or": [{field: {"$gt": watermark}}, {field: watermark, "_id": {"$gt": last_id}}]}
+        order = [(field, 1), ("_id", 1)]
+    projection = {name: 1 for name in rename_map}
+    projection[field] = 1
+    cursor = collection.find(query, projection).sort(order).batch_size(chunk_size)
+
+    chunk = []
+    for document in cursor:
+        chunk.append(document)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def reflect_tombstones(engine, table_name):
+    """The API's delete tombstones table for ``table_name``, if the warehouse has one."""
+    name = f"{table_name}Tombstones".lower()
+    if not inspect(engine).has_table(name):
+        return None
+    return Table(name, MetaData(), autoload_with=engine)
 
-    # Step 11: Insert data
-    for _, row in df.iterrows():
-        values = tuple(row.fillna("").values.tolist())
-        cursor.execute(insert_query, values)
 
-    conn.commit()
-    print("✅ JSON data from MongoDB loaded into Snowflake.")
+def key_is_unique(table, key):
+    if key in {column.name for column in table.primary_key.columns}:
+        return True
+    return any(index.unique and [column.name for column in index.columns] == [key] for index in table.indexes)
 
-except Exception as e:
-    print(f"❌ Error: {e}")
 
-finally:
+def merge_rows(conn, table, rows, key):
+    """Snowflake: MERGE from a session-temporary staging table (primary keys aren't enforced)."""
+    names = list(rows[0])
+    stage = Table(f"{table.name}_sync_stage", MetaData(), *(Column(name, String) for name in names))
+    conn.execute(text(f"CREATE TEMPORARY TABLE IF NOT EXISTS {stage.name} LIKE {table.name}"))
+    conn.execute(stage.delete())
+    conn.execute(stage.insert(), rows)
+    updates = ", ".join(f"t.{name} = s.{name}" for name in names if name != key)
+    conn.execute(text(
+        f"MERGE INTO {table.name} t USING {stage.name} s ON t.{key} = s.{key} "
+        f"WHEN MATCHED THEN UPDATE SET {updates} "
+        f"WHEN NOT MATCHED THEN INSERT ({', '.join(names)}) "
+        f"VALUES ({', '.join(f's.{name}' for name in names)})"
+    ))
+
+
+def upsert_chunk(engine, table, columns, documents, tombstones=None):
+    """Insert or replace documents by TRANSACTION_ID in one transaction."""
+    key = columns["TRANSACTION_ID"]
+    rows = prepare_rows(table, columns, documents)
+    # Last one wins within a chunk; MERGE and ON CONFLICT reject repeated keys
+    rows = list({row[key]: row for row in rows}.values())
+    keys = [row[key] for row in rows]
+    with engine.begin() as conn:
+        dialect = conn.dialect.name
+        if dialect == "snowflake":
+            merge_rows(conn, table, rows, key)
+        elif dialect in ("sqlite", "postgresql") and key_is_unique(table, key):
+            if dialect == "sqlite":
+                from sqlalchemy.dialects.sqlite import insert as dialect_insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert as dialect_insert
+            statement = dialect_insert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c[key]],
+                set_={name: statement.excluded[name] for name in rows[0] if name != key},
+            )
+            conn.execute(statement, rows)
+        else:
+            conn.execute(table.delete().where(table.c[key].in_(keys)))
+            conn.execute(table.insert(), rows)
+        if tombstones is not None:
+            # A re-synced record is live again; see the API's clear_tombstone
+            tombstone_key = next(column for column in tombstones.columns if column.name.upper() == "TRANSACTION_ID")
+            conn.execute(tombstones.delete().where(tombstone_key.in_(keys)))
+    return len(rows)
+
+
+def sync(collection, engine, table_name='newDataset', chunk_size=DEFAULT_CHUNK_SIZE,
+         state_path=DEFAULT_SYNC_STATE, updated_field=None):
+    """Upsert documents added (or, with ``updated_field``, changed) since the last sync.
+
+    Chunks are applied in order and the state is saved after each commit,
+    so an interrupted sync resumes where it stopped. Returns (rows upserted,
+    seconds taken).
+    """
+    table, columns = reflect_columns(engine, table_name)
+    if "TRANSACTION_ID" not in columns:
+        raise ValueError(f"{table_name} has no TRANSACTION_ID column to upsert on")
+    tombstones = reflect_tombstones(engine, table_name)
+    state = load_sync_state(state_path, updated_field or "_id")
+    field = state["field"]
+    upserted = 0
+    start = time.perf_counter()
+    for documents in iter_changes(collection, chunk_size, state):
+        upserted += upsert_chunk(engine, table, columns, documents, tombstones)
+        state["watermark"] = documents[-1].get(field)
+        state["last_id"] = documents[-1]["_id"]
+        save_checkpoint(state_path, state)
+        print(f"  {upserted} rows, {upserted / (time.perf_counter() - start):.0f} rows/sec")
+    return upserted, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the MongoDB Dataset1 collection into the warehouse.")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--table", default='newDataset')
+    parser.add_argument("--sync", action="store_true",
+                        help="upsert only documents newer than the saved high-water mark")
+    parser.add_argument("--state", default=DEFAULT_SYNC_STATE, help="sync high-water mark file")
+    parser.add_argument("--updated-field",
+                        help="MongoDB updated-at field to track edits by (default: new _ids only)")
+    args = parser.parse_args()
+
+    mongo_client = None
     try:
-        cursor.close()
-        conn.close()
-    except:
-        pass
+        # Connect to MongoDB
+        mongo_url = os.environ.get('MONGO_URL', "mongodb://localhost:27017")
+        mongo_client = MongoClient(mongo_url)
+        collection = mongo_client["healthcare"]["Dataset1"]
+
+        # Target defaults to Snowflake; DATABASE_URL points it elsewhere
+        engine = create_engine(os.environ.get('DATABASE_URL') or snowflake_url())
+
+        if args.sync:
+            synced, elapsed = sync(
+                collection, engine, args.table,
+                chunk_size=args.chunk_size, state_path=args.state, updated_field=args.updated_field,
+            )
+            print(f"✅ {synced} changed documents synced in {elapsed:.1f}s.")
+            return
+
+        loaded, elapsed = load(
+            collection, engine, args.table,
+            chunk_size=args.chunk_size, workers=args.workers, checkpoint_path=args.checkpoint,
+        )
+        if not loaded:
+            raise ValueError("No documents found in MongoDB collection.")
+        print(f"✅ {loaded} documents from MongoDB loaded into Snowflake "
+              f"in {elapsed:.1f}s ({loaded / elapsed:.0f} rows/sec).")
+
+    except Exception as e:
+        print(f"❌ Error: {e}")
+
+    finally:
+        if mongo_client is not None:
+            mongo_client.close()
+
+
+if __name__ == "__main__":
+    main()
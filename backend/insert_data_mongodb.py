@@ -1,32 +1,78 @@
-import json
-from pymongo import MongoClient
-from dotenv import load_dotenv
+import argparse
 import os
+import time
+from itertools import islice
+
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+
+from json_conversion import iter_csv_rows, iter_ndjson, tee_ndjson
 
 load_dotenv()
 
-# Connect to MongoDB
-mongo_url = os.environ.get('MONGO_URL', "mongodb://localhost:27017") #Get MongoDB URL from environment or default to localhost
-client = MongoClient(mongo_url)
-db = client["healthcare"]
-collection = db["Dataset1"]
+DEFAULT_BATCH_SIZE = 1000
+PROGRESS_EVERY = 50000
+
+def insert_in_batches(collection, documents, batch_size=DEFAULT_BATCH_SIZE):
+    """insert_many each batch unordered; returns (inserted, failed, seconds).
+
+    Only one batch is held in memory, so any size of input works.
+    """
+    inserted = failed = 0
+    next_report = PROGRESS_EVERY
+    start = time.perf_counter()
+    documents = iter(documents)
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            break
+        try:
+            inserted += len(collection.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            # ordered=False: everything except the rejected documents went in
+            inserted += e.details["nInserted"]
+            failed += len(e.details["writeErrors"])
+        if inserted + failed >= next_report:
+            elapsed = time.perf_counter() - start
+            print(f"  {inserted + failed} rows processed, {inserted / elapsed:.0f} rows/sec")
+            next_report += PROGRESS_EVERY
+    return inserted, failed, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream CSV or NDJSON rows into MongoDB.")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--csv-dir", default='csv', help="Directory holding Dataset.csv")
+    source.add_argument("--ndjson", help="Read an existing NDJSON(.gz) file instead of CSV")
+    parser.add_argument("--ndjson-out", help="Also write the CSV rows to this NDJSON(.gz) file")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--limit", type=int, help="Stop after this many CSV rows")
+    args = parser.parse_args()
 
-json_filepath = 'output/newDataset.json'
+    # Connect to MongoDB
+    mongo_url = os.environ.get('MONGO_URL', "mongodb://localhost:27017") #Get MongoDB URL from environment or default to localhost
+    client = MongoClient(mongo_url)
+    collection = client["healthcare"]["Dataset1"]
 
-try:
-    with open(json_filepath, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    try:
+        if args.ndjson:
+            documents = iter_ndjson(args.ndjson)
+        else:
+            documents = iter_csv_rows(args.csv_dir, limit=args.limit)
+            if args.ndjson_out:
+                documents = tee_ndjson(documents, args.ndjson_out)
 
-    # If data is a list, use it directly
-    documents = data if isinstance(data, list) else list(data.values())
+        inserted, failed, elapsed = insert_in_batches(collection, documents, args.batch_size)
+        if inserted or failed:
+            print(f"✅ Inserted {inserted} documents into MongoDB in {elapsed:.1f}s "
+                  f"({inserted / elapsed:.0f} rows/sec, {failed} rejected).")
+        else:
+            print("No data found to insert.")
 
-    if documents:
-        collection.insert_many(documents)
-        print(f"✅ Inserted {len(documents)} documents into MongoDB.")
-    else:
-        print("No data found to insert.")
+    except Exception as e:
+        print(f"Error inserting data into MongoDB: {e}")
 
-except Exception as e:
-    print(f"Error inserting data into MongoDB: {e}")
+    client.close()
 
-client.close()
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,58 @@
 import csv
+import gzip
 import json
 import os
 
-def csv_to_flat_json(csv_dir, json_filepath, limit=50):
-    files = ['Dataset.csv']
-
-    flat_data = []
+def open_text(path, mode):
+    # Transparently (de)compress .gz files
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='' if 'r' in mode else None)
+    return open(path, mode, encoding='utf-8', newline='' if 'r' in mode else None)
 
+def iter_csv_rows(csv_dir, files=('Dataset.csv',), limit=None):
+    """Yield CSV rows as flat dicts, one at a time."""
     for file in files:
         path = os.path.join(csv_dir, file)
         try:
-            with open(path, 'r', encoding='utf-8') as f:
+            with open_text(path, 'r') as f:
                 reader = csv.DictReader(f)
                 for i, row in enumerate(reader):
-                    if i >= limit:
+                    if limit is not None and i >= limit:
                         break
                     row['__source_file__'] = file.replace('.csv', '')  # Optional: to track where each row came from
-                    flat_data.append(row)
+                    yield row
         except FileNotFoundError:
             print(f"Missing file: {file}, skipping...")
-        except Exception as e:
-            print(f"Error reading {file}: {e}")
 
-    # Save to JSON
+def iter_ndjson(path):
+    """Yield one document per non-empty NDJSON line."""
+    with open_text(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def tee_ndjson(rows, ndjson_path):
+    """Pass rows through while appending each one to an NDJSON file."""
+    os.makedirs(os.path.dirname(ndjson_path) or '.', exist_ok=True)
+    with open_text(ndjson_path, 'w') as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False))
+            f.write('\n')
+            yield row
+
+def csv_to_ndjson(csv_dir, ndjson_path, limit=None):
+    """Stream CSV rows into an NDJSON file (gzipped if the path ends in .gz)."""
+    count = 0
     try:
-        with open(json_filepath, 'w', encoding='utf-8') as f:
-            json.dump(flat_data, f, indent=4)
-        print(f"✅ Flat data saved to {json_filepath}")
+        for _ in tee_ndjson(iter_csv_rows(csv_dir, limit=limit), ndjson_path):
+            count += 1
+        print(f"✅ {count} rows saved to {ndjson_path}")
     except Exception as e:
-        print(f"Error writing JSON: {e}")
+        print(f"Error writing NDJSON: {e}")
+    return count
 
-# Example usage
-csv_dir = 'csv'
-json_filepath = 'output/newDataset.json'
-csv_to_flat_json(csv_dir, json_filepath)
+if __name__ == "__main__":
+    # Example usage
+    csv_dir = 'csv'
+    ndjson_path = 'output/newDataset.ndjson'
+    csv_to_ndjson(csv_dir, ndjson_path)
@@ -2,6 +2,8 @@ import streamlit as st
 import requests
 import pandas as pd
 import os
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 API_BASE_URL = os.getenv("BACKEND_URL", "http://localhost:8000/mtm")  
 NCPDP_BASE_URL = f"{API_BASE_URL}/ncpdp/messaging"
@@ -24,6 +26,7 @@ if "nav_page" not in st.session_state:
 pages = {
     "🏠 All Patients": "patients",
     "🔍 Search by ID": "search",
+    "🧮 Filter Records": "filter",
     "🔑 Demographics": "demographics"
 }
 
@@ -41,57 +44,88 @@ st.title("MTM Patient Dashboard")
 selected_page = st.session_state.nav_page
 
 # --- API Functions ---
-@st.cache_data(show_spinner=False)
-def fetch_all_patients():
+# (connect, read) timeouts; full exports get a longer read timeout
+REQUEST_TIMEOUT = (3.05, float(os.getenv("BACKEND_TIMEOUT", "30")))
+EXPORT_TIMEOUT = (3.05, float(os.getenv("BACKEND_EXPORT_TIMEOUT", "300")))
+CACHE_TTL = int(os.getenv("FRONTEND_CACHE_TTL", "60"))
+
+@st.cache_resource
+def get_http_session():
+    """One pooled keep-alive session shared by every rerun and browser tab."""
+    session = requests.Session()
+    retries = Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504), allowed_methods=("GET",))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def api_get(url, timeout=REQUEST_TIMEOUT, **kwargs):
+    return get_http_session().get(url, timeout=timeout, **kwargs)
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL, max_entries=256)
+def fetch_patients_page(after, limit):
+    """Fetch one keyset page: (rows, total_records, next_after)."""
     try:
-        response = requests.get(f"{API_BASE_URL}/")
+        params = {"limit": limit}
+        if after is not None:
+            params["after"] = after
+        response = api_get(f"{API_BASE_URL}/", params=params)
         response.raise_for_status()
-        return response.json()
+        total = int(response.headers.get("X-Total-Count", 0))
+        return response.json(), total, response.headers.get("X-Next-After")
     except Exception as e:
         st.error(f"Error fetching patients: {e}")
-        return []
+        return [], 0, None
 
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL, max_entries=256)
 def fetch_patient_by_id(patient_id):
     try:
-        response = requests.get(f"{API_BASE_URL}/{patient_id}")
+        response = api_get(f"{API_BASE_URL}/{patient_id}")
         response.raise_for_status()
         return response.json()
-    except:
+    except Exception:
         return None
 
-@st.cache_data(show_spinner=False)
+# Full exports are only fetched when the user asks for one; the short cache
+# shares a fetch between sessions asking at about the same time
+@st.cache_data(show_spinner="Preparing XML export...", ttl=CACHE_TTL, max_entries=1)
 def download_all_xml():
     try:
-        response = requests.get(f"{API_BASE_URL}/xml/all")
+        response = api_get(f"{API_BASE_URL}/xml/all", timeout=EXPORT_TIMEOUT)
         response.raise_for_status()
-        return response.text
+        return response.content
     except Exception as e:
         st.error(f"Error fetching XML: {e}")
         return None
 
 def download_xml_by_id(patient_id):
     url = f"{API_BASE_URL}/{patient_id}/xml"
-    response = requests.get(url)
+    response = api_get(url)
     return response.text if response.ok else None
 
 def download_ncpdp_by_id(patient_id):
     url = f"{NCPDP_BASE_URL}/download/{patient_id}"
-    response = requests.get(url)
+    response = api_get(url)
     return response.text if response.ok else None
 
+@st.cache_data(show_spinner="Preparing NCPDP messaging export...", ttl=CACHE_TTL, max_entries=1)
 def download_all_ncpdp():
     try:
-        response = requests.get(MESSAGING_EXPORT_URL)
+        response = api_get(MESSAGING_EXPORT_URL, timeout=EXPORT_TIMEOUT)
         response.raise_for_status()
-        return response.text
+        return response.content
     except Exception as e:
         st.error(f"Error fetching NCPDP message format: {e}")
         return None
 
-def fetch_demographic_by_key(patient_id, key):
+def forget_prepared_export():
+    st.session_state.pop("prepared_export", None)
+
+def fetch_demographics_by_keys(patient_id, keys):
+    # One round-trip for all keys, e.g. keys="AM20,PRV,DT"
     try:
-        url = f"{NCPDP_BASE_URL}/{patient_id}/{key}"
-        response = requests.get(url)
+        url = f"{NCPDP_BASE_URL}/{patient_id}"
+        response = api_get(url, params={"keys": keys})
         if response.status_code == 200:
             return response.json()
         else:
@@ -99,41 +133,82 @@ def fetch_demographic_by_key(patient_id, key):
     except Exception as e:
         return {"error": str(e)}
 
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL, max_entries=256)
+def search_records(filters, after, limit):
+    """One keyset page of /search results: (rows, total_matches, next_after)."""
+    try:
+        params = dict(filters, limit=limit)
+        if after is not None:
+            params["after"] = after
+        response = api_get(f"{API_BASE_URL}/search", params=params)
+        response.raise_for_status()
+        total = int(response.headers.get("X-Total-Count", 0))
+        return response.json(), total, response.headers.get("X-Next-After")
+    except Exception as e:
+        st.error(f"Error searching records: {e}")
+        return [], 0, None
+
+@st.cache_data(show_spinner="Preparing export...", ttl=CACHE_TTL, max_entries=2)
+def download_search_results(filters, export_format):
+    try:
+        response = api_get(f"{API_BASE_URL}/search", params=dict(filters, format=export_format),
+                           timeout=EXPORT_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+    except Exception as e:
+        st.error(f"Error exporting search results: {e}")
+        return None
+
+def clean_for_display(rows):
+    # Only the current page is ever cleaned, so this is O(page size)
+    return pd.DataFrame(rows).astype(str).replace("\n", " ", regex=True).replace("  ", " ", regex=True)
+
 # --- Page Logic ---
 if selected_page == "patients":
-    patients = fetch_all_patients()
+    rows_per_page = st.number_input("Rows per page", min_value=1, max_value=1000, value=10)
+
+    # Keyset cursors of the pages visited so far; page 1 starts at None
+    if st.session_state.get("page_size") != rows_per_page:
+        st.session_state.page_size = rows_per_page
+        st.session_state.page_cursors = [None]
+        st.session_state.current_page = 1
+    page = st.session_state.current_page
+    patients, total_records, next_after = fetch_patients_page(st.session_state.page_cursors[page - 1], rows_per_page)
+
     if patients:
         st.subheader("📋 All Patients (Paginated View)")
-        df = pd.DataFrame(patients)
+        total_pages = max((total_records - 1) // rows_per_page + 1, 1)
 
-        colA, colB = st.columns([4, 1])
+        colA, colB, colC = st.columns([4, 1, 1])
         with colA:
-            rows_per_page = st.number_input("Rows per page", min_value=1, max_value=1000, value=10)
+            st.caption(f"Showing page {page} of {total_pages}")
         with colB:
-            total_records = len(df)
-            total_pages = max((total_records - 1) // rows_per_page + 1, 1)
-            if "current_page" not in st.session_state:
-                st.session_state.current_page = 1
-            page = st.number_input("Page", min_value=1, max_value=total_pages, value=st.session_state.current_page)
-            st.session_state.current_page = page
-
-        st.caption(f"Showing page {page} of {total_pages}")
-        start_idx = (page - 1) * rows_per_page
-        end_idx = start_idx + rows_per_page
-        display_df = df.iloc[start_idx:end_idx].copy()
-        for col in display_df.columns:
-            display_df[col] = display_df[col].astype(str).str.replace("\n", " ").str.replace("  ", " ")
-        st.dataframe(display_df)
+            if st.button("◀ Previous", disabled=page <= 1):
+                st.session_state.current_page -= 1
+                st.rerun()
+        with colC:
+            if st.button("Next ▶", disabled=next_after is None):
+                del st.session_state.page_cursors[page:]
+                st.session_state.page_cursors.append(next_after)
+                st.session_state.current_page += 1
+                st.rerun()
+
+        st.dataframe(clean_for_display(patients))
 
         format_choice = st.selectbox("Choose Format to Download All", ["NCPDP XML Format", "NCPDP Messaging Format"], key="all_format")
-        if format_choice == "NCPDP XML Format":
-            xml_data = download_all_xml()
-            if xml_data:
-                st.download_button("Download All Patients (XML)", data=xml_data, file_name="all_patients.xml", mime="application/xml")
+        # The export is fetched once, on request, and kept in the session until
+        # it is downloaded, so paging and other reruns never fetch it again
+        prepared = st.session_state.get("prepared_export")
+        if prepared is None or prepared[0] != format_choice:
+            if st.button("Prepare download"):
+                data = download_all_xml() if format_choice == "NCPDP XML Format" else download_all_ncpdp()
+                if data:
+                    st.session_state.prepared_export = (format_choice, data)
+                    st.rerun()
+        elif format_choice == "NCPDP XML Format":
+            st.download_button("Download All Patients (XML)", data=prepared[1], file_name="all_patients.xml", mime="application/xml", on_click=forget_prepared_export)
         else:
-            ncpdp_data = download_all_ncpdp()
-            if ncpdp_data:
-                st.download_button("Download All Patients (NCPDP Messaging Format)", data=ncpdp_data, file_name="all_patients.txt", mime="text/plain")
+            st.download_button("Download All Patients (NCPDP Messaging Format)", data=prepared[1], file_name="all_patients.txt", mime="text/plain", on_click=forget_prepared_export)
     else:
         st.warning("No patient records available.")
 
@@ -163,6 +238,60 @@ elif selected_page == "search":
         else:
             st.warning("Patient not found.")
 
+elif selected_page == "filter":
+    st.subheader("🧮 Filter Records")
+    with st.form("filter_form"):
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            payer_id = st.text_input("Payer ID")
+            plan_name = st.text_input("Plan Name")
+        with col2:
+            intervention_type = st.text_input("Intervention Type")
+            mtm_service_code = st.text_input("MTM Service Code")
+        with col3:
+            outcome = st.text_input("Outcome")
+            start_range = st.date_input("Start Date between", value=(), key="start_range")
+        st.form_submit_button("Apply Filters")
+
+    # Only the filters that were filled in; tuples keep the cache key hashable
+    filters = tuple((name, value.strip()) for name, value in (
+        ("payer_id", payer_id), ("plan_name", plan_name), ("intervention_type", intervention_type),
+        ("mtm_service_code", mtm_service_code), ("outcome", outcome),
+    ) if value.strip())
+    if len(start_range) == 2:
+        filters += (("start_from", start_range[0].isoformat()), ("start_to", start_range[1].isoformat()))
+
+    if st.session_state.get("filter_key") != filters:
+        st.session_state.filter_key = filters
+        st.session_state.filter_cursors = [None]
+    cursors = st.session_state.filter_cursors
+    matches, total_matches, next_after = search_records(filters, cursors[-1], 50)
+
+    st.caption(f"{total_matches} matching records, page {len(cursors)}")
+    colA, colB = st.columns([1, 1])
+    with colA:
+        if st.button("◀ Previous", key="filter_prev", disabled=len(cursors) <= 1):
+            cursors.pop()
+            st.rerun()
+    with colB:
+        if st.button("Next ▶", key="filter_next", disabled=next_after is None):
+            cursors.append(next_after)
+            st.rerun()
+    if matches:
+        st.dataframe(clean_for_display(matches))
+        export_choice = st.selectbox("Export Matches As", ["NCPDP XML Format", "NCPDP Messaging Format"], key="filter_format")
+        if st.button("Prepare export", key="filter_export"):
+            if export_choice == "NCPDP XML Format":
+                data = download_search_results(filters, "xml")
+                if data:
+                    st.download_button("Download Matches (XML)", data=data, file_name="search_results.xml", mime="application/xml")
+            else:
+                data = download_search_results(filters, "messaging")
+                if data:
+                    st.download_button("Download Matches (NCPDP Messaging Format)", data=data, file_name="search_results.txt", mime="text/plain")
+    else:
+        st.warning("No records match these filters.")
+
 elif selected_page == "demographics":
     st.subheader("🔑 Search Patient Demographic Field")
     with st.form("demo_search_form"):
@@ -170,17 +299,20 @@ elif selected_page == "demographics":
         with col1:
             key_patient_id = st.text_input("Enter Patient ID", key="demo_pid")
         with col2:
-            key_name = st.text_input("Enter Key (e.g., AM20, PAT)", key="demo_key")
+            key_name = st.text_input("Enter Keys (e.g., AM20, PAT)", key="demo_key")
         submitted = st.form_submit_button("Search")
 
     if submitted:
         if key_patient_id.strip() and key_name.strip():
-            result = fetch_demographic_by_key(key_patient_id, key_name)
+            result = fetch_demographics_by_keys(key_patient_id, key_name)
             if "error" in result:
                 st.error(result["error"])
             else:
-                value = result.get(key_name.upper(), "")
-                st.success(f"{key_name.upper()} = {value}")
+                for key, value in result.items():
+                    if value is None:
+                        st.warning(f"{key} is empty for this patient.")
+                    else:
+                        st.success(f"{key} = {value}")
         else:
             st.warning("Please fill both Patient ID and Key fields.")
 